@@ -0,0 +1,25 @@
+"""blobs of long article contents, moved there with manage.py offload-content
+
+Revision ID: 0c7d5e2a9b41
+Revises: f8a2c6d05e19
+Create Date: 2026-10-18 19:26:51.730414
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0c7d5e2a9b41'
+down_revision = 'f8a2c6d05e19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('articles', sa.Column('content_blob', sa.String(length=42), nullable=True))
+
+
+def downgrade():
+    # Note contents moved to blobs have to be moved back first
+    op.drop_column('articles', 'content_blob')
@@ -0,0 +1,33 @@
+"""articles.content_words, so the full-text index finds offloaded contents
+
+Revision ID: 3c8e5a7b2f14
+Revises: 6a2f8c4d1e93
+Create Date: 2026-10-19 12:26:03.918452
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c8e5a7b2f14'
+down_revision = '6a2f8c4d1e93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Filled in for contents offloaded before by `manage.py reindex`
+    op.add_column('articles', sa.Column('content_words', sa.String(), nullable=True))
+    if op.get_bind().dialect.name != 'mssql':
+        return
+    # Full-text statements can't run within a transaction
+    with op.get_context().autocommit_block():
+        op.execute('ALTER FULLTEXT INDEX ON articles ADD (content_words)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'mssql':
+        with op.get_context().autocommit_block():
+            op.execute('ALTER FULLTEXT INDEX ON articles DROP (content_words)')
+    op.drop_column('articles', 'content_words')
@@ -0,0 +1,28 @@
+"""claims of direct uploads, so each upload_token is used once
+
+Revision ID: 4e1a8f3c6b25
+Revises: 0c7d5e2a9b41
+Create Date: 2026-10-19 10:12:37.508126
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4e1a8f3c6b25'
+down_revision = '0c7d5e2a9b41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('upload_claims',
+    sa.Column('blob_filename', sa.String(length=255), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('blob_filename')
+    )
+
+
+def downgrade():
+    op.drop_table('upload_claims')
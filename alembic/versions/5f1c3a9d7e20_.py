@@ -0,0 +1,31 @@
+"""blob deletions outbox
+
+Revision ID: 5f1c3a9d7e20
+Revises: 289411b2e831
+Create Date: 2026-10-18 09:12:44.318020
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f1c3a9d7e20'
+down_revision = '289411b2e831'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('blob_deletions',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('container_name', sa.String(length=63), nullable=False),
+    sa.Column('blob_filename', sa.String(length=255), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('blob_deletions')
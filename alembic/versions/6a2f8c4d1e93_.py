@@ -0,0 +1,28 @@
+"""users.created_at, so incremental exports of users can lag behind
+
+Revision ID: 6a2f8c4d1e93
+Revises: 9d3b6e1f0a72
+Create Date: 2026-10-19 11:48:51.204376
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6a2f8c4d1e93'
+down_revision = '9d3b6e1f0a72'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('created_at', sa.DateTime(), nullable=True))
+    # Existing users count as added now, so they're in the next export
+    users = sa.table('users', sa.column('created_at', sa.DateTime()))
+    op.execute(users.update().values(created_at=datetime.utcnow()))
+
+
+def downgrade():
+    op.drop_column('users', 'created_at')
@@ -0,0 +1,44 @@
+"""cascade user deletes, background jobs
+
+Revision ID: 7be25f0d9a14
+Revises: d41b7e09c3a5
+Create Date: 2026-10-18 12:40:55.104327
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7be25f0d9a14'
+down_revision = 'd41b7e09c3a5'
+branch_labels = None
+depends_on = None
+
+
+def _drop_user_foreign_key():
+    # The original constraint was unnamed, so look up the name SQL Server gave it
+    for fk in sa.inspect(op.get_bind()).get_foreign_keys('articles'):
+        if fk['referred_table'] == 'users':
+            op.drop_constraint(fk['name'], 'articles', type_='foreignkey')
+
+
+def upgrade():
+    _drop_user_foreign_key()
+    op.create_foreign_key('fk_articles_user_id', 'articles', 'users', 
+        ['user_id'], ['id'], ondelete='CASCADE')
+    op.create_table('jobs',
+    sa.Column('id', sa.String(length=36), nullable=False),
+    sa.Column('name', sa.String(length=63), nullable=False),
+    sa.Column('status', sa.String(length=16), nullable=False),
+    sa.Column('error', sa.String(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('jobs')
+    _drop_user_foreign_key()
+    op.create_foreign_key('fk_articles_user_id', 'articles', 'users', ['user_id'], ['id'])
@@ -0,0 +1,24 @@
+"""index articles.image_filename, looked up by image variants
+
+Revision ID: 9d3b6e1f0a72
+Revises: 4e1a8f3c6b25
+Create Date: 2026-10-19 11:02:14.731690
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d3b6e1f0a72'
+down_revision = '4e1a8f3c6b25'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_articles_image_filename'), 'articles', ['image_filename'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_articles_image_filename'), table_name='articles')
@@ -0,0 +1,34 @@
+"""collection versions
+
+Revision ID: a83d0f6b41c7
+Revises: 5f1c3a9d7e20
+Create Date: 2026-10-18 10:02:31.904114
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a83d0f6b41c7'
+down_revision = '5f1c3a9d7e20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    collection_versions = op.create_table('collection_versions',
+    sa.Column('name', sa.String(length=63), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+    # Seed the versioned tables, so bumping them is always an update
+    op.bulk_insert(collection_versions, [
+        dict(name='users', version=1, updated_at=datetime.utcnow()),
+        dict(name='articles', version=1, updated_at=datetime.utcnow())])
+
+
+def downgrade():
+    op.drop_table('collection_versions')
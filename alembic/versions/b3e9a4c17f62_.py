@@ -0,0 +1,47 @@
+"""article search: full-text index on SQL Server, article_terms elsewhere
+
+Revision ID: b3e9a4c17f62
+Revises: e6f31c8b2d57
+Create Date: 2026-10-18 16:40:27.118305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3e9a4c17f62'
+down_revision = 'e6f31c8b2d57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Searched where there's no full-text index, fill it with `manage.py reindex`
+    op.create_table('article_terms',
+    sa.Column('term', sa.String(length=64), nullable=False),
+    sa.Column('article_id', sa.Integer(), nullable=False),
+    sa.Column('weight', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['article_id'], ['articles.id'], name='fk_article_terms_article_id', ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('term', 'article_id')
+    )
+    op.create_index(op.f('ix_article_terms_article_id'), 'article_terms', ['article_id'], unique=False)
+
+    if op.get_bind().dialect.name != 'mssql':
+        return
+    # The full-text index is keyed on the primary key, whose name SQL Server
+    # generated. Full-text statements can't run within a transaction
+    pk_name = sa.inspect(op.get_bind()).get_pk_constraint('articles')['name']
+    with op.get_context().autocommit_block():
+        op.execute('CREATE FULLTEXT CATALOG articles_catalog')
+        op.execute(f'CREATE FULLTEXT INDEX ON articles (title, content) KEY INDEX [{pk_name}] '
+            'ON articles_catalog WITH CHANGE_TRACKING AUTO')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'mssql':
+        with op.get_context().autocommit_block():
+            op.execute('DROP FULLTEXT INDEX ON articles')
+            op.execute('DROP FULLTEXT CATALOG articles_catalog')
+    op.drop_index(op.f('ix_article_terms_article_id'), table_name='article_terms')
+    op.drop_table('article_terms')
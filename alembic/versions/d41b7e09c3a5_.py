@@ -0,0 +1,24 @@
+"""article image variants
+
+Revision ID: d41b7e09c3a5
+Revises: a83d0f6b41c7
+Create Date: 2026-10-18 11:24:07.312558
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41b7e09c3a5'
+down_revision = 'a83d0f6b41c7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('articles', sa.Column('image_variants', sa.String(length=255), nullable=True))
+
+
+def downgrade():
+    op.drop_column('articles', 'image_variants')
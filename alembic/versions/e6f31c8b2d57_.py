@@ -0,0 +1,27 @@
+"""indexes for list filters and sorts
+
+Revision ID: e6f31c8b2d57
+Revises: 7be25f0d9a14
+Create Date: 2026-10-18 14:05:12.671830
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6f31c8b2d57'
+down_revision = '7be25f0d9a14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Also serves the user delete cascade, which filters on user_id alone
+    op.create_index('ix_articles_user_id_created_at', 'articles', ['user_id', 'created_at'], unique=False)
+    op.create_index(op.f('ix_users_name'), 'users', ['name'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_users_name'), table_name='users')
+    op.drop_index('ix_articles_user_id_created_at', table_name='articles')
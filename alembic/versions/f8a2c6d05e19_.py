@@ -0,0 +1,29 @@
+"""blob reference counts, for content addressed blobs
+
+Revision ID: f8a2c6d05e19
+Revises: b3e9a4c17f62
+Create Date: 2026-10-18 16:42:08.215307
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f8a2c6d05e19'
+down_revision = 'b3e9a4c17f62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('blob_refs',
+    sa.Column('container_name', sa.String(length=63), nullable=False),
+    sa.Column('digest', sa.String(length=64), nullable=False),
+    sa.Column('refs', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('container_name', 'digest')
+    )
+
+
+def downgrade():
+    op.drop_table('blob_refs')
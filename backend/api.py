@@ -1,9 +1,18 @@
+import base64
+import binascii
 import inspect
 import logging
+import zlib
 
+from datetime import datetime
 from functools import wraps
-from flask import Blueprint, request, jsonify
-from backend.services import user_service, article_service
+from flask import Blueprint, Response, current_app, json, jsonify, request, stream_with_context, url_for
+from backend.blob_cache import blob_cache
+from backend.export import exporter
+from backend.limits import limiter
+from backend.models import Article, InvalidUpload
+from backend.serializers import encoder
+from backend.services import job_runner, user_service, article_service
 from werkzeug.utils import secure_filename
 
 
@@ -24,12 +33,32 @@ def parse_params(required_params):
     return (params, missing_params)
 
 
-def route(*args, required_params=[], **kwargs):
-    """Hacky helper to parse/validate params and jsonify response."""
+def route(*args, required_params=[], conditional=None, limit=None, **kwargs):
+    """Hacky helper to parse/validate params and jsonify response.
+    
+    GET routes given a `conditional` service, support conditional requests 
+    against the version of that service's models (see `not_modified`). 
+    Route defs can ask for that version with a version function argument.
+
+    Requests are admitted per the limits of the route's endpoint class (see
+    `limits.Limiter`), by default read for GET routes and write otherwise."""
+    methods = [method.upper() for method in kwargs.get('methods', ['GET'])]
+    limit = limit or ('read' if methods == ['GET'] else 'write')
+
     def decorator(f):
         @bp.route(*args, **kwargs)
+        @limiter.limit(limit)
         @wraps(f)
         def wrapper(*args, **kwargs):
+            validators = None
+            if conditional is not None and request.method == 'GET':
+                version = conditional.version()
+                validators = conditional_validators(conditional, version)
+                if not_modified(*validators):
+                    return with_validators(Response(status=304), *validators)
+                if 'version' in inspect.getfullargspec(f).args:
+                    kwargs['version'] = version
+
             # route defs with can ask for request params to be parse 
             # by specifying a params function argument
             if 'params' in inspect.getfullargspec(f).args:
@@ -40,42 +69,287 @@ def route(*args, required_params=[], **kwargs):
 
             status = 200
             resp = f(*args, **kwargs)
-            if isinstance(resp, tuple):
-                resp = resp[0]
-                status = resp[1]
-            return jsonify(resp), status
+            # Already a response (e.g, streamed), nothing more to do
+            if not isinstance(resp, Response):
+                if isinstance(resp, tuple):
+                    resp, status = resp
+                resp = encoder.response(resp)
+                resp.status_code = status
+            if validators and resp.status_code == 200:
+                with_validators(resp, *validators)
+            return resp
         return f
     return decorator
 
 
-@route('/articles', methods=['get'])
-def list_articles():
-    articles = [art.as_dict() for art in article_service.all()]
-    return articles
+def conditional_validators(service, version):
+    """Returns the ETag and Last-Modified for the current request, from the
+    (version, updated_at) of the service's models. The query string is part
+    of the ETag since it changes the representation (e.g, ?limit=)."""
+    version, updated_at = version
+    variant = zlib.crc32(request.query_string)
+    return (f'{service._model_.__tablename__}-{version}-{variant:x}', updated_at)
+
+
+def not_modified(etag, last_modified):
+    """True if the client's copy (per If-None-Match, or If-Modified-Since 
+    when there's no If-None-Match) is still current."""
+    if request.if_none_match:
+        # Weak comparison, compressed responses have weak ETags
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        # HTTP dates only have a resolution of seconds
+        return last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
+
+def with_validators(resp, etag, last_modified):
+    resp.set_etag(etag)
+    if last_modified:
+        resp.last_modified = last_modified
+    # Clients may keep the response, but have to revalidate it before use
+    resp.cache_control.no_cache = True
+    return resp
+
+
+def arg_flag(name):
+    """True if the given query arg is set to a truthy value, (e.g, ?stream=1)."""
+    return request.args.get(name, '').lower() in ['1','y','yes','t','true']
+
+
+def encode_cursor(key):
+    """Encodes the given keyset values as an opaque cursor for clients."""
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in key]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def column_value(model, name, value):
+    """Converts value (e.g, from a query arg) to the type of the given 
+    column, raises ValueError if it can't be."""
+    python_type = model.__table__.columns[name].type.python_type
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    return python_type(value)
+
+
+def decode_cursor(cursor, model, sort=None):
+    """Decodes a cursor from `encode_cursor` back into the keyset values of 
+    the given model, raises ValueError if the cursor is not valid."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f'Invalid cursor: {cursor}')
+    keyset = model.keyset(sort)
+    if not isinstance(values, list) or len(values) != len(keyset):
+        raise ValueError(f'Invalid cursor: {cursor}')
+    return [column_value(model, name, value) for (name, _), value in zip(keyset, values)]
+
+
+def list_options(model):
+    """Parses the filters (see the model's `__filters__`), `sort` (e.g, 
+    -created_at) and `fields` (e.g, id,title) query args of list requests. 
+    Raises ValueError if any of them is not valid."""
+    options = {}
+    filters = {name: column_value(model, column, request.args[name])
+        for name, (column, _) in model.__filters__.items() if request.args.get(name)}
+    if filters:
+        options['filters'] = filters
+    if request.args.get('sort'):
+        options['sort'] = request.args['sort']
+        model.keyset(options['sort'])
+    if request.args.get('fields'):
+        fields = request.args['fields'].split(',')
+        columns = model.row_serializer().fields
+        unknown = [name for name in fields if name not in columns]
+        if unknown:
+            raise ValueError(f'Invalid fields: {unknown}')
+        # In column order, so each set of fields has a single serializer
+        options['fields'] = tuple(name for name in columns if name in fields)
+    return options
+
+
+def paginate(service, **options):
+    """Returns a page of the given service's models, using the `limit` and 
+    `after` (cursor from a previous page) query args."""
+    limit = request.args.get('limit', current_app.config['API_PAGE_LIMIT'], type=int)
+    limit = max(1, min(limit, current_app.config['API_PAGE_LIMIT_MAX']))
+    cursor, after = request.args.get('after'), None
+    if cursor:
+        try:
+            after = decode_cursor(cursor, service._model_, options.get('sort'))
+        except (TypeError, ValueError) as e:
+            return dict(error=str(e)), 400
+    items, next_key = service.page(limit, after=after, **options)
+    return dict(items=items, next=encode_cursor(next_key) if next_key else None)
+
 
-@route('/articles', methods=['post'], required_params=['user_id', 'title'])
+def list_models(service, version=None):
+    """Lists the given service's models, all of them, a page at a time 
+    (?limit=&after=) or streamed (?stream=1), filtered, sorted and with only 
+    the fields in the query args, see `list_options`. Given the version of
+    the models the response is validated against, it's the one listed."""
+    try:
+        options = list_options(service._model_)
+    except (TypeError, ValueError) as e:
+        return dict(error=str(e)), 400
+    if arg_flag('stream'):
+        return stream_list(service, **options)
+    if 'limit' in request.args or 'after' in request.args:
+        return paginate(service, **options)
+    return service.all_dicts(version=version[0] if version else None, **options)
+
+
+def parse_rows(field=None):
+    """Extracts the rows of a batch request, either a JSON array or newline 
+    delimited JSON (application/x-ndjson), which is parsed lazily as it's 
+    streamed in. Multipart requests carry the JSON array in the given form 
+    field, rows can then reference uploaded files by name."""
+    content_type = request.content_type or ''
+    if content_type.startswith('application/x-ndjson'):
+        return (_loads_row(line) for line in request.stream if line.strip())
+    if content_type.startswith('multipart'):
+        rows = _loads_row(request.form.get(field) or 'null')
+    else:
+        rows = request.get_json(silent=True)
+    if not isinstance(rows, list):
+        raise ValueError('Expecting a JSON array of rows')
+    return rows
+
+
+def _loads_row(line):
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def _attach_files(rows, name):
+    """Replaces the value of each row's `name` with the uploaded file it 
+    refers to, if there is one."""
+    for row in rows:
+        if isinstance(row, dict) and row.get(name) in request.files:
+            file = request.files[row[name]]
+            file.filename = secure_filename(file.filename)
+            row[name] = file
+        yield row
+
+
+def bulk_create(service, required_params, field=None, file_param=None):
+    """Creates the rows of a batch request with the given service."""
+    try:
+        rows = parse_rows(field)
+    except ValueError as e:
+        return dict(error=str(e)), 400
+    if file_param:
+        rows = _attach_files(rows, file_param)
+    created, errors = service.bulk_create(rows, 
+        current_app.config['BULK_CREATE_CHUNK_SIZE'], required_params=required_params)
+    return dict(created=created, errors=errors)
+
+
+def stream_list(service, **options):
+    """Streams all of the given service's models as a JSON array, one row at
+    a time, so memory use stays flat regardless of the number of rows."""
+    batch_size = current_app.config['DB_STREAM_BATCH_SIZE']
+    items = service.stream(batch_size, **options)
+    return Response(stream_with_context(encoder.iter_array(items, batch_size)), 
+        mimetype='application/json')
+
+
+@route('/articles', methods=['get'], conditional=article_service, limit='list')
+def list_articles(version):
+    return list_models(article_service, version)
+
+@route('/articles/search')
+def search_articles():
+    """Articles matching all the words of ?q=, best first, a page (?limit=)
+    at a time, the next page is at ?after= the returned cursor."""
+    q = request.args.get('q', '').strip()
+    if not q:
+        return dict(error='Missing required param: q'), 400
+    limit = request.args.get('limit', current_app.config['API_PAGE_LIMIT'], type=int)
+    limit = max(1, min(limit, current_app.config['API_PAGE_LIMIT_MAX']))
+    offset = 0
+    if request.args.get('after'):
+        try:
+            (offset,) = json.loads(base64.urlsafe_b64decode(request.args['after'].encode()))
+            offset = max(0, int(offset))
+        except (binascii.Error, TypeError, ValueError):
+            return dict(error=f"Invalid cursor: {request.args['after']}"), 400
+    items, more = article_service.search(q, limit, offset)
+    return dict(items=items, next=encode_cursor([offset + limit]) if more else None)
+
+@route('/articles', methods=['post'], required_params=['user_id', 'title'], limit='upload')
 def create_article(params):
-    image = request.files['image']
+    """Takes the image as a multipart file, or the `upload_token` of an
+    image uploaded straight to blob storage (see `create_article_upload`)."""
+    image = request.files.get('image')
     if image:
         image.filename = secure_filename(image.filename)
-    article = article_service.create(image=image, **params)
-    return article.as_dict()
+    try:
+        article = article_service.create(image=image, **params)
+    except InvalidUpload as e:
+        return dict(error=str(e)), 400
+    return article_service.as_dict(article, content=params.get('content'))
+
+@route('/articles/uploads', methods=['post'], required_params=['filename'])
+def create_article_upload(params):
+    """Issues a URL for clients to upload an article image to directly, 
+    then they create the article with the returned `upload_token`."""
+    return article_service.create_upload(secure_filename(params['filename']))
+
+@route('/articles:batch', methods=['post'], limit='upload')
+def create_articles_batch():
+    """Takes a JSON array (or NDJSON) of articles, or a multipart request
+    with the array in the `articles` field, where an article's `image` is 
+    the name of its file field."""
+    return bulk_create(article_service, required_params=['user_id', 'title'],
+        field='articles', file_param='image')
+
+@route('/articles/<id>/image')
+def get_article_image(id):
+    """Serves the article's image, or one of its variants (?variant=, e.g 
+    160.webp), from the local blob cache, see `blob_cache.BlobCache`."""
+    article = article_service.get(id)
+    if article is None or not article.image_filename:
+        return dict(error='Image not found'), 404
+    blob_filename = article.image_filename
+    variant = request.args.get('variant')
+    if variant:
+        if variant not in (article.image_variants or '').split(','):
+            return dict(error='Variant not found'), 404
+        blob_filename = Article.variant_filename(blob_filename, variant)
+    try:
+        return blob_cache.send(article_service.asset_container_name, blob_filename)
+    except FileNotFoundError:
+        return dict(error='Image not found'), 404
+
+@route('/articles/<id>')
+def get_article(id):
+    """The article along with its content, which lists leave out."""
+    article = article_service.get(id)
+    if article is None:
+        return dict(error='Article not found'), 404
+    return article_service.as_dict(article)
 
 @route('/articles/<id>', methods=['delete'])
 def delete_article(id):
     article_service.delete(id)
     return {}, 204 
 
-@route('/users', methods=['get'])
-def list_users():
-    users = [u.as_dict() for u in user_service.all()]
-    return users
+@route('/users', methods=['get'], conditional=user_service, limit='list')
+def list_users(version):
+    return list_models(user_service, version)
 
 @route('/users', methods=['post'], required_params=['name', 'email'])
 def create_user(params):
     user = user_service.create(**params)
     return user.as_dict()
 
+@route('/users:batch', methods=['post'], limit='upload')
+def create_users_batch():
+    return bulk_create(user_service, required_params=['name', 'email'])
+
 @route('/users/<id>', methods=['put'])
 def update_user(id, params):
     user = user_service.update(id=id, **params)
@@ -83,5 +357,41 @@ def update_user(id, params):
 
 @route('/users/<id>', methods=['delete'])
 def delete_user(id):
+    """With ?async=1, users with lots of articles are deleted in the 
+    background, returns 202 and the job to poll (see /jobs/<id>)."""
+    if arg_flag('async'):
+        job = job_runner.submit('delete_user', user_service.delete, id)
+        status_url = url_for('api.get_job', id=job.id, _external=True)
+        resp = encoder.response(dict(job.as_dict(), status_url=status_url))
+        resp.status_code = 202
+        resp.headers['Location'] = status_url
+        return resp
     user_service.delete(id)
     return {}, 204
+
+@route('/export/<table>', limit='export')
+def export_table(table):
+    """Streams all rows of a table (users or articles) as ?format= ndjson
+    (the default), csv or parquet. With ?since= the X-Export-Watermark of
+    a previous export, only the rows added after it, see `export.Exporter`.
+    Either way, rows added in the last EXPORT_WATERMARK_LAG seconds are 
+    left for the next export."""
+    format = request.args.get('format', 'ndjson')
+    try:
+        watermark, chunks = exporter.export(table, format, request.args.get('since'))
+    except LookupError as e:
+        return dict(error=str(e)), 404
+    except ValueError as e:
+        return dict(error=str(e)), 400
+    resp = Response(stream_with_context(chunks), mimetype=exporter.FORMATS[format].mimetype)
+    resp.headers['Content-Disposition'] = f'attachment; filename={table}.{format}'
+    if watermark is not None:
+        resp.headers['X-Export-Watermark'] = watermark
+    return resp
+
+@route('/jobs/<id>')
+def get_job(id):
+    job = job_runner.get(id)
+    if job is None:
+        return dict(error='Job not found'), 404
+    return job.as_dict()
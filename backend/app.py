@@ -1,8 +1,14 @@
 import logging
+import time
 import urllib.parse
 
-from flask import Flask, jsonify
-from backend import settings, api, services, datastores
+from flask import Flask, Response, jsonify
+from backend import settings, api, blob_cache, compression, contents, services, datastores, export, images, instrumentation, limits, metrics, search, serializers
+
+log = logging.getLogger(__name__)
+
+startup_duration = metrics.registry.gauge('app_startup_seconds', 
+    'Time spent by create_app, by step')
 
 
 def create_config_only_app():
@@ -27,7 +33,14 @@ def create_config_only_app():
 
     # These properties are dependent on other being set
     app.config['DB_ODBC_URI'] = f'DRIVER={app.config["DB_DRIVER"]};SERVER={app.config["DB_SERVER_HOST"]};PORT={app.config["DB_SERVER_PORT"]};DATABASE={app.config["DB_DATABASE"]};UID={app.config["DB_USERNAME"]};PWD={app.config["DB_PASSWORD"]}'
-    app.config['SQLALCHEMY_DATABASE_URI'] =  f'mssql+pyodbc:///?odbc_connect={urllib.parse.quote_plus(app.config["DB_ODBC_URI"])}'
+    app.config['SQLALCHEMY_DATABASE_URI'] = (app.config['DB_URI'] or 
+        f'mssql+pyodbc:///?odbc_connect={urllib.parse.quote_plus(app.config["DB_ODBC_URI"])}')
+    # Read replicas are binds, see datastores.Database
+    replica_uris = [f'mssql+pyodbc:///?odbc_connect={urllib.parse.quote_plus(odbc_uri)}' 
+        for odbc_uri in [f'DRIVER={app.config["DB_DRIVER"]};SERVER={host};PORT={app.config["DB_SERVER_PORT"]};DATABASE={app.config["DB_DATABASE"]};UID={app.config["DB_USERNAME"]};PWD={app.config["DB_PASSWORD"]};ApplicationIntent=ReadOnly'
+            for host in app.config['DB_REPLICA_HOSTS']]] + app.config['DB_REPLICA_URIS']
+    app.config['SQLALCHEMY_BINDS'] = dict(app.config.get('SQLALCHEMY_BINDS') or {}, 
+        **{f'replica_{i}': uri for i, uri in enumerate(replica_uris)})
 
     # Configure logging
     logging.basicConfig(level=app.config['APP_LOG_LVL'], 
@@ -36,21 +49,64 @@ def create_config_only_app():
     return app
 
 
+def ready():
+    """Readiness probe, 503 until this process can serve requests (e.g, 
+    the database is reachable and the blob containers are verified)."""
+    checks = dict(blob_store=datastores.blob_store.ready())
+    try:
+        datastores.db.session.execute('SELECT 1')
+        checks['database'] = True
+    except Exception:
+        log.exception('Readiness check of the database failed')
+        checks['database'] = False
+    finally:
+        datastores.db.session.remove()
+    is_ready = all(checks.values())
+    return jsonify(dict(ready=is_ready, checks=checks)), 200 if is_ready else 503
+
+
 def create_app():
+    started = time.perf_counter()
     app = create_config_only_app()
     logging.getLogger('azure').setLevel(app.config['AZURE_LOG_LVL'])
     logging.getLogger('urllib3').setLevel(app.config['URLLIB_LOG_LVL'])
-    
-    datastores.db.init_app(app)
-    datastores.blob_store.init_app(app)
-    services.article_service.init_app(app)
-    services.user_service.init_app(app)
+    timings = dict(config=time.perf_counter() - started)
+
+    # Note none of these should block on the network, see /ready
+    for name, init_app in [
+            ('instrumentation', instrumentation.instrumentation.init_app),
+            ('compression', compression.compression.init_app),
+            ('limiter', limits.limiter.init_app),
+            ('db', datastores.db.init_app),
+            ('blob_store', datastores.blob_store.init_app),
+            ('blob_cache', blob_cache.blob_cache.init_app),
+            ('content_store', contents.content_store.init_app),
+            ('blob_deletion_queue', services.blob_deletion_queue.init_app),
+            ('job_runner', services.job_runner.init_app),
+            ('image_pipeline', images.image_pipeline.init_app),
+            ('search_index', search.search_index.init_app),
+            ('exporter', export.exporter.init_app),
+            ('encoder', serializers.encoder.init_app),
+            ('cache', services.cache.init_app),
+            ('article_service', services.article_service.init_app),
+            ('user_service', services.user_service.init_app)]:
+        step_started = time.perf_counter()
+        init_app(app)
+        timings[name] = time.perf_counter() - step_started
 
     app.register_blueprint(api.bp)
+    app.route('/metrics')(lambda: Response(metrics.registry.render(), 
+        mimetype='text/plain; version=0.0.4'))
+    app.route('/ready')(ready)
 
     app.errorhandler(500)(lambda e: (jsonify(dict(error="Sorry, it's not you it's us!")), 500))
     app.errorhandler(404)(lambda e: (jsonify(dict(error="Doh")), 404))
-    
+
+    timings['total'] = time.perf_counter() - started
+    for name, seconds in timings.items():
+        startup_duration.set(seconds, step=name)
+    log.info(f"Started in {timings['total'] * 1000:.1f}ms (" + ', '.join(
+        f'{name} {seconds * 1000:.1f}ms' for name, seconds in timings.items() if name != 'total') + ')')
     return app
 
     
\ No newline at end of file
@@ -0,0 +1,174 @@
+import hashlib
+import logging
+import mimetypes
+import os
+import threading
+
+from concurrent.futures import Future
+from flask import current_app, request
+from werkzeug.wsgi import wrap_file
+from backend.datastores import blob_store
+from backend.metrics import registry
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+blob_cache_lookups = registry.counter('blob_cache_lookups_total',
+    'Blob cache lookups, by result')
+blob_cache_evictions = registry.counter('blob_cache_evictions_total',
+    'Blobs evicted from the blob cache')
+
+
+class BlobCache:
+    """Size bounded (BLOB_CACHE_MAX_BYTES) cache of blobs on local disk,
+    shared by all processes using BLOB_CACHE_DIR. Blobs are never modified
+    (each upload gets a new filename), so cached copies never go stale.
+
+    Fetches are single flight: concurrent misses on a blob wait on the one
+    download, within a process, and across processes with file locks
+    (where fcntl is available). Least recently used blobs are evicted once
+    the cache is over its size, by modification time, which hits refresh.
+    """
+    # Cross process locks are striped, so there's a bounded number of files
+    LOCK_STRIPES = 64
+
+    def __init__(self):
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._size = None
+
+    def init_app(self, app):
+        self.directory = app.config['BLOB_CACHE_DIR']
+        self.max_bytes = app.config['BLOB_CACHE_MAX_BYTES']
+        self.max_age = app.config['BLOB_CACHE_MAX_AGE']
+        self._blobs_dir = os.path.join(self.directory, 'blobs')
+        self._locks_dir = os.path.join(self.directory, 'locks')
+        # Measured on first use, since it means scanning the directory
+        self._size = None
+
+    def _path(self, container_name, blob_filename):
+        digest = hashlib.sha1(f'{container_name}/{blob_filename}'.encode()).hexdigest()
+        return os.path.join(self._blobs_dir, digest)
+
+    def get(self, container_name, blob_filename):
+        """Returns the path of the cached copy of the given blob, downloading
+        it on a miss. Raises FileNotFoundError if there's no such blob."""
+        path = self._path(container_name, blob_filename)
+        try:
+            os.utime(path)
+            blob_cache_lookups.inc(result='hit')
+            return path
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            future = self._inflight.get(path)
+            leader = future is None
+            if leader:
+                future = self._inflight[path] = Future()
+        if not leader:
+            blob_cache_lookups.inc(result='wait')
+            return future.result()
+        try:
+            future.set_result(self._fetch(container_name, blob_filename, path))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._inflight[path]
+        return future.result()
+
+    def _fetch(self, container_name, blob_filename, path):
+        os.makedirs(self._blobs_dir, exist_ok=True)
+        os.makedirs(self._locks_dir, exist_ok=True)
+        stripe = int(os.path.basename(path), 16) % self.LOCK_STRIPES
+        with open(os.path.join(self._locks_dir, str(stripe)), 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another process may have fetched it meanwhile
+            if os.path.exists(path):
+                blob_cache_lookups.inc(result='hit')
+                return path
+            blob_cache_lookups.inc(result='miss')
+            partial = f'{path}.{os.getpid()}.{threading.get_ident()}.partial'
+            try:
+                with open(partial, 'wb') as f:
+                    blob_store.download_to(container_name, blob_filename, f)
+                size = os.path.getsize(partial)
+                os.replace(partial, path)
+            finally:
+                if os.path.exists(partial):
+                    os.remove(partial)
+        self._added(size)
+        return path
+
+    def _added(self, size):
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan()[1]
+            else:
+                self._size += size
+            if self._size <= self.max_bytes:
+                return
+        self.evict()
+
+    def _scan(self):
+        """Returns the cached blobs as (mtime, size, path), and their size."""
+        entries = []
+        with os.scandir(self._blobs_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.partial'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return (entries, sum(size for (_, size, _) in entries))
+
+    def evict(self):
+        """Removes the least recently used blobs, down to 90% of max_bytes
+        so there's room before the next eviction. Blobs being sent are
+        unaffected, they're only unlinked."""
+        entries, size = self._scan()
+        target = self.max_bytes * 0.9
+        for (_, blob_size, path) in sorted(entries):
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+                blob_cache_evictions.inc()
+            except FileNotFoundError:
+                pass
+            size -= blob_size
+        with self._lock:
+            self._size = size
+
+    def send(self, container_name, blob_filename):
+        """Response of the given blob from the cache, supporting Range and
+        conditional requests. Its ETag is the blob's filename, so
+        revalidations don't even need the blob to be cached. The file is
+        sent with the server's file wrapper (i.e, sendfile)."""
+        resp = current_app.response_class(mimetype=mimetypes.guess_type(blob_filename)[0]
+            or 'application/octet-stream')
+        resp.set_etag(blob_filename)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = self.max_age
+        if request.if_none_match.contains(blob_filename):
+            return resp.make_conditional(request)
+        try:
+            file = open(self.get(container_name, blob_filename), 'rb')
+        except FileNotFoundError:
+            # Evicted (by any process) between the lookup and the open
+            file = open(self.get(container_name, blob_filename), 'rb')
+        resp.response = wrap_file(request.environ, file)
+        resp.direct_passthrough = True
+        size = os.fstat(file.fileno()).st_size
+        resp.content_length = size
+        return resp.make_conditional(request, accept_ranges=True, complete_length=size)
+
+
+blob_cache = BlobCache()
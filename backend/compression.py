@@ -0,0 +1,101 @@
+import zlib
+
+from flask import request
+from backend.metrics import registry
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+compressed_responses = registry.counter('http_compressed_responses_total',
+    'Responses compressed, by encoding')
+
+
+class Compression:
+    """Compresses responses with the best encoding the client accepts, among
+    br and zstd (when brotli/zstandard are installed) and gzip. Responses
+    smaller than COMPRESSION_MIN_SIZE are left alone. Streamed responses
+    (e.g, ?stream=1 lists) are compressed chunk by chunk as they're sent,
+    each chunk is flushed so clients can start decoding right away.
+    """
+    def init_app(self, app):
+        if not app.config['COMPRESSION']:
+            return
+        self.min_size = app.config['COMPRESSION_MIN_SIZE']
+        self.mimetypes = set(app.config['COMPRESSION_MIMETYPES'])
+        self.levels = dict(br=app.config['COMPRESSION_BROTLI_LEVEL'],
+            zstd=app.config['COMPRESSION_ZSTD_LEVEL'], gzip=app.config['COMPRESSION_GZIP_LEVEL'])
+        # In order of preference, when the client accepts several equally
+        self.encodings = [encoding for encoding, available in
+            [('br', brotli), ('zstd', zstandard), ('gzip', zlib)] if available]
+        app.after_request(self._after_request)
+
+    def _negotiate(self):
+        """Returns the encoding to use, or None if the client accepts none."""
+        best, best_quality = None, 0
+        for encoding in self.encodings:
+            quality = request.accept_encodings.quality(encoding)
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def _compressor(self, encoding):
+        """Returns the (compress, flush, finish) functions of a new compressor."""
+        level = self.levels[encoding]
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=level)
+            return (compressor.process, compressor.flush, compressor.finish)
+        if encoding == 'zstd':
+            compressor = zstandard.ZstdCompressor(level=level).compressobj()
+            return (compressor.compress,
+                lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK), compressor.flush)
+        # gzip, rather than a raw zlib stream (see the wbits)
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return (compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush)
+
+    def _after_request(self, resp):
+        if (resp.status_code < 200 or resp.status_code in (204, 206, 304)
+                or resp.direct_passthrough or 'Content-Encoding' in resp.headers
+                or resp.mimetype not in self.mimetypes):
+            return resp
+        resp.vary.add('Accept-Encoding')
+        if not resp.is_streamed and len(resp.get_data()) < self.min_size:
+            return resp
+        encoding = self._negotiate()
+        if encoding is None:
+            return resp
+
+        compress, flush, finish = self._compressor(encoding)
+        if resp.is_streamed:
+            resp.response = self._compress_stream(resp.response, compress, flush, finish)
+            resp.headers.pop('Content-Length', None)
+        else:
+            resp.set_data(compress(resp.get_data()) + finish())
+        resp.headers['Content-Encoding'] = encoding
+        # The compressed bytes differ, but still mean the same as the original
+        etag, weak = resp.get_etag()
+        if etag and not weak:
+            resp.set_etag(etag, weak=True)
+        compressed_responses.inc(encoding=encoding)
+        return resp
+
+    @staticmethod
+    def _compress_stream(chunks, compress, flush, finish):
+        try:
+            for chunk in chunks:
+                data = compress(chunk.encode() if isinstance(chunk, str) else chunk) + flush()
+                if data:
+                    yield data
+            yield finish()
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+
+compression = Compression()
@@ -0,0 +1,108 @@
+import io
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import func
+from werkzeug.datastructures import FileStorage
+from backend.datastores import blob_store, db
+from backend.metrics import registry
+from backend.models import Article
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+offloaded_contents = registry.counter('article_contents_offloaded_total',
+    'Article contents stored in blob storage rather than inline')
+
+
+class ContentStore:
+    """Stores article contents longer than ARTICLE_CONTENT_OFFLOAD_LENGTH
+    characters compressed in blob storage, rather than inline in the
+    articles table, so scans of it (and the buffer pool) only carry small
+    rows. Offloaded contents are loaded when a single article is read,
+    lists of articles leave contents out (see `Article.__list_fields__`).
+
+    Blobs are compressed with zstd (when zstandard is installed) or gzip,
+    and named after the codec, so either can be read back whatever the
+    current ARTICLE_CONTENT_CODEC.
+    """
+    # Contents are written once and read many times, so compress them well
+    LEVELS = dict(zstd=10, gzip=9)
+    EXTENSIONS = dict(zstd='.zst', gzip='.gz')
+
+    def init_app(self, app):
+        self.container_name = app.config['CONTAINER_ARTICLE_ASSETS']
+        self.offload_length = app.config['ARTICLE_CONTENT_OFFLOAD_LENGTH']
+        codec = app.config['ARTICLE_CONTENT_CODEC']
+        if codec == 'auto':
+            codec = 'zstd' if zstandard is not None else 'gzip'
+        if codec == 'zstd' and zstandard is None:
+            raise EnvironmentError('ARTICLE_CONTENT_CODEC=zstd requires the zstandard package')
+        self.codec = codec
+
+    def offloads(self, content):
+        """True if the given content should be stored in blob storage."""
+        return bool(self.offload_length and content and len(content) > self.offload_length)
+
+    def _compress(self, data):
+        if self.codec == 'zstd':
+            return zstandard.ZstdCompressor(level=self.LEVELS['zstd']).compress(data)
+        # gzip framing, so blobs can be read with standard tools
+        compressor = zlib.compressobj(self.LEVELS['gzip'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    @staticmethod
+    def _decompress(blob_filename, data):
+        if blob_filename.endswith('.zst'):
+            if zstandard is None:
+                raise EnvironmentError(f'Reading {blob_filename} requires the zstandard package')
+            return zstandard.ZstdDecompressor().decompress(data)
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+    def store(self, content):
+        """Uploads the compressed content, returns the name of its blob."""
+        blob_filename = blob_store.new_blob_filename(f'content{self.EXTENSIONS[self.codec]}')
+        file = FileStorage(stream=io.BytesIO(self._compress(content.encode())),
+            filename=blob_filename)
+        blob_filename = blob_store.upload(self.container_name, file, blob_filename=blob_filename)
+        offloaded_contents.inc()
+        return blob_filename
+
+    def load(self, blob_filename):
+        """The content stored in the given blob, raises FileNotFoundError if
+        there's no such blob."""
+        data = io.BytesIO()
+        blob_store.download_to(self.container_name, blob_filename, data)
+        return self._decompress(blob_filename, data.getvalue()).decode()
+
+    def offload_existing(self, batch_size=100, concurrency=8):
+        """Moves the contents of existing articles that are too long to blob
+        storage, a batch at a time, each committed on its own so it can be
+        stopped and resumed. Returns the number of articles moved."""
+        if not self.offload_length:
+            return 0
+        count, last_id = 0, 0
+        while True:
+            rows = (db.session.query(Article.id, Article.content)
+                .filter(Article.id > last_id, Article.content_blob.is_(None),
+                    func.length(Article.content) > self.offload_length)
+                .order_by(Article.id).limit(batch_size).all())
+            if not rows:
+                break
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                blobs = list(executor.map(self.store, [content for (_, content) in rows]))
+            try:
+                db.session.bulk_update_mappings(Article, [dict(id=id, content=None, content_blob=blob,
+                    content_words=Article.words_of(content)) for (id, content), blob in zip(rows, blobs)])
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                blob_store.delete_many(self.container_name, blobs)
+                raise
+            count, last_id = count + len(rows), rows[-1].id
+        return count
+
+
+content_store = ContentStore()
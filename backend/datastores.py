@@ -1,49 +1,571 @@
+import base64
+import hashlib
+import itertools
 import logging
 import os
+import sqlite3
+import tempfile
+import threading
+import time
 import uuid
+import weakref
 
-from azure.storage.blob import BlobServiceClient, PublicAccess
-from flask_sqlalchemy import SQLAlchemy
+from contextlib import contextmanager
+from functools import wraps
+from datetime import datetime, timedelta
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from flask import has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, exc, orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool, QueuePool
+from backend.metrics import registry
 
 log = logging.getLogger(__name__)
 
+pool_checkout_wait = registry.histogram('db_pool_checkout_wait_seconds', 
+    'Time spent waiting to check out a connection from the pool',
+    buckets=(.001, .005, .01, .05, .1, .5, 1, 5, 10, 30))
+pool_timeouts = registry.counter('db_pool_timeouts_total', 
+    'Checkouts that timed out waiting for a connection')
+pool_connects = registry.counter('db_pool_connects_total', 
+    'New database connections opened by the pool')
+pool_connections = registry.gauge('db_pool_connections', 
+    'Connections held by the pool, by state')
+replica_queries = registry.counter('db_replica_queries_total',
+    'Queries made within `Database.replica`, by where they ran')
+replica_fallbacks = registry.counter('db_replica_fallbacks_total',
+    'Reads retried on the primary after failing on a replica')
+deduplicated_uploads = registry.counter('blob_deduplicated_uploads_total',
+    'Uploads skipped since a blob with the same content was already there')
+blob_call_duration = registry.histogram('blob_call_duration_seconds',
+    'Time spent on blob storage calls, by operation')
+
+
+def timed(operation):
+    """Records the duration of the decorated blob storage call."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                blob_call_duration.observe(time.perf_counter() - start, operation=operation)
+        return wrapper
+    return decorator
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait on the pool, and how
+    many connections it holds (see `pool_*` metrics).
+    """
+    instances = weakref.WeakSet()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        InstrumentedQueuePool.instances.add(self)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            pool_timeouts.inc()
+            raise
+        finally:
+            pool_checkout_wait.observe(time.perf_counter() - start)
+
+    def _create_connection(self):
+        pool_connects.inc()
+        return super()._create_connection()
+
+    @classmethod
+    def connection_counts(cls):
+        pools = list(cls.instances)
+        return [
+            (dict(state='checked_out'), sum(p.checkedout() for p in pools)),
+            (dict(state='idle'), sum(p.checkedin() for p in pools)),
+            (dict(state='overflow'), sum(max(p.overflow(), 0) for p in pools))]
+
+
+pool_connections.set_function(InstrumentedQueuePool.connection_counts)
+
+
+class ReplicaRouter:
+    """Picks the read replica (the SQLALCHEMY_BINDS named replica_*) that
+    reads go to, round robin among the healthy ones, once per session (so
+    per request): replicas lag by different amounts, and reads of a request
+    that go to different ones may see writes go back and forth. Replicas that fail a 
+    read or a health check are skipped until they pass a check again, every
+    DB_REPLICA_CHECK_INTERVAL seconds, from a thread started with the 
+    process's first request.
+
+    For DB_REPLICA_STICKY_SECONDS after a write, so readers see it despite
+    replication lag, reads stay on the primary: within the process (once 
+    caches are invalidated, see `stick_to_primary`) and for the client that
+    wrote (via a cookie).
+    """
+    COOKIE = 'read_primary_until'
+
+    def __init__(self, db, app):
+        self.db = db
+        self.app = app
+        self.bind_keys = sorted(key for key in app.config.get('SQLALCHEMY_BINDS') or {}
+            if key.startswith('replica_'))
+        self.check_interval = app.config['DB_REPLICA_CHECK_INTERVAL']
+        self.sticky_seconds = app.config['DB_REPLICA_STICKY_SECONDS']
+        self.unhealthy = set()
+        self._primary_until = 0
+        self._next = itertools.count()
+
+    def pick(self, current=None):
+        """Returns the (bind key, engine) of a healthy replica, or (None, None).
+        That's the current one while it's healthy, otherwise the next one."""
+        keys = [key for key in self.bind_keys if key not in self.unhealthy]
+        if not keys:
+            return (None, None)
+        key = current if current in keys else keys[next(self._next) % len(keys)]
+        return (key, self.db.get_engine(self.app, bind=key))
+
+    def mark_unhealthy(self, key):
+        if key not in self.unhealthy:
+            log.warning(f'Read replica {key} is unhealthy, reading from the primary')
+        self.unhealthy.add(key)
+
+    def check(self):
+        """Runs a query on each replica, updating which ones are healthy."""
+        for key in self.bind_keys:
+            try:
+                with self.db.get_engine(self.app, bind=key).connect() as conn:
+                    conn.execute('SELECT 1')
+            except Exception:
+                self.mark_unhealthy(key)
+                continue
+            if key in self.unhealthy:
+                log.info(f'Read replica {key} is healthy again')
+                self.unhealthy.discard(key)
+
+    def _run(self):
+        while True:
+            time.sleep(self.check_interval)
+            self.check()
+
+    def stick_to_primary(self):
+        self._primary_until = time.monotonic() + self.sticky_seconds
+
+    def primary_only(self):
+        """True while reads should stay on the primary, see above."""
+        if time.monotonic() < self._primary_until:
+            return True
+        if not has_request_context():
+            return False
+        try:
+            return float(request.cookies.get(self.COOKIE, 0)) > time.time()
+        except ValueError:
+            return False
+
+    def _after_request(self, resp):
+        # Only look at a session the request actually used
+        if self.db.session.registry.has() and self.db.session.info.get('wrote'):
+            resp.set_cookie(self.COOKIE, str(int(time.time() + self.sticky_seconds) + 1),
+                max_age=self.sticky_seconds + 1, httponly=True)
+        return resp
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends the queries made within `Database.replica` to a 
+    read replica, the same one for the whole session, unless it's flushing
+    or already wrote (see `_mark_wrote`), or the `ReplicaRouter` says reads
+    should stay on the primary.
+    """
+    def get_bind(self, mapper=None, clause=None):
+        if self.info.get('replica'):
+            router = get_state(self.app).db.router
+            if (router is not None and not self._flushing and not self.info.get('wrote')
+                    and not router.primary_only()):
+                key, engine = router.pick(self.info.get('replica_bind'))
+                if engine is not None:
+                    self.info['replica_bind'] = key
+                    self.info['replica_read'] = True
+                    replica_queries.inc(target='replica')
+                    return engine
+            replica_queries.inc(target='primary')
+        return super().get_bind(mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+@event.listens_for(RoutingSession, 'after_bulk_update')
+@event.listens_for(RoutingSession, 'after_bulk_delete')
+@event.listens_for(RoutingSession, 'after_commit')
+def _mark_wrote(session, *args):
+    # The rest of the request reads its own writes from the primary
+    session.info['wrote'] = True
+
+
+class Database(SQLAlchemy):
+    """Applies the connection pool and pyodbc settings from `Config` to SQL
+    Server engines (read replicas included). Note, anything in 
+    SQLALCHEMY_ENGINE_OPTIONS still takes priority.
+
+    Reads made within `replica` (or through `read`) go to a read replica
+    when any are configured, see `ReplicaRouter`.
+    """
+    router = None
+
+    def init_app(self, app):
+        super().init_app(app)
+        self.router = ReplicaRouter(self, app)
+        if self.router.bind_keys:
+            app.before_first_request(lambda: threading.Thread(target=self.router._run,
+                name='db-replicas', daemon=True).start())
+            app.after_request(self.router._after_request)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    @contextmanager
+    def replica(self):
+        """Within this block, the current session's reads may go to a 
+        read replica, see `RoutingSession`."""
+        session = self.session()
+        session.info['replica'] = session.info.get('replica', 0) + 1
+        try:
+            yield session
+        finally:
+            session.info['replica'] -= 1
+
+    def read(self, f, *args, **kwargs):
+        """Calls f within `replica`. If it fails to reach the replica, the 
+        replica is marked unhealthy and f is retried on the primary."""
+        session = self.session()
+        session.info.pop('replica_read', None)
+        try:
+            with self.replica():
+                return f(*args, **kwargs)
+        except exc.DBAPIError as e:
+            if not session.info.pop('replica_read', None) or not (
+                    isinstance(e, exc.OperationalError) or e.connection_invalidated):
+                raise
+            key = session.info.pop('replica_bind')
+            log.exception(f'Read from replica {key} failed, retrying on the primary')
+            self.router.mark_unhealthy(key)
+            replica_fallbacks.inc()
+            session.rollback()
+            return f(*args, **kwargs)
+
+    def stick_to_primary(self):
+        """Keeps this process's reads on the primary for a while, e.g so 
+        caches aren't refilled from a replica that's behind."""
+        if self.router is not None:
+            self.router.stick_to_primary()
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        if sa_url.drivername.startswith('mssql'):
+            options.update(
+                poolclass=InstrumentedQueuePool,
+                pool_size=app.config['DB_POOL_SIZE'],
+                max_overflow=app.config['DB_POOL_MAX_OVERFLOW'],
+                pool_timeout=app.config['DB_POOL_TIMEOUT'],
+                pool_recycle=app.config['DB_POOL_RECYCLE'],
+                pool_pre_ping=app.config['DB_POOL_PRE_PING'])
+        # pyodbc is the default driver of mssql URLs, and the only one with these
+        if sa_url.drivername in ('mssql', 'mssql+pyodbc'):
+            options.update(fast_executemany=app.config['DB_FAST_EXECUTEMANY'])
+            import pyodbc
+            # Has to be set before the first connection is made
+            pyodbc.pooling = app.config['DB_ODBC_POOLING']
+        super().apply_driver_hacks(app, sa_url, options)
+
+
+@event.listens_for(Pool, 'connect')
+def _record_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    # Connections inherited from the parent of a forked process belong to 
+    # it, drop them without closing them and have the pool connect anew
+    if connection_record.info['pid'] != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError('Connection belongs to the parent process')
+
+
+@event.listens_for(Engine, 'connect')
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite only enforces foreign keys (and their ON DELETE) when asked to,
+    # e.g the cascade from users to articles
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.execute('PRAGMA foreign_keys=ON')
+
+
+def content_address(file, spool_size):
+    """Spools the given file (on disk past spool_size bytes) while hashing
+    it. Returns the spooled copy and a filename derived from its content 
+    and extension, for content addressed blobs (see `BlobStore`)."""
+    from werkzeug.datastructures import FileStorage
+    _, ext = os.path.splitext(file.filename)
+    # The extension is part of the digest, so each digest is one blob
+    digest = hashlib.sha256(ext.lower().encode() + b'\0')
+    spooled = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    with file.stream as data:
+        for chunk in iter(lambda: data.read(1024 * 1024), b''):
+            digest.update(chunk)
+            spooled.write(chunk)
+    spooled.seek(0)
+    # 128 bits, so filenames fit in `Article.image_filename`
+    return (FileStorage(stream=spooled, filename=file.filename), 
+        f'{digest.hexdigest()[:32]}{ext.lower()}')
+
+
 class BlobStore:
     """Provides a simple interface to Azure's Blob Storage service and
     it operations on containers and blobs.
+
+    Nothing talks to Azure during `init_app`: the client (and the Azure SDK, 
+    a large share of import time) is loaded on first use, and containers are
+    verified per BLOB_STORE_VERIFY_CONTAINERS, by default once per process 
+    in the background, from its first request. Until then `ready` is False.
+
+    With BLOB_CONTENT_ADDRESSED, blobs are named after their content (see
+    `content_address`), and uploads of content that's already there are 
+    skipped. Blobs are then shared, see `models.BlobRef`.
     """
+    # Azure limits batch requests to 256 sub-requests
+    MAX_BATCH_SIZE = 256
+    # Seconds between attempts at verifying containers, doubled up to a minute
+    VERIFY_RETRY_INTERVAL = 1
+
+    def __init__(self):
+        self._client = None
+        self._client_lock = threading.Lock()
+        self.containers_ready = False
+        self.content_addressed = False
+
     def init_app(self, app):
-        self.client = BlobServiceClient(
-            account_url=app.config['BLOB_STORE_URI'], 
-            credential=app.config['BLOB_STORE_CREDENTIAL'])
-        self._init_containers(app)
+        self.account_url = app.config['BLOB_STORE_URI']
+        self.credential = app.config['BLOB_STORE_CREDENTIAL']
+        self.container_names = app.config['BLOB_STORE_CONTAINERS']
+        self.content_addressed = app.config['BLOB_CONTENT_ADDRESSED']
+        self._client = None
+        self._init_uploads(app)
+        verify = app.config['BLOB_STORE_VERIFY_CONTAINERS']
+        if verify == 'startup':
+            self.init_containers()
+        elif verify == 'background':
+            # Not before, so a preloading server's master never does it
+            app.before_first_request(lambda: threading.Thread(target=self._verify_containers,
+                name='blob-containers', daemon=True).start())
+        else:
+            # Provisioned beforehand, see `manage.py provision`
+            self.containers_ready = True
+
+    @property
+    def client(self):
+        """The `BlobServiceClient`, built on first use."""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    from azure.storage.blob import BlobServiceClient
+                    self._client = BlobServiceClient(account_url=self.account_url, 
+                        credential=self.credential)
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    def ready(self):
+        """True once the containers this application needs are known to exist."""
+        return self.containers_ready
+
+    def _init_uploads(self, app):
+        """Configures the block size and concurrency of uploads, note the
+        pool is shared by all uploads so it bounds the total number of 
+        blocks in flight for this process.
+        """
+        self.block_size = app.config['BLOB_UPLOAD_BLOCK_SIZE']
+        self.max_concurrency = app.config['BLOB_UPLOAD_MAX_CONCURRENCY']
+        self.executor = ThreadPoolExecutor(
+            max_workers=app.config['BLOB_UPLOAD_POOL_SIZE'],
+            thread_name_prefix='blob-upload')
+        # Whole uploads run on their own pool, since they wait on blocks 
+        # staged in the one above
+        self.background_executor = ThreadPoolExecutor(
+            max_workers=app.config['BLOB_UPLOAD_POOL_SIZE'],
+            thread_name_prefix='blob-background-upload')
 
-    def _init_containers(self, app):
+    @timed('init_containers')
+    def init_containers(self):
         """Creates any missing containers needed by this application.
         """
-        log.info(f"Initializing blob containers for {app.config['BLOB_STORE_URI']}")
+        from azure.storage.blob import PublicAccess
+        log.info(f"Initializing blob containers for {self.account_url}")
         containers_names = [c['name'] for c in self.client.list_containers(include_metadata=True)]
-        for name in app.config['BLOB_STORE_CONTAINERS']:
+        for name in self.container_names:
             if name not in containers_names:
                 log.info(f"Creating container: {name}")
-                self.client.create_container(name, public_access=PublicAccess.Container)        
+                self.client.create_container(name, public_access=PublicAccess.Container)
+        self.containers_ready = True
+
+    def _verify_containers(self):
+        """Keeps trying `init_containers` until it succeeds, so an 
+        unreachable storage account delays readiness rather than startup."""
+        interval = self.VERIFY_RETRY_INTERVAL
+        while True:
+            try:
+                return self.init_containers()
+            except Exception:
+                log.exception(f'Failed to verify blob containers, retrying in {interval}s')
+            time.sleep(interval)
+            interval = min(interval * 2, 60)
+
+    @staticmethod
+    def new_blob_filename(filename):
+        """Generates a unique blob filename, keeping the extension of filename."""
+        _, ext = os.path.splitext(filename)
+        return f"{str(uuid.uuid4())}{ext}"
+
+    def name(self, file):
+        """Returns the file to upload and the blob filename it will have, its
+        content address with BLOB_CONTENT_ADDRESSED, otherwise a new name."""
+        if self.content_addressed:
+            return content_address(file, self.block_size)
+        return (file, self.new_blob_filename(file.filename))
+
+    def upload_async(self, container_name, file, blob_filename=None):
+        """Starts uploading the given file (named by `name`, unless it's 
+        given with its blob_filename) in the background, so callers can do 
+        other work meanwhile. Returns the blob filename it will have and a
+        future of the upload."""
+        if blob_filename is None:
+            file, blob_filename = self.name(file)
+        future = self.background_executor.submit(self.upload, container_name, file, 
+            blob_filename=blob_filename)
+        return (blob_filename, future)
 
-    def upload(self, container_name, file, existing_blob=None):
+    @timed('upload')
+    def upload(self, container_name, file, existing_blob=None, blob_filename=None):
         """Uploads the given to the specified container."""
-        _, ext = os.path.splitext(file.filename)
-        blob_filename = f"{str(uuid.uuid4())}{ext}"
+        if self.content_addressed:
+            if blob_filename is None:
+                file, blob_filename = content_address(file, self.block_size)
+            # Callers must hold a committed reference (see `models.BlobRef`),
+            # or the blob could be deleted before theirs is
+            if self.exists(container_name, blob_filename):
+                deduplicated_uploads.inc()
+                file.close()
+                return blob_filename
+        blob_filename = blob_filename or self.new_blob_filename(file.filename)
         blob_client = self.client.get_blob_client(container=container_name, blob=blob_filename)
         with file.stream as data:
-            blob_client.upload_blob(data)
+            self._upload_blocks(blob_client, data)
         return blob_filename
 
+    def _upload_blocks(self, blob_client, data):
+        """Uploads anything that fits in a single block with one request, 
+        otherwise splits data into blocks, stages up to `max_concurrency` of 
+        them at a time, then commits the block list. 
+        
+        If staging fails nothing is committed, and Azure discards the 
+        uncommitted blocks on its own.
+        """
+        block = data.read(self.block_size)
+        next_block = data.read(self.block_size) if len(block) == self.block_size else b''
+        if not next_block:
+            blob_client.upload_blob(block)
+            return
+
+        from azure.storage.blob import BlobBlock
+
+        block_ids, pending = [], set()
+        while block:
+            # Block ids must all be the same length within a blob
+            block_id = base64.b64encode(f'{len(block_ids):08d}'.encode()).decode()
+            block_ids.append(block_id)
+            if len(pending) >= self.max_concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(self.executor.submit(blob_client.stage_block, block_id, block))
+            block, next_block = next_block, data.read(self.block_size) if next_block else b''
+        for future in wait(pending).done:
+            future.result()
+        blob_client.commit_block_list([BlobBlock(block_id) for block_id in block_ids])
+
+    def generate_upload_url(self, container_name, blob_filename, expires_in):
+        """Returns a URL that lets whoever holds it create (but not read) the
+        given blob, for the next `expires_in` seconds. Clients PUT the file 
+        to it, with an `x-ms-blob-type: BlockBlob` header."""
+        from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+        now = datetime.utcnow()
+        sas = generate_blob_sas(
+            account_name=self.client.account_name,
+            container_name=container_name,
+            blob_name=blob_filename,
+            account_key=self.credential,
+            permission=BlobSasPermissions(create=True, write=True, tag=False),
+            # Allow for clock skew between us and Azure
+            start=now - timedelta(minutes=5),
+            expiry=now + timedelta(seconds=expires_in))
+        blob_client = self.client.get_blob_client(container=container_name, blob=blob_filename)
+        return f'{blob_client.url}?{sas}'
+
+    @timed('download')
+    def download(self, container_name, blob_filename):
+        """Returns the content of the given blob."""
+        blob_client = self.client.get_blob_client(container=container_name, blob=blob_filename)
+        return blob_client.download_blob(max_concurrency=self.max_concurrency).readall()
+
+    @timed('download')
+    def download_to(self, container_name, blob_filename, file):
+        """Writes the content of the given blob to file, as it's received.
+        Raises FileNotFoundError if there's no such blob."""
+        from azure.core.exceptions import ResourceNotFoundError
+        blob_client = self.client.get_blob_client(container=container_name, blob=blob_filename)
+        try:
+            blob_client.download_blob(max_concurrency=self.max_concurrency).readinto(file)
+        except ResourceNotFoundError:
+            raise FileNotFoundError(f'No blob {blob_filename} in {container_name}')
+
+    @timed('exists')
+    def exists(self, container_name, blob_filename):
+        """True if a blob with the given filename is in the specified container."""
+        from azure.core.exceptions import ResourceNotFoundError
+        blob_client = self.client.get_blob_client(container=container_name, blob=blob_filename)
+        try:
+            blob_client.get_blob_properties()
+            return True
+        except ResourceNotFoundError:
+            return False
+
+    @timed('delete')
     def delete(self, container_name, blob_filename):
         """Deletes a blob wit the given filename in the specified container.
         """
         blob_client = self.client.get_blob_client(container=container_name, blob=blob_filename)
         blob_client.delete_blob(delete_snapshots="include")
 
+    @timed('delete_many')
+    def delete_many(self, container_name, blob_filenames):
+        """Deletes the given blobs in the specified container using batch 
+        requests, returns the filenames that could not be deleted. Blobs that
+        are already gone count as deleted.
+        """
+        container_client = self.client.get_container_client(container_name)
+        failed = set()
+        for i in range(0, len(blob_filenames), self.MAX_BATCH_SIZE):
+            batch = blob_filenames[i:i + self.MAX_BATCH_SIZE]
+            responses = container_client.delete_blobs(*batch, 
+                delete_snapshots="include", raise_on_any_failure=False)
+            for blob_filename, resp in zip(batch, responses):
+                if resp.status_code not in (202, 404):
+                    failed.add(blob_filename)
+        return failed
+
 
-db = SQLAlchemy()
+db = Database()
 blob_store = BlobStore()
 
 
@@ -0,0 +1,237 @@
+import csv
+import io
+import itertools
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from sqlalchemy import Boolean, Date, DateTime, Float, Integer, func
+from backend.contents import content_store
+from backend.datastores import db
+from backend.metrics import registry
+from backend.models import Article, User
+from backend.serializers import encoder
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+exported_rows = registry.counter('export_rows_total', 'Rows exported, by table and format')
+
+
+def _iso(value):
+    return value.isoformat()
+
+
+def _converters(columns):
+    """Per column converters of values to text, dates as ISO 8601."""
+    return [_iso if isinstance(c.type, (DateTime, Date)) else None for c in columns]
+
+
+def _convert(values, convert):
+    if convert is None:
+        return values
+    return [None if value is None else convert(value) for value in values]
+
+
+class NdjsonFormat:
+    """One JSON object per row, per line."""
+    mimetype = 'application/x-ndjson'
+
+    def __init__(self, columns):
+        self.names = [c.name for c in columns]
+        self.converters = _converters(columns)
+
+    def begin(self):
+        return b''
+
+    def batch(self, columns):
+        columns = [_convert(values, convert) for values, convert in zip(columns, self.converters)]
+        return b''.join(encoder.dumps(dict(zip(self.names, row))) + b'\n' for row in zip(*columns))
+
+    def end(self):
+        return b''
+
+
+class CsvFormat(NdjsonFormat):
+    """A header line of column names, then one line per row, NULLs as
+    empty values."""
+    mimetype = 'text/csv'
+
+    def _lines(self, rows):
+        out = io.StringIO()
+        csv.writer(out).writerows(rows)
+        return out.getvalue().encode()
+
+    def begin(self):
+        return self._lines([self.names])
+
+    def batch(self, columns):
+        return self._lines(zip(*[_convert(values, convert)
+            for values, convert in zip(columns, self.converters)]))
+
+
+class _Sink(io.RawIOBase):
+    """Write only file that keeps what's written until it's drained, while
+    its position keeps counting (Parquet footers refer to offsets)."""
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data, self._chunks = b''.join(self._chunks), []
+        return data
+
+
+class ParquetFormat:
+    """Parquet with a row group per batch, requires the pyarrow package."""
+    mimetype = 'application/vnd.apache.parquet'
+
+    def __init__(self, columns):
+        if pyarrow is None:
+            raise ValueError('Parquet exports require the pyarrow package')
+        self.schema = pyarrow.schema([(c.name, self._type(c)) for c in columns])
+        self._sink = _Sink()
+        self._writer = None
+
+    @staticmethod
+    def _type(column):
+        for sql_type, arrow_type in [(Boolean, pyarrow.bool_()), (Integer, pyarrow.int64()),
+                (Float, pyarrow.float64()), (DateTime, pyarrow.timestamp('us')),
+                (Date, pyarrow.date32())]:
+            if isinstance(column.type, sql_type):
+                return arrow_type
+        return pyarrow.string()
+
+    def begin(self):
+        self._writer = pyarrow.parquet.ParquetWriter(self._sink, self.schema, compression='snappy')
+        return self._sink.drain()
+
+    def batch(self, columns):
+        self._writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(values, type=field.type)
+            for values, field in zip(columns, self.schema)], schema=self.schema))
+        return self._sink.drain()
+
+    def end(self):
+        self._writer.close()
+        return self._sink.drain()
+
+
+class Exporter:
+    """Streams whole tables out for analytics, in constant memory: rows are
+    read from a server side cursor (on a read replica, when there's one)
+    a batch at a time, each encoded column by column. Rows are exported 
+    as the API shows them: internal (`__hidden__`) columns are left out, 
+    and offloaded contents (see `contents.ContentStore`) are loaded back.
+
+    Exports can be incremental: each returns its watermark, the latest
+    value of the table's `__watermark__` column it covers, and exports
+    since that watermark only have the rows added after it. Rows added in
+    the last EXPORT_WATERMARK_LAG seconds (by created_at) are left for the
+    next export: a row still being committed may have an earlier 
+    watermark than those after it, and would be skipped for good.
+    """
+    TABLES = dict(users=User, articles=Article)
+    # Offloaded contents loaded at a time
+    LOAD_CONCURRENCY = 8
+    FORMATS = dict(ndjson=NdjsonFormat, csv=CsvFormat, parquet=ParquetFormat)
+
+    def __init__(self):
+        self.batch_size = 10000
+        self.watermark_lag = 60
+
+    def init_app(self, app):
+        self.batch_size = app.config['EXPORT_BATCH_SIZE']
+        self.watermark_lag = app.config['EXPORT_WATERMARK_LAG']
+
+    def model(self, table):
+        """The model of an exportable table, raises LookupError if there's none."""
+        if table not in self.TABLES:
+            raise LookupError(f'Unknown table: {table}, expected one of {list(self.TABLES)}')
+        return self.TABLES[table]
+
+    @staticmethod
+    def parse_watermark(model, value):
+        """Parses a watermark from a previous export of the model's table,
+        raises ValueError if it's not valid."""
+        column = getattr(model, model.__watermark__)
+        if column.type.python_type is datetime:
+            return datetime.fromisoformat(value)
+        return column.type.python_type(value)
+
+    @staticmethod
+    def format_watermark(value):
+        return value.isoformat() if isinstance(value, (date, datetime)) else str(value)
+
+    def export(self, table, format='ndjson', since=None):
+        """Returns the watermark (as text) and the chunks (bytes, lazily
+        read and encoded) of an export of the table in the given format,
+        of the rows added since the given watermark, all of them without.
+        Raises LookupError for unknown tables, ValueError for invalid
+        formats or watermarks.
+
+        The watermark is read up front, so rows added during the export
+        are left for the next one, as are those added in the last 
+        EXPORT_WATERMARK_LAG seconds (see `Exporter`), even without since."""
+        model = self.model(table)
+        if format not in self.FORMATS:
+            raise ValueError(f'Invalid format: {format}, expected one of {list(self.FORMATS)}')
+        columns = [c for c in model.__table__.columns if c.name not in model.__hidden__]
+        encoding = self.FORMATS[format](columns)
+        column = getattr(model, model.__watermark__)
+        # All columns, lists (and so `_rows_query` by default) leave some out
+        query = model._rows_query(fields=[c.name for c in model.__table__.columns])
+        if since:
+            try:
+                since = self.parse_watermark(model, since)
+            except (TypeError, ValueError):
+                raise ValueError(f'Invalid watermark: {since}')
+            query = query.filter(column > since)
+        settled = model.created_at <= datetime.utcnow() - timedelta(seconds=self.watermark_lag)
+        until = db.read(lambda: query.filter(settled).with_entities(func.max(column))
+            .order_by(None).scalar())
+        if until is None:
+            # Nothing new, the next export starts from the same watermark
+            watermark = self.format_watermark(since) if since else None
+            return (watermark, self._chunks(table, format, encoding, columns, []))
+        rows = db.read(iter, query.filter(column <= until).yield_per(self.batch_size))
+        return (self.format_watermark(until), self._chunks(table, format, encoding, columns, rows))
+
+    def _exported(self, columns, batch):
+        """The values of the given columns of the batch's rows, with their
+        offloaded contents loaded (concurrently) in place of their blobs."""
+        rows = [row._asdict() for row in batch]
+        blobs = [row['content_blob'] for row in rows if row.get('content_blob')]
+        if blobs:
+            with ThreadPoolExecutor(max_workers=self.LOAD_CONCURRENCY) as executor:
+                contents = dict(zip(blobs, executor.map(content_store.load, blobs)))
+            for row in rows:
+                if row.get('content_blob'):
+                    row['content'] = contents[row['content_blob']]
+        return [[row[c.name] for row in rows] for c in columns]
+
+    def _chunks(self, table, format, encoding, columns, rows):
+        yield encoding.begin()
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                break
+            yield encoding.batch(self._exported(columns, batch))
+            exported_rows.inc(len(batch), table=table, format=format)
+        yield encoding.end()
+
+
+exporter = Exporter()
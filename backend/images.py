@@ -0,0 +1,126 @@
+import io
+import logging
+import threading
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from werkzeug.datastructures import FileStorage
+from backend.datastores import blob_store
+from backend.metrics import registry
+from backend.models import Article
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+log = logging.getLogger(__name__)
+
+image_variants_rendered = registry.counter('image_variants_rendered_total',
+    'Image variants rendered by the image pipeline')
+image_pipeline_failures = registry.counter('image_pipeline_failures_total',
+    'Images the image pipeline failed to process')
+
+
+def supported_formats(formats):
+    """The given formats (e.g, webp, avif) that Pillow can save."""
+    if Image is None:
+        return []
+    Image.init()
+    return [fmt for fmt in formats if fmt.upper() in Image.SAVE]
+
+
+def render_variants(data, sizes, formats, quality):
+    """Renders the image in data at each size (longest side, never upscaled)
+    in each format. Returns {variant: bytes}, where variant is `{size}.{format}`.
+
+    Runs in the pipeline's worker processes, so it must stay a picklable
+    top level function.
+    """
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    variants = {}
+    for size in sizes:
+        resized = image.copy()
+        resized.thumbnail((size, size))
+        for fmt in formats:
+            output = io.BytesIO()
+            resized.save(output, format=fmt.upper(), quality=quality)
+            variants[f'{size}.{fmt}'] = output.getvalue()
+    return variants
+
+
+class ImagePipeline:
+    """Generates resized, compressed variants of uploaded images off the
+    request path. Each image is downloaded, rendered by a pool of worker
+    processes (resizing and encoding are CPU bound) and its variants are
+    uploaded next to it, see `models.Article.variant_filename`.
+
+    Disabled when Pillow is not installed, or IMAGE_PIPELINE is not set.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._processes = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.sizes = app.config['IMAGE_VARIANT_SIZES']
+        self.quality = app.config['IMAGE_VARIANT_QUALITY']
+        self.workers = app.config['IMAGE_PROCESS_WORKERS']
+        self.enabled = bool(app.config['IMAGE_PIPELINE'] and Image is not None and self.sizes)
+        if app.config['IMAGE_PIPELINE'] and Image is None:
+            log.warning('Image pipeline disabled, Pillow is not installed')
+        # Checked on first use, loading Pillow's plugins slows down startup
+        self._formats = app.config['IMAGE_VARIANT_FORMATS']
+        self.formats = None
+        # Downloads and uploads wait on I/O, they run on threads that hand
+        # the rendering to the process pool
+        self.executor = ThreadPoolExecutor(max_workers=self.workers,
+            thread_name_prefix='image-pipeline')
+
+    def _process_pool(self):
+        # Created on first use, so processes that never see an image (e.g,
+        # manage.py commands) don't start any workers
+        with self._lock:
+            if self._processes is None:
+                self._processes = ProcessPoolExecutor(max_workers=self.workers)
+            return self._processes
+
+    def submit(self, container_name, image_filename, on_done):
+        """Starts generating the variants of the given image in the
+        background. Once they are uploaded, `on_done(image_filename, variants)`
+        is called within an app context. Returns a future, or None when
+        the pipeline is disabled.
+        """
+        if not (self.enabled and image_filename):
+            return None
+        return self.executor.submit(self._process, container_name, image_filename, on_done)
+
+    def _process(self, container_name, image_filename, on_done):
+        if self.formats is None:
+            self.formats = supported_formats(self._formats)
+            if not self.formats:
+                log.warning(f'Image pipeline disabled, Pillow supports none of {self._formats}')
+        if not self.formats:
+            return []
+        try:
+            data = blob_store.download(container_name, image_filename)
+            variants = self._process_pool().submit(render_variants, data,
+                self.sizes, self.formats, self.quality).result()
+            for variant, content in variants.items():
+                blob_store.upload(container_name,
+                    FileStorage(stream=io.BytesIO(content), filename=variant),
+                    blob_filename=Article.variant_filename(image_filename, variant))
+            image_variants_rendered.inc(len(variants))
+            with self.app.app_context():
+                on_done(image_filename, list(variants))
+            return list(variants)
+        except Exception:
+            image_pipeline_failures.inc()
+            log.exception(f'Failed to generate the variants of {image_filename}')
+            raise
+
+
+image_pipeline = ImagePipeline()
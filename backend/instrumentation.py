@@ -0,0 +1,110 @@
+import cProfile
+import logging
+import os
+import random
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from backend.metrics import registry
+
+log = logging.getLogger(__name__)
+
+request_duration = registry.histogram('http_request_duration_seconds',
+    'Time spent handling requests, by endpoint')
+request_queries = registry.histogram('db_queries_per_request',
+    'Number of SQL queries made by each request, by endpoint',
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100))
+request_query_duration = registry.histogram('db_query_seconds_per_request',
+    'Time spent on SQL queries by each request, by endpoint')
+request_profiles = registry.counter('http_request_profiles_total',
+    'Profiles dumped for requests slower than PROFILE_THRESHOLD_MS')
+
+
+class Instrumentation:
+    """Opt-in (INSTRUMENTATION) per request metrics: latency, SQL query count
+    and time by endpoint, plus profiles of a sample of requests, kept when a
+    request is slower than PROFILE_THRESHOLD_MS. When disabled nothing is
+    hooked up, so there's no overhead. Note streamed bodies are not timed.
+    """
+    _listening = False
+
+    def init_app(self, app):
+        if not app.config['INSTRUMENTATION']:
+            return
+        self.sample_rate = app.config['PROFILE_SAMPLE_RATE']
+        self.threshold = app.config['PROFILE_THRESHOLD_MS'] / 1000
+        self.profile_dir = app.config['PROFILE_DIR']
+        self.profiler = app.config['PROFILER']
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        # Unlike after_request, also runs when the view raised
+        app.teardown_request(self._teardown_request)
+        # Engines are created lazily, so listen on all of them
+        if not Instrumentation._listening:
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+            Instrumentation._listening = True
+
+    def _before_request(self):
+        g._queries, g._query_time = 0, 0.0
+        g._profiler = self._start_profiler() if random.random() < self.sample_rate else None
+        g._request_start = time.perf_counter()
+
+    def _after_request(self, resp):
+        elapsed = time.perf_counter() - g._request_start
+        endpoint = request.endpoint or 'none'
+        request_duration.observe(elapsed, endpoint=endpoint, method=request.method,
+            status=resp.status_code)
+        request_queries.observe(g._queries, endpoint=endpoint)
+        request_query_duration.observe(g._query_time, endpoint=endpoint)
+        return resp
+
+    def _teardown_request(self, exc):
+        profiler = g.pop('_profiler', None)
+        if profiler is not None:
+            self._stop_profiler(profiler, request.endpoint or 'none',
+                time.perf_counter() - g._request_start)
+
+    def _start_profiler(self):
+        if self.profiler == 'pyinstrument':
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        return profiler
+
+    def _stop_profiler(self, profiler, endpoint, elapsed):
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+        else:
+            profiler.stop()
+        if elapsed < self.threshold:
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        filename = os.path.join(self.profile_dir,
+            f'{time.strftime("%Y%m%d-%H%M%S")}-{endpoint}-{int(elapsed * 1000)}ms')
+        if isinstance(profiler, cProfile.Profile):
+            profiler.dump_stats(f'{filename}.prof')
+        else:
+            with open(f'{filename}.html', 'w') as f:
+                f.write(profiler.output_html())
+        request_profiles.inc(endpoint=endpoint)
+        log.info(f'Slow request to {endpoint} ({elapsed:.3f}s) profiled in {filename}')
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['_query_start'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop('_query_start', None)
+    if start is not None and has_request_context() and '_queries' in g:
+        g._queries += 1
+        g._query_time += time.perf_counter() - start
+
+
+instrumentation = Instrumentation()
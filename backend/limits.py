@@ -0,0 +1,168 @@
+import math
+import threading
+import time
+
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, jsonify, request
+from backend.metrics import registry
+
+rejected_requests = registry.counter('http_requests_rejected_total',
+    'Requests rejected by admission control, by reason and endpoint class')
+
+
+class MemoryBuckets:
+    """In process token buckets, keeping the `max_keys` most recently used.
+    Note each process has its own, so clients get as many tokens per process."""
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Takes a token from key's bucket, which holds up to burst tokens
+        and gains rate per second. Returns 0 if there was one, otherwise the
+        seconds until there is."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class RedisBuckets:
+    """Token buckets shared by all processes, requires the `redis` package.
+    Each take is a single script call, timed by the Redis server's clock."""
+    SCRIPT = """
+        local now = redis.call('TIME')
+        now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+        local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+        local tokens = tonumber(bucket[1]) or burst
+        local updated_at = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+        local wait = 0
+        if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return tostring(wait)
+    """
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise EnvironmentError('RATE_LIMIT_BACKEND=redis requires the redis package')
+        self._take = redis.Redis.from_url(url).register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst):
+        return float(self._take(keys=[f'rate-limit:{key}'], args=[rate, burst]))
+
+
+class Limiter:
+    """Admission control for API routes, by endpoint class (e.g, list or
+    upload, see `api.route`):
+
+    - Rate limits, token buckets per client and endpoint class (RATE_LIMITS),
+      answer 429 once a client runs out of tokens.
+    - Concurrency limits, per process and endpoint class (CONCURRENCY_LIMITS),
+      let requests wait up to CONCURRENCY_QUEUE_TIMEOUT for a slot, then
+      answer 503. Streamed responses hold their slot until they're sent.
+
+    Both set Retry-After. Clients are told apart by RATE_LIMIT_KEY_HEADER
+    when they send one of RATE_LIMIT_API_KEYS, otherwise by address. Any
+    other key is ignored, or clients could get a fresh bucket (and evict
+    others') by making keys up.
+    """
+    def __init__(self):
+        self.rate_limits = {}
+        self._slots = {}
+
+    def init_app(self, app):
+        self.rate_limits = app.config['RATE_LIMITS']
+        self.key_header = app.config['RATE_LIMIT_KEY_HEADER']
+        self.api_keys = app.config['RATE_LIMIT_API_KEYS']
+        self.trust_proxy = app.config['RATE_LIMIT_TRUST_PROXY']
+        self.queue_timeout = app.config['CONCURRENCY_QUEUE_TIMEOUT']
+        self.retry_after = app.config['CONCURRENCY_RETRY_AFTER']
+        self._slots = {name: threading.BoundedSemaphore(limit)
+            for name, limit in app.config['CONCURRENCY_LIMITS'].items()}
+        if app.config['RATE_LIMIT_BACKEND'] == 'redis':
+            self.buckets = RedisBuckets(app.config['RATE_LIMIT_REDIS_URL'])
+        else:
+            self.buckets = MemoryBuckets(app.config['RATE_LIMIT_MAX_KEYS'])
+
+    def client_key(self):
+        key = request.headers.get(self.key_header)
+        if key in self.api_keys:
+            return f'key:{key}'
+        # Behind a proxy (e.g, App Service), the client is in X-Forwarded-For.
+        # Only the last address, appended by the proxy, can be trusted
+        return request.access_route[-1] if self.trust_proxy else request.remote_addr
+
+    def _reject(self, status, error, retry_after, reason, endpoint_class):
+        rejected_requests.inc(reason=reason, endpoint_class=endpoint_class)
+        resp = jsonify(dict(error=error))
+        resp.status_code = status
+        resp.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+        return resp
+
+    def limit(self, endpoint_class):
+        """Applies the rate and concurrency limits of endpoint_class to the
+        decorated view."""
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if endpoint_class in self.rate_limits:
+                    rate, burst = self.rate_limits[endpoint_class]
+                    wait = self.buckets.take(f'{endpoint_class}:{self.client_key()}', rate, burst)
+                    if wait:
+                        return self._reject(429, 'Too many requests, retry later', wait,
+                            'rate_limit', endpoint_class)
+                slots = self._slots.get(endpoint_class)
+                if slots is None:
+                    return f(*args, **kwargs)
+                if not slots.acquire(timeout=self.queue_timeout):
+                    return self._reject(503, 'Too busy, retry later', self.retry_after,
+                        'concurrency', endpoint_class)
+                try:
+                    resp = current_app.make_response(f(*args, **kwargs))
+                except BaseException:
+                    slots.release()
+                    raise
+                if not resp.is_streamed:
+                    slots.release()
+                    return resp
+                release = _once(slots.release)
+                resp.response = _releasing(resp.response, release)
+                resp.call_on_close(release)
+                return resp
+            return wrapper
+        return decorator
+
+
+def _once(f):
+    called = []
+    def wrapper():
+        if not called:
+            called.append(True)
+            f()
+    return wrapper
+
+
+def _releasing(chunks, release):
+    """Yields the chunks, calling release once they're all sent (or the 
+    response is closed, see `Limiter.limit`)."""
+    try:
+        yield from chunks
+    finally:
+        release()
+
+
+limiter = Limiter()
@@ -0,0 +1,144 @@
+import bisect
+import threading
+
+from collections import defaultdict
+
+
+class Metric:
+    """Base for metrics kept in process and exported in the Prometheus text
+    format. Values are kept per set of labels, e.g `inc(endpoint='api.x')`.
+    """
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items()))
+
+    @staticmethod
+    def _format(name, labels, value):
+        if labels:
+            name += '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+        return f'{name} {value}'
+
+    def samples(self):
+        return []
+
+    def render(self):
+        return '\n'.join([f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}',
+            *self.samples()])
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help):
+        super().__init__(name, help)
+        self._values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            self._values[self._labels(labels)] += amount
+
+    def value(self, **labels):
+        return self._values.get(self._labels(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [self._format(self.name, labels, value) for labels, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """Either set explicitly, or computed when exported by the function
+    given to `set_function`, which returns a value or a list of
+    (labels dict, value).
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help):
+        super().__init__(name, help)
+        self._function = None
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._labels(labels)] = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def samples(self):
+        if self._function is None:
+            return super().samples()
+        values = self._function()
+        if not isinstance(values, list):
+            values = [({}, values)]
+        return [self._format(self.name, self._labels(labels), value) for labels, value in values]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (+Inf last), sum]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    def count(self, **labels):
+        counts = self._values.get(self._labels(labels))
+        return sum(counts[0]) if counts else 0
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for labels, (counts, total) in self._values.items():
+                cumulative = 0
+                for le, count in zip([*self.buckets, '+Inf'], counts):
+                    cumulative += count
+                    samples.append(self._format(f'{self.name}_bucket',
+                        labels + (('le', le),), cumulative))
+                samples.append(self._format(f'{self.name}_sum', labels, total))
+                samples.append(self._format(f'{self.name}_count', labels, cumulative))
+        return samples
+
+
+class Registry:
+    """Collection of the metrics exported by this process."""
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name, help):
+        return self._get_or_create(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self._get_or_create(Gauge, name, help)
+
+    def histogram(self, name, help, **kwargs):
+        return self._get_or_create(Histogram, name, help, **kwargs)
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+
+registry = Registry()
@@ -1,31 +1,186 @@
+import os
+import re
+
+from collections import Counter
 from datetime import datetime
+from flask import current_app
+from sqlalchemy import and_, event, or_
+from sqlalchemy.exc import IntegrityError
 from backend.datastores import db
+from backend.serializers import ModelSerializer
+
+# Words, as indexed and searched, see search.SearchIndex
+WORD = re.compile(r'\w+')
+
+# Operators of `ModelMixin.__filters__`
+FILTER_OPERATORS = dict(
+    eq=lambda column, value: column == value,
+    ge=lambda column, value: column >= value,
+    lt=lambda column, value: column < value,
+    startswith=lambda column, value: column.startswith(value, autoescape=True))
+
 
 class ModelMixin:
+    # Columns (unique when taken together) that define a stable ordering 
+    # for keyset pagination, see `page`
+    __keyset__ = ('id',)
+    # Filters clients can apply to lists, as {name: (column, operator)}
+    __filters__ = {}
+    # Columns clients can sort lists by, each should lead an index
+    __sortable__ = ('id',)
+    # Columns `_extend_dict` needs to build a field, as {field: columns}
+    __dict_dependencies__ = {}
+    # Internal columns, left out of dicts
+    __hidden__ = ()
+    # Columns clients can set, all of them if None, see `writable`
+    __writable__ = None
+    # Fields of list items, all of them if None, lists can select (?fields=)
+    # among those only. Large columns are better left to single reads
+    __list_fields__ = None
+    # Whether changes to this table bump its `CollectionVersion`
+    __versioned__ = False
+    # Indexed column that only grows as rows are added, incremental exports
+    # resume from its latest exported value, see `export.Exporter` (which
+    # also needs a created_at column)
+    __watermark__ = 'id'
+
+    @classmethod
+    def writable(cls, values):
+        """The values (e.g, sent by a client) of `__writable__` columns, 
+        others are left out."""
+        if cls.__writable__ is None:
+            return values
+        return {name: value for name, value in values.items() if name in cls.__writable__}
+
     @classmethod
     def _process_params(cls, kwargs):
         return kwargs
         
     @classmethod
-    def save(cls, model):
+    def save(cls, model, commit=True):
         db.session.add(model)
-        db.session.commit()
+        if commit:
+            db.session.commit()
         return model
 
     @classmethod
-    def create(cls, **kwargs):
+    def create(cls, commit=True, **kwargs):
         model = cls(**cls._process_params(kwargs))
-        return cls.save(model)
+        return cls.save(model, commit=commit)
+
+    @classmethod
+    def bulk_create(cls, rows, return_defaults=False):
+        """Inserts the given rows (dicts of column values) with a single 
+        executemany and commits, returns the inserted column values. Note no
+        models are created, so ids are only returned with `return_defaults`,
+        which inserts one row at a time."""
+        columns = cls.__table__.columns.keys()
+        mappings = [{k: v for k, v in cls._process_params(row).items() if k in columns} 
+            for row in rows]
+        db.session.bulk_insert_mappings(cls, mappings, return_defaults=return_defaults)
+        # Bulk operations skip the flush events, see `_bump_flushed_versions`
+        if cls.__versioned__:
+            CollectionVersion.bump(db.session, [cls.__tablename__])
+        db.session.commit()
+        return mappings
 
     @classmethod
     def all(cls):
         return [model for model in cls.query.all()]
 
     @classmethod
-    def delete(cls, id):
+    def serializer(cls, fields=None, extra=()):
+        # Built lazily, once per model class and set of fields
+        if '_serializers' not in cls.__dict__:
+            cls._serializers = {}
+        key = (tuple(fields) if fields else None, tuple(extra))
+        if key not in cls._serializers:
+            cls._serializers[key] = ModelSerializer(cls, fields=fields, extra=extra)
+        return cls._serializers[key]
+
+    @classmethod
+    def keyset(cls, sort=None):
+        """Returns the (column name, descending) that rows are ordered by, 
+        `__keyset__` unless sorted by one of `__sortable__` (e.g, -created_at), 
+        then followed by the primary key to break ties."""
+        if not sort:
+            return [(name, False) for name in cls.__keyset__]
+        name, descending = sort.lstrip('-'), sort.startswith('-')
+        if name not in cls.__sortable__:
+            raise ValueError(f'Invalid sort: {sort}, expected one of {list(cls.__sortable__)}')
+        primary_key = [c.name for c in cls.__table__.primary_key.columns if c.name != name]
+        return [(name, descending) for name in [name, *primary_key]]
+
+    @classmethod
+    def row_serializer(cls, fields=None, sort=None):
+        """Serializer of the rows returned by `all_rows`, `page` and `stream`,
+        with `__list_fields__` unless given fields. They also hold the keyset
+        columns even when not among the fields."""
+        fields = fields or cls.__list_fields__
+        if not fields:
+            return cls.serializer()
+        return cls.serializer(fields, extra=[name for name, _ in cls.keyset(sort)])
+
+    @classmethod
+    def all_rows(cls, **options):
+        """Same as `all`, but as rows of the model's columns rather than 
+        models, which skips the cost of building ORM instances. Takes the 
+        filters, sort and fields of `_rows_query`."""
+        if options:
+            return cls._rows_query(**options).all()
+        return cls.query.with_entities(*cls.row_serializer().entities).all()
+
+    @classmethod
+    def _rows_query(cls, filters=None, sort=None, fields=None):
+        """Query of rows with only the columns of the given fields (see 
+        `row_serializer`), matching the filters ({name: value} of 
+        `__filters__`) and ordered by `keyset(sort)`."""
+        query = cls.query.with_entities(*cls.row_serializer(fields, sort).entities)
+        for name, value in (filters or {}).items():
+            column, operator = cls.__filters__[name]
+            query = query.filter(FILTER_OPERATORS[operator](getattr(cls, column), value))
+        return query.order_by(*[getattr(cls, name).desc() if descending else getattr(cls, name) 
+            for name, descending in cls.keyset(sort)])
+
+    @classmethod
+    def page(cls, limit, after=None, **options):
+        """Returns up to `limit` rows (see `all_rows`) ordered by `keyset`,
+        starting after the given key (a sequence of `keyset` values). Also
+        returns the key of the last row, or None if there are no more pages.
+        Takes the filters, sort and fields of `_rows_query`.
+
+        Note: we expand the row comparison into OR/AND terms because SQL 
+        Server does not support tuple comparisons.
+        """
+        query = cls._rows_query(**options)
+        keyset = cls.keyset(options.get('sort'))
+        if after is not None:
+            columns = [(getattr(cls, name), descending) for name, descending in keyset]
+            terms = []
+            for i, (column, descending) in enumerate(columns):
+                equals = [c == v for (c, _), v in zip(columns[:i], after[:i])]
+                terms.append(and_(*equals, column < after[i] if descending else column > after[i]))
+            query = query.filter(or_(*terms))
+        # Fetch one extra row to find out if there's another page
+        rows = query.limit(limit + 1).all()
+        if len(rows) <= limit:
+            return (rows, None)
+        rows = rows[:limit]
+        return (rows, tuple(getattr(rows[-1], name) for name, _ in keyset))
+
+    @classmethod
+    def stream(cls, batch_size, **options):
+        """Iterates over all rows (see `all_rows`) ordered by `keyset`, 
+        using a server side cursor so that only `batch_size` rows are held 
+        at a time. Takes the filters, sort and fields of `_rows_query`."""
+        return cls._rows_query(**options).yield_per(batch_size)
+
+    @classmethod
+    def delete(cls, id, commit=True):
         model = cls.query.get(id)
         db.session.delete(model)
-        db.session.commit()
+        if commit:
+            db.session.commit()
         return model
 
     @classmethod
@@ -33,31 +188,291 @@ class ModelMixin:
         return cls.query.get(id)
 
     def as_dict(self):
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        values = {name: getattr(self, name) for name in self.serializer().names}
+        if hasattr(self, '_extend_dict'):
+            self._extend_dict(values)
+        return values
 
 
 class User(ModelMixin, db.Model):
     __tablename__ = 'users'
+    __versioned__ = True
+    __filters__ = dict(email_prefix=('email', 'startswith'), name=('name', 'eq'))
+    __sortable__ = ('id', 'name', 'email')
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(50), nullable=False)
+    name = db.Column(db.String(50), nullable=False, index=True)
     email = db.Column(db.String(255), nullable=False, unique=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     @classmethod
-    def delete(cls, id):
-        # TODO: let ORM cascade delete for us
-        Article.query.filter_by(user_id=id).delete()
-        super().delete(id)
+    def delete(cls, id, commit=True):
+        """Deletes the user with a single statement, the database cascades
+        it to their articles (see `Article.user_id`). Returns the number of 
+        users deleted."""
+        deleted = cls.query.filter_by(id=id).delete(synchronize_session=False)
+        if deleted:
+            # The cascade happens behind the ORM's back, so no events for it
+            CollectionVersion.bump(db.session, [Article.__tablename__])
+        if commit:
+            db.session.commit()
+        return deleted
 
 
 class Article(db.Model, ModelMixin):
     __tablename__ = 'articles'
+    # created_at is indexed, and SQL Server includes the clustered key (id)
+    # in that index, so paging with this keyset is an index seek
+    __keyset__ = ('created_at', 'id')
+    __versioned__ = True
+    __watermark__ = 'created_at'
+    __filters__ = dict(user_id=('user_id', 'eq'), created_after=('created_at', 'ge'),
+        created_before=('created_at', 'lt'))
+    __sortable__ = ('id', 'created_at')
+    __dict_dependencies__ = dict(image_variants=('image_filename',))
+    # Lists of a user's articles filter on user_id and order by created_at
+    __table_args__ = (db.Index('ix_articles_user_id_created_at', 'user_id', 'created_at'),)
+    __hidden__ = ('content_blob', 'content_words')
+    # The rest are maintained by the application, e.g content_blob names a
+    # blob deleted along with the article, and exports rely on created_at
+    __writable__ = ('title', 'content', 'user_id')
+    # Lists are metadata only, contents are only read one article at a time
+    __list_fields__ = ('id', 'title', 'image_filename', 'image_variants', 'created_at', 'user_id')
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), nullable=False)
-    image_filename = db.Column(db.String(42))
+    image_filename = db.Column(db.String(42), index=True)
+    # Comma separated variants of the image (e.g, 160.webp), see 
+    # images.ImagePipeline, exposed as {variant: url}
+    image_variants = db.Column(db.String(255))
     content = db.Column(db.String(None))
+    # Long contents are stored compressed in this blob instead of inline,
+    # see contents.ContentStore
+    content_blob = db.Column(db.String(42))
+    # The distinct words of offloaded contents, far smaller than them, so 
+    # SQL Server's full-text index (see search.SearchIndex) still finds them
+    content_words = db.Column(db.String(None))
     created_at = db.Column(db.DateTime, index=True, default=datetime.utcnow)
-    user_id = db.Column(db.ForeignKey('users.id'))
+    user_id = db.Column(db.ForeignKey('users.id', name='fk_articles_user_id', ondelete='CASCADE'))
+
+    @classmethod
+    def _process_params(cls, kwargs):
+        # Offloaded contents are not stored inline as well, only their words
+        if kwargs.get('content_blob'):
+            kwargs = dict(kwargs, content=None, content_words=cls.words_of(kwargs.get('content')))
+        return kwargs
+
+    @staticmethod
+    def words_of(content):
+        """The distinct words of content, in order, see `content_words`."""
+        return ' '.join(dict.fromkeys(WORD.findall((content or '').lower())))
+
+    @staticmethod
+    def variant_filename(image_filename, variant):
+        """Blob filename of a variant (e.g, 160.webp) of the given image."""
+        stem, _ = os.path.splitext(image_filename)
+        return f'{stem}_{variant}'
+
+    @classmethod
+    def image_blob_filenames(cls, image_filename, image_variants):
+        """All the blobs of an image, the original and its variants."""
+        if not image_filename:
+            return []
+        variants = image_variants.split(',') if image_variants else []
+        return [image_filename, *(cls.variant_filename(image_filename, v) for v in variants)]
+
+    @classmethod
+    def _extend_dict(cls, values):
+        variants = values.get('image_variants')
+        if variants:
+            base_url = (f"{current_app.config['BLOB_STORE_URI']}/"
+                f"{current_app.config['CONTAINER_ARTICLE_ASSETS']}")
+            values['image_variants'] = {variant: 
+                f"{base_url}/{cls.variant_filename(values['image_filename'], variant)}"
+                for variant in variants.split(',')}
+
+    @classmethod
+    def set_image_variants(cls, image_filename, variants):
+        """Records the variants of an image, returns the number of articles 
+        updated (none if the article was deleted meanwhile)."""
+        updated = (cls.query.filter_by(image_filename=image_filename)
+            .update(dict(image_variants=','.join(variants)), synchronize_session=False))
+        db.session.commit()
+        return updated
+
+
+class ArticleTerm(db.Model, ModelMixin):
+    """Inverted index of the words of article titles and contents, searched 
+    where there's no full-text index (e.g, SQLite), see `search.SearchIndex`.
+    Rows go with their article, by cascade.
+    """
+    __tablename__ = 'article_terms'
+
+    term = db.Column(db.String(64), primary_key=True)
+    article_id = db.Column(db.ForeignKey('articles.id', name='fk_article_terms_article_id', 
+        ondelete='CASCADE'), primary_key=True, index=True)
+    # Occurrences of the term, those in the title count more
+    weight = db.Column(db.Integer, nullable=False)
+
+
+class BlobRef(db.Model, ModelMixin):
+    """Number of articles using each image blob (along with its variants),
+    by digest, when blobs are content addressed (see `datastores.BlobStore`)
+    and so shared by articles with the same image.
+    """
+    __tablename__ = 'blob_refs'
+
+    container_name = db.Column(db.String(63), primary_key=True)
+    digest = db.Column(db.String(64), primary_key=True)
+    refs = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def digest_of(blob_filename):
+        """The digest of a blob, or of the image a variant is of (see 
+        `Article.variant_filename`)."""
+        return os.path.splitext(blob_filename.split('_')[0])[0]
+
+    @classmethod
+    def acquire(cls, container_name, blob_filenames):
+        """Adds a reference to each of the given blobs (repeats count), in 
+        the current transaction."""
+        table = cls.__table__
+        for digest, count in Counter(map(cls.digest_of, blob_filenames)).items():
+            key = and_(table.c.container_name == container_name, table.c.digest == digest)
+            update = table.update().where(key).values(refs=table.c.refs + count)
+            if db.session.execute(update).rowcount:
+                continue
+            try:
+                # In a savepoint, so losing the race leaves the transaction usable
+                with db.session.begin_nested():
+                    db.session.execute(table.insert().values(container_name=container_name, 
+                        digest=digest, refs=count))
+            except IntegrityError:
+                # Inserted by a concurrent acquire since the update
+                db.session.execute(update)
+
+    @classmethod
+    def release(cls, container_name, blob_filenames):
+        """Removes a reference to each of the given blobs, in the current 
+        transaction. Returns the digests no longer referenced, including 
+        those never counted (e.g, uploaded before blobs were shared)."""
+        table = cls.__table__
+        digests = Counter(map(cls.digest_of, blob_filenames))
+        for digest, count in digests.items():
+            key = and_(table.c.container_name == container_name, table.c.digest == digest)
+            db.session.execute(table.update().where(key).values(refs=table.c.refs - count))
+        still_referenced = cls.referenced(container_name, digests)
+        unreferenced = set(digests) - still_referenced
+        if unreferenced:
+            db.session.execute(table.delete().where(and_(table.c.container_name == container_name,
+                table.c.digest.in_(unreferenced))))
+        return unreferenced
+
+    @classmethod
+    def referenced(cls, container_name, digests):
+        """The given digests that are still referenced."""
+        if not digests:
+            return set()
+        return {digest for (digest,) in db.session.query(cls.digest).filter(
+            cls.container_name == container_name, cls.digest.in_(list(digests)), cls.refs > 0)}
+
+
+class InvalidUpload(ValueError):
+    """A direct upload (see `ArticleService.create_upload`) that can't be 
+    used, the client's fault, unlike other errors creating articles."""
+
+
+class UploadClaim(db.Model, ModelMixin):
+    """Direct uploads (see `ArticleService.create_upload`) that articles
+    were created from, so each upload is used once, even by concurrent 
+    requests. Note image filenames can't be unique themselves, articles 
+    share content addressed images.
+    """
+    __tablename__ = 'upload_claims'
+
+    blob_filename = db.Column(db.String(255), primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @classmethod
+    def claim(cls, blob_filename):
+        """Claims the upload in the current transaction, raises 
+        InvalidUpload (and rolls back) if it's already claimed."""
+        db.session.add(cls(blob_filename=blob_filename))
+        try:
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+            raise InvalidUpload('upload_token was already used')
+
+
+class BlobDeletion(db.Model, ModelMixin):
+    """Outbox of blobs waiting to be deleted, rows are added in the same 
+    transaction that deletes whatever referenced the blob.
+    """
+    __tablename__ = 'blob_deletions'
+
+    id = db.Column(db.Integer, primary_key=True)
+    container_name = db.Column(db.String(63), nullable=False)
+    blob_filename = db.Column(db.String(255), nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class Job(db.Model, ModelMixin):
+    """Status of work a request left to run in the background (e.g, 
+    deleting a user with lots of articles), see `services.JobRunner`.
+    """
+    __tablename__ = 'jobs'
+
+    id = db.Column(db.String(36), primary_key=True)
+    name = db.Column(db.String(63), nullable=False)
+    # One of: pending, running, done, failed
+    status = db.Column(db.String(16), nullable=False, default='pending')
+    error = db.Column(db.String(None))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class CollectionVersion(db.Model, ModelMixin):
+    """Version of each versioned table, bumped in the same transaction as 
+    any change to the table's rows. Lets readers cheaply tell if anything 
+    changed (e.g, for conditional requests).
+    """
+    __tablename__ = 'collection_versions'
+
+    name = db.Column(db.String(63), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @classmethod
+    def bump(cls, session, names):
+        table = cls.__table__
+        now = datetime.utcnow()
+        for name in names:
+            result = session.execute(table.update()
+                .where(table.c.name == name)
+                .values(version=table.c.version + 1, updated_at=now))
+            if result.rowcount == 0:
+                session.execute(table.insert().values(name=name, version=1, updated_at=now))
+
+    @classmethod
+    def of(cls, name):
+        """Returns the version and last update time of the given table."""
+        row = db.session.query(cls.version, cls.updated_at).filter(cls.name == name).first()
+        return tuple(row) if row else (0, None)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _bump_flushed_versions(session, flush_context):
+    names = {model.__tablename__ for model in [*session.new, *session.dirty, *session.deleted]
+        if getattr(model, '__versioned__', False)}
+    if names:
+        CollectionVersion.bump(session, sorted(names))
 
 
+@event.listens_for(db.session, 'after_bulk_update')
+@event.listens_for(db.session, 'after_bulk_delete')
+def _bump_bulk_changed_versions(context):
+    model = context.mapper.class_
+    if getattr(model, '__versioned__', False):
+        CollectionVersion.bump(context.session, [model.__tablename__])
@@ -0,0 +1,137 @@
+import math
+
+from collections import Counter
+from sqlalchemy import case, func, text
+from backend.contents import content_store
+from backend.datastores import db
+from backend.models import WORD, Article, ArticleTerm
+
+
+def tokenize(value):
+    """The lowercased words of value, too long ones can't be indexed."""
+    return [word for word in WORD.findall((value or '').lower()) if len(word) <= 64]
+
+
+class SearchIndex:
+    """Full-text search of article titles and contents, ranked best first.
+
+    On SQL Server, it's a full-text index (see the migration adding it) kept
+    up to date by the database itself, offloaded contents are found by
+    their words (see `Article.content_words`). Elsewhere (e.g, SQLite) it's the
+    `ArticleTerm` inverted index, that `ArticleService` adds articles to as
+    they're created, ranked by TF-IDF. Either way articles have to match
+    every word searched for.
+    """
+    # Weight of words in titles, over those in contents
+    TITLE_WEIGHT = 3
+
+    def __init__(self):
+        self._backend = None
+
+    def init_app(self, app):
+        self.max_terms = app.config['SEARCH_MAX_TERMS']
+        backend = app.config['SEARCH_BACKEND']
+        # Otherwise picked from the database on first use
+        self._backend = None if backend == 'auto' else backend
+
+    @property
+    def backend(self):
+        """Either fulltext (SQL Server) or terms (`ArticleTerm`)."""
+        if self._backend is None:
+            self._backend = 'fulltext' if db.engine.dialect.name == 'mssql' else 'terms'
+        return self._backend
+
+    @property
+    def indexes_terms(self):
+        """True if articles have to be added to the index by `add`."""
+        return self.backend == 'terms'
+
+    def add(self, articles):
+        """Adds (id, title, content) of articles to the current transaction's
+        index, the caller commits."""
+        if not self.indexes_terms:
+            return
+        mappings = []
+        for id, title, content in articles:
+            weights = Counter(tokenize(content))
+            for word in tokenize(title):
+                weights[word] += self.TITLE_WEIGHT
+            mappings.extend(dict(term=term, article_id=id, weight=weight)
+                for term, weight in weights.items())
+        if mappings:
+            db.session.bulk_insert_mappings(ArticleTerm, mappings)
+
+    def rebuild(self, batch_size=1000):
+        """Indexes all articles anew, e.g once they're migrated. Returns the
+        number of articles indexed. The full-text index is kept up to date, 
+        there it only fills in the words of contents offloaded before those
+        were kept."""
+        if not self.indexes_terms:
+            return self._fill_content_words(batch_size)
+        ArticleTerm.query.delete(synchronize_session=False)
+        count, last_id = 0, 0
+        while True:
+            rows = (db.session.query(Article.id, Article.title, Article.content, Article.content_blob)
+                .filter(Article.id > last_id).order_by(Article.id).limit(batch_size).all())
+            if not rows:
+                break
+            self.add([(id, title, content_store.load(content_blob) if content_blob else content)
+                for id, title, content, content_blob in rows])
+            db.session.commit()
+            count, last_id = count + len(rows), rows[-1].id
+        return count
+
+    def _fill_content_words(self, batch_size):
+        count, last_id = 0, 0
+        while True:
+            rows = (db.session.query(Article.id, Article.content_blob)
+                .filter(Article.id > last_id, Article.content_blob.isnot(None), 
+                    Article.content_words.is_(None))
+                .order_by(Article.id).limit(batch_size).all())
+            if not rows:
+                break
+            db.session.bulk_update_mappings(Article, [dict(id=id, 
+                content_words=Article.words_of(content_store.load(content_blob)))
+                for id, content_blob in rows])
+            db.session.commit()
+            count, last_id = count + len(rows), rows[-1].id
+        return count
+
+    def search(self, q, limit, offset=0):
+        """Returns the ids of up to `limit` articles matching all the words
+        of q, best first, skipping the first `offset`."""
+        terms = list(dict.fromkeys(tokenize(q)))[:self.max_terms]
+        if not terms:
+            return []
+        if self.backend == 'fulltext':
+            return self._search_fulltext(terms, limit, offset)
+        return self._search_terms(terms, limit, offset)
+
+    def _search_fulltext(self, terms, limit, offset):
+        # Terms are words, so quoting them is enough to escape them
+        condition = ' AND '.join(f'"{term}"' for term in terms)
+        rows = db.session.execute(text(
+            'SELECT [KEY] FROM CONTAINSTABLE(articles, (title, content, content_words), :condition) '
+            'ORDER BY RANK DESC, [KEY] OFFSET :offset ROWS FETCH NEXT :limit ROWS ONLY'),
+            dict(condition=condition, offset=offset, limit=limit))
+        return [id for (id,) in rows]
+
+    def _search_terms(self, terms, limit, offset):
+        # Rarer terms count more, all from the primary key index
+        frequencies = dict(db.session.query(ArticleTerm.term, func.count())
+            .filter(ArticleTerm.term.in_(terms)).group_by(ArticleTerm.term))
+        if len(frequencies) < len(terms):
+            return []
+        total = db.session.query(func.count(Article.id)).scalar()
+        score = func.sum(case([(ArticleTerm.term == term, ArticleTerm.weight *
+            math.log(1 + total / frequencies[term])) for term in terms]))
+        rows = (db.session.query(ArticleTerm.article_id)
+            .filter(ArticleTerm.term.in_(terms))
+            .group_by(ArticleTerm.article_id)
+            .having(func.count() == len(terms))
+            .order_by(score.desc(), ArticleTerm.article_id)
+            .offset(offset).limit(limit))
+        return [id for (id,) in rows]
+
+
+search_index = SearchIndex()
@@ -0,0 +1,133 @@
+import itertools
+import re
+
+from datetime import date, datetime
+from flask import current_app, json, jsonify
+from sqlalchemy import Date, DateTime
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _http_datetime(value):
+    return http_date(value.utctimetuple())
+
+
+def _http_date(value):
+    return http_date(value.timetuple())
+
+
+class ModelSerializer:
+    """Precomputed column accessors for a model, turns models or rows (from
+    a query on `entities`) into dicts that encode exactly like
+    `jsonify(model.as_dict())`, with dates already formatted. Models can
+    add to or replace values with an `_extend_dict(values)` classmethod.
+
+    Given fields, only those columns are included, otherwise all but the
+    model's `__hidden__` ones. Any `extra` columns (and those `_extend_dict`
+    depends on) are loaded but left out of the dicts.
+    """
+    def __init__(self, model, fields=None, extra=()):
+        hidden = getattr(model, '__hidden__', ())
+        self.fields = fields = tuple(fields or 
+            [name for name in model.__table__.columns.keys() if name not in hidden])
+        dependencies = getattr(model, '__dict_dependencies__', {})
+        self.names = fields + tuple(dict.fromkeys(name 
+            for name in [*extra, *(d for f in fields for d in dependencies.get(f, ()))]
+            if name not in fields))
+        self._hidden = self.names[len(fields):]
+        columns = [model.__table__.columns[name] for name in self.names]
+        self.entities = tuple(getattr(model, name) for name in self.names)
+        self._converters = tuple(
+            _http_datetime if isinstance(c.type, DateTime) else
+            _http_date if isinstance(c.type, Date) else None for c in columns)
+        self._extend = getattr(model, '_extend_dict', None)
+
+    def from_row(self, row):
+        values = {name: (convert(value) if convert and value is not None else value)
+            for name, convert, value in zip(self.names, self._converters, row)}
+        if self._extend is not None:
+            self._extend(values)
+        for name in self._hidden:
+            del values[name]
+        return values
+
+    def from_model(self, model):
+        return self.from_row([getattr(model, name) for name in self.names])
+
+
+class Encoder:
+    """Encodes JSON responses with orjson when it's installed, producing the
+    same bytes `jsonify` would. Anything orjson can't reproduce exactly
+    (pretty printing, escaping non ASCII characters) goes through `jsonify`.
+    """
+    # Characters that Python's json escapes when ensure_ascii is set
+    _NON_ASCII = re.compile(rb'[\x7f-\xff]')
+
+    def __init__(self):
+        self.enabled = False
+
+    def init_app(self, app):
+        self.enabled = orjson is not None and app.config['JSON_FAST_ENCODER']
+        self.stream_min_items = app.config['JSON_STREAM_MIN_ITEMS']
+        self.stream_batch_size = app.config['DB_STREAM_BATCH_SIZE']
+        self.ascii = app.config['JSON_AS_ASCII']
+        self.options = (orjson.OPT_PASSTHROUGH_DATETIME |
+            (orjson.OPT_SORT_KEYS if app.config['JSON_SORT_KEYS'] else 0)) if orjson else 0
+
+    @staticmethod
+    def _default(value):
+        if isinstance(value, datetime):
+            return _http_datetime(value)
+        if isinstance(value, date):
+            return _http_date(value)
+        raise TypeError
+
+    def _pretty(self):
+        return current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug
+
+    def dumps(self, value):
+        """Compact JSON (bytes) of value, as encoded by Flask's `json.dumps`."""
+        if self.enabled:
+            try:
+                data = orjson.dumps(value, default=self._default, option=self.options)
+                if not (self.ascii and self._NON_ASCII.search(data)):
+                    return data
+            except TypeError:
+                pass
+        return json.dumps(value, separators=(',', ':')).encode()
+
+    def iter_array(self, items, batch_size):
+        """Encodes items (any iterable, consumed lazily) as a JSON array, 
+        yielding a batch of items at a time rather than many tiny chunks."""
+        items = iter(items)
+        yield b'['
+        separator = b''
+        while True:
+            batch = list(itertools.islice(items, batch_size))
+            if not batch:
+                break
+            yield separator + b','.join(self.dumps(item) for item in batch)
+            separator = b','
+        yield b']'
+
+    def response(self, value):
+        """Same as `jsonify(value)`. Large lists are encoded as the response
+        is sent, so neither the whole body nor (see `Compression`) its 
+        compressed copy are ever held in memory."""
+        if self._pretty():
+            return jsonify(value)
+        if isinstance(value, list) and len(value) >= self.stream_min_items:
+            return current_app.response_class(
+                itertools.chain(self.iter_array(value, self.stream_batch_size), [b'\n']),
+                mimetype=current_app.config['JSONIFY_MIMETYPE'])
+        if not self.enabled:
+            return jsonify(value)
+        return current_app.response_class(self.dumps(value) + b'\n',
+            mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+encoder = Encoder()
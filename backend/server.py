@@ -0,0 +1,73 @@
+"""Production server, gunicorn with threaded workers forked from a master
+that has already imported and created the app (`create_app`), so workers
+start fast and share its memory. 
+
+    python manage.py serve
+
+Send the master HUP to gracefully replace the workers (e.g, after a config
+change), note they're forked from the already loaded app. To deploy new
+code, send USR2 to start a new master, then QUIT to the old one.
+"""
+import os
+
+from gunicorn.app.base import BaseApplication
+from backend.datastores import blob_store, db
+
+
+def cpu_count():
+    """CPUs this process may run on, which can be less than the machine's
+    (e.g, in a container)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def options(config, **overrides):
+    """Gunicorn settings from the SERVER_* configurations."""
+    options = dict(
+        bind=config['SERVER_BIND'],
+        workers=config['SERVER_WORKERS'] or 2 * cpu_count() + 1,
+        # Requests mostly wait on the database and blob storage
+        worker_class='gthread',
+        threads=config['SERVER_THREADS'],
+        preload_app=True,
+        max_requests=config['SERVER_MAX_REQUESTS'],
+        max_requests_jitter=config['SERVER_MAX_REQUESTS_JITTER'],
+        timeout=config['SERVER_TIMEOUT'],
+        graceful_timeout=config['SERVER_GRACEFUL_TIMEOUT'],
+        keepalive=config['SERVER_KEEPALIVE'],
+        pre_fork=pre_fork,
+        post_fork=post_fork)
+    options.update({k: v for k, v in overrides.items() if v is not None})
+    return options
+
+
+def pre_fork(server, worker):
+    # Close whatever connections the master made, so workers start with
+    # an empty pool (see datastores._check_pid for the ones in use)
+    with server.app.app.app_context():
+        db.engine.dispose()
+
+
+def post_fork(server, worker):
+    # The SDK's HTTP sessions must not be shared with the parent either
+    blob_store.client = None
+
+
+class Server(BaseApplication):
+    def __init__(self, app, options):
+        self.app = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for name, value in self.options.items():
+            self.cfg.set(name, value)
+
+    def load(self):
+        return self.app
+
+
+def serve(app, **overrides):
+    Server(app, options(app.config, **overrides)).run()
@@ -1,16 +1,165 @@
 import logging
+import pickle
+import threading
+import time
+import uuid
 
-from backend.datastores import blob_store
-from backend.models import User, Article
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from itsdangerous import BadData, URLSafeTimedSerializer
+from sqlalchemy.exc import SQLAlchemyError
+from backend.contents import content_store
+from backend.datastores import BlobStore, blob_store, db
+from backend.images import image_pipeline
+from backend.metrics import registry
+from backend.models import User, Article, BlobDeletion, BlobRef, CollectionVersion, InvalidUpload, Job, UploadClaim
+from backend.search import search_index
 
 log = logging.getLogger(__name__)
 
 
+class NullCache:
+    """Cache backend that never caches anything."""
+    def __init__(self):
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+class LRUCache(NullCache):
+    """In process, thread safe LRU cache backend, entries expire after 
+    `ttl` seconds. Note each process has its own copy, so writes made by 
+    other processes are only seen once entries expire.
+    """
+    def __init__(self, max_entries, ttl):
+        super().__init__()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        return dict(super().stats(), entries=len(self._entries))
+
+
+class RedisCache(NullCache):
+    """Cache backend shared by all processes, requires the `redis` package.
+    Note the hit/miss counters are still per process.
+    """
+    def __init__(self, url, ttl):
+        super().__init__()
+        try:
+            import redis
+        except ImportError:
+            raise EnvironmentError('CACHE_BACKEND=redis requires the redis package')
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(value)
+
+    def set(self, key, value):
+        self.client.setex(key, self.ttl, pickle.dumps(value))
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*keys)
+
+
+class Cache:
+    """Read through cache used by `Service`, delegates to the backend 
+    selected with CACHE_BACKEND (memory, redis or none).
+    """
+    def __init__(self):
+        self.backend = NullCache()
+
+    def init_app(self, app):
+        backend = app.config['CACHE_BACKEND']
+        if backend == 'memory':
+            self.backend = LRUCache(app.config['CACHE_MAX_ENTRIES'], app.config['CACHE_TTL'])
+        elif backend == 'redis':
+            self.backend = RedisCache(app.config['CACHE_REDIS_URL'], app.config['CACHE_TTL'])
+        else:
+            self.backend = NullCache()
+
+    def get(self, key, load, fresh=None):
+        """Returns the value for key, calling load and caching its result 
+        on a miss, or when the cached value isn't `fresh` (if given). None 
+        is never cached."""
+        value = self.backend.get(key)
+        if value is None or (fresh is not None and not fresh(value)):
+            value = load()
+            if value is not None:
+                self.backend.set(key, value)
+        return value
+
+    def delete(self, *keys):
+        self.backend.delete(*keys)
+
+    def stats(self):
+        return self.backend.stats()
+
+
+def read_only(f):
+    """Runs the decorated `Service` method on a read replica, when there's
+    a healthy one, see `datastores.Database.read`."""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        return db.read(f, *args, **kwargs)
+    return wrapper
+
+
 class Service:
     """Encapsulates common SQLAlchemy specific operations to 
-    implementing classes.
+    implementing classes. Reads go to read replicas, when configured.
     """
     _model_ = None
+    # Whether batch inserts fetch the ids of rows, one insert per row
+    _bulk_return_defaults = False
 
     def init_app(self, app):
         pass
@@ -18,14 +167,154 @@ class Service:
     def _before_update(self, kwargs):
         return kwargs
 
+    def _cache_key(self, *parts):
+        return ':'.join([self._model_.__tablename__, *map(str, parts)])
+
+    def _detach(self, model):
+        """Detaches model from the session so it can be cached, it keeps 
+        its loaded state and later commits won't expire it."""
+        if model is not None:
+            db.session.expunge(model)
+        return model
+
+    def _attach(self, model):
+        """Attaches a copy of a cached model to the current session without
+        querying the database, so callers are free to update it."""
+        return db.session.merge(model, load=False)
+
+    def invalidate(self, *ids):
+        """Removes the cached models with the given ids and any cached 
+        collections of this service's models. Until replicas catch up, 
+        they're reloaded from the primary."""
+        db.stick_to_primary()
+        cache.delete(self._cache_key('all'), self._cache_key('all_dicts'),
+            *[self._cache_key('get', id) for id in ids])
+
+    @read_only
+    def version(self):
+        """Returns the (version, last updated time) of this service's models,
+        never cached, since it's what tells readers that something changed."""
+        return CollectionVersion.of(self._model_.__tablename__)
+
+    @read_only
     def all(self):
-        return self._model_.all()
+        models = cache.get(self._cache_key('all'), 
+            lambda: [self._detach(model) for model in self._model_.all()])
+        return [self._attach(model) for model in models]
+
+    @read_only
+    def all_dicts(self, version=None, **options):
+        """All models as dicts ready to be encoded (see `ModelSerializer`), 
+        read straight from rows rather than models. Only cached without 
+        options (see `ModelMixin.all_rows`), along with the `version` of the
+        models (read if not given) they're of, and reloaded once it changes.
+        So the cached dicts are never older than the version they're served
+        with, whichever process changed them, and there's only ever one 
+        copy of them."""
+        serializer = self._model_.row_serializer(options.get('fields'), options.get('sort'))
+        load = lambda: [serializer.from_row(row) for row in self._model_.all_rows(**options)]
+        if options:
+            return load()
+        if version is None:
+            version, _ = self.version()
+        _, dicts = cache.get(self._cache_key('all_dicts'), lambda: (version, load()),
+            fresh=lambda cached: cached[0] == version)
+        return dicts
+
+    @read_only
+    def page(self, limit, after=None, **options):
+        """Returns a page of models as dicts (see `all_dicts`) and the key
+        of the next page, see `ModelMixin.page` for the options."""
+        serializer = self._model_.row_serializer(options.get('fields'), options.get('sort'))
+        rows, next_key = self._model_.page(limit, after=after, **options)
+        return ([serializer.from_row(row) for row in rows], next_key)
+
+    def stream(self, batch_size, **options):
+        """Iterates over all models as dicts (see `all_dicts`), see 
+        `ModelMixin.stream` for the options."""
+        serializer = self._model_.row_serializer(options.get('fields'), options.get('sort'))
+        # The query runs once it's iterated, so only that needs a replica
+        rows = db.read(iter, self._model_.stream(batch_size, **options))
+        return (serializer.from_row(row) for row in rows)
 
     def create(self, **kwargs):
-        return self._model_.create(**kwargs)
+        model = self._model_.create(**kwargs)
+        self.invalidate()
+        return model
+
+    def bulk_create(self, rows, chunk_size, required_params=()):
+        """Inserts the given rows (an iterable of dicts, consumed lazily) in 
+        chunks of `chunk_size`, each with a single executemany and commit. 
+        Returns the number of rows created and the errors of rows that were 
+        not, e.g dict(index=3, error='...').
+        """
+        created, errors, chunk = 0, [], []
+        for index, row in enumerate(rows):
+            if not isinstance(row, dict):
+                errors.append(dict(index=index, error='Invalid row'))
+                continue
+            missing_params = [name for name in required_params if row.get(name) is None]
+            if missing_params:
+                errors.append(dict(index=index, error=f'Missing required params: {missing_params}'))
+                continue
+            chunk.append((index, row))
+            if len(chunk) >= chunk_size:
+                created += self._insert_chunk(chunk, errors)
+                chunk = []
+        if chunk:
+            created += self._insert_chunk(chunk, errors)
+        if created:
+            self.invalidate()
+        return (created, sorted(errors, key=lambda e: e['index']))
+
+    def _before_insert(self, chunk, errors):
+        """Prepares a chunk of (index, row) before it's inserted, returns
+        the rows that should still be inserted."""
+        return chunk
+
+    def _after_insert(self, rows):
+        """Follows up on rows that were inserted (and committed), as given
+        to `bulk_create`, with their ids when `_bulk_return_defaults`."""
+        pass
+
+    def _after_failed_insert(self, rows):
+        """Cleans up after rows that could not be inserted."""
+        pass
+
+    def _insert(self, rows):
+        """Inserts the rows with a single executemany and commits, returns
+        them with their ids when `_bulk_return_defaults`."""
+        mappings = self._model_.bulk_create(rows, return_defaults=self._bulk_return_defaults)
+        return [dict(row, id=mapping['id']) if 'id' in mapping else row
+            for row, mapping in zip(rows, mappings)]
+
+    def _insert_chunk(self, chunk, errors):
+        chunk = self._before_insert(chunk, errors)
+        if not chunk:
+            return 0
+        try:
+            self._after_insert(self._insert([row for _, row in chunk]))
+            return len(chunk)
+        except SQLAlchemyError:
+            db.session.rollback()
+        # Some row(s) in the chunk failed, fall back to one row at a time 
+        # to find out which ones
+        created_rows, failed_rows = [], []
+        for index, row in chunk:
+            try:
+                created_rows.extend(self._insert([row]))
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                errors.append(dict(index=index, error=str(getattr(e, 'orig', e))))
+                failed_rows.append(row)
+        self._after_insert(created_rows)
+        self._after_failed_insert(failed_rows)
+        return len(created_rows)
 
     def delete(self, id):
-        return self._model_.delete(id)
+        model = self._model_.delete(id)
+        self.invalidate(id)
+        return model
 
     def update(self, model=None, id=None, **kwargs):
         if id is None and model is None:
@@ -34,10 +323,15 @@ class Service:
             model = self.get(id)
         for k, v in self._before_update(kwargs).items():
             setattr(model, k, v)
-        return self._model_.save(model)
+        model = self._model_.save(model)
+        self.invalidate(model.id)
+        return model
 
+    @read_only
     def get(self, id):
-        return self._model_.get(id)
+        model = cache.get(self._cache_key('get', id), 
+            lambda: self._detach(self._model_.get(id)))
+        return self._attach(model) if model is not None else None
 
 
 class UserService(Service):
@@ -46,10 +340,26 @@ class UserService(Service):
     """
     _model_ = User
 
+    def init_app(self, app):
+        self.asset_container_name = app.config['CONTAINER_ARTICLE_ASSETS']
+
     def delete(self, id):
-        # TODO: let ORM cascade delete for us
-        Article.query.filter_by(user_id=id).delete()
-        super().delete(id)
+        """Deletes the user and (by cascade) their articles in a single 
+        transaction, queueing all of their image (and content) blobs for deletion. Returns
+        True if the user existed."""
+        # Collect the articles before the rows are gone, so their image 
+        # blobs are queued for deletion in the same transaction
+        articles = (db.session.query(Article.id, Article.image_filename, Article.image_variants,
+            Article.content_blob).filter(Article.user_id == id).all())
+        deleted = self._model_.delete(id, commit=False)
+        blob_deletion_queue.enqueue(self.asset_container_name, article_service.unused_blobs(
+            [(image_filename, image_variants) for (_, image_filename, image_variants, _) in articles])
+            + [content_blob for (*_, content_blob) in articles if content_blob])
+        db.session.commit()
+        self.invalidate(id)
+        article_service.invalidate(*[article_id for (article_id, *_) in articles])
+        blob_deletion_queue.notify()
+        return bool(deleted)
 
 
 class ArticleService(Service):
@@ -60,27 +370,399 @@ class ArticleService(Service):
 
     def init_app(self, app):
         self.asset_container_name = app.config['CONTAINER_ARTICLE_ASSETS']
+        self.bulk_upload_concurrency = app.config['BULK_UPLOAD_CONCURRENCY']
+        self.upload_expires_in = app.config['BLOB_UPLOAD_SAS_TTL']
+        self.upload_tokens = URLSafeTimedSerializer(app.config['SECRET_KEY'], 
+            salt='article-image-upload')
 
-    def create(self, image=None, **kwargs):
-        filename = None
+    def create_upload(self, filename):
+        """First step of letting clients upload images straight to blob 
+        storage. Returns a short lived, write only URL for a new blob and a 
+        token to `create` the article with once the upload is done."""
+        blob_filename = blob_store.new_blob_filename(filename)
+        url = blob_store.generate_upload_url(self.asset_container_name, 
+            blob_filename, self.upload_expires_in)
+        return dict(upload_url=url, upload_token=self.upload_tokens.dumps(blob_filename),
+            expires_in=self.upload_expires_in)
+
+    def _uploaded_filename(self, upload_token):
+        """Returns the blob filename of an upload started with 
+        `create_upload`, raises InvalidUpload if it can't be used."""
+        try:
+            # Leave clients some time between finishing the upload and us
+            blob_filename = self.upload_tokens.loads(upload_token, 
+                max_age=self.upload_expires_in * 2)
+        except BadData:
+            raise InvalidUpload('Invalid or expired upload_token')
+        # Only a fast path, `UploadClaim.claim` is what prevents reuse
+        if UploadClaim.query.get(blob_filename) is not None:
+            raise InvalidUpload('upload_token was already used')
+        if not blob_store.exists(self.asset_container_name, blob_filename):
+            raise InvalidUpload('Image was not uploaded')
+        return blob_filename
+
+    def create(self, image=None, upload_token=None, content=None, **kwargs):
+        """Creates the article while its image uploads in the background: 
+        the row is inserted and committed meanwhile, in one short transaction,
+        then the article is returned once the upload is done. If the upload
+        fails the article is deleted again, readers may have seen it (without
+        its image) in between. Or, with the token of a direct upload (see 
+        `create_upload`), from the already uploaded image. Long contents are
+        stored in blob storage, see `contents.ContentStore`."""
+        kwargs, content_blob = self._model_.writable(kwargs), None
+        if upload_token:
+            filename, upload = self._uploaded_filename(upload_token), None
+        elif image:
+            [(image, filename)] = self._reserve([image])
+            filename, upload = blob_store.upload_async(file=image,
+                container_name=self.asset_container_name, blob_filename=filename)
+        else:
+            filename, upload = None, None
         try:
-            if image:
-                filename = blob_store.upload(file=image,
-                    container_name=self.asset_container_name)
-            return super().create(image_filename=filename, **kwargs)
+            if content_store.offloads(content):
+                # While the image uploads
+                content_blob = content_store.store(content)
+            if upload_token:
+                UploadClaim.claim(filename)
+            article = self._model_.create(image_filename=filename, content=content, 
+                content_blob=content_blob, commit=False, **kwargs)
+            db.session.flush()
+            search_index.add([(article.id, article.title, content)])
+            if upload_token and blob_store.content_addressed:
+                BlobRef.acquire(self.asset_container_name, [filename])
+            db.session.commit()
         except Exception as e:
-            if filename:
-                # Rolling back the blob we just uploaded
-                blob_store.delete(blob_filename=filename,
-                    container_name=self.asset_container_name)
+            db.session.rollback()
+            # Waits for the upload, so the blob isn't left behind
+            if upload and (blob_store.content_addressed or upload.exception() is None):
+                # Rolling back the blob we just uploaded (or reserved)
+                self._discard_uploads([filename])
+            if content_blob:
+                blob_store.delete_many(content_store.container_name, [content_blob])
             raise e
+        self.invalidate()
+        if upload:
+            try:
+                upload.result()
+            except Exception:
+                # Along with its content blob, and image reference if any
+                self.delete(article.id)
+                raise
+        self._generate_variants(filename)
+        return article
+
+    def as_dict(self, article, content=None):
+        """The article as a dict, with its content loaded from blob storage
+        if it was offloaded there, unless it's given (e.g, just created)."""
+        values = article.as_dict()
+        if article.content_blob:
+            values['content'] = content if content is not None else content_store.load(article.content_blob)
+        return values
+
+    @read_only
+    def search(self, q, limit, offset=0):
+        """Articles matching all the words of q (see `search.SearchIndex`), 
+        best first, as dicts (see `all_dicts`). Returns up to `limit` of 
+        them, skipping the first `offset`, and whether there are more."""
+        ids = search_index.search(q, limit + 1, offset)
+        serializer = self._model_.row_serializer()
+        rows = {row.id: row for row in self._model_.query
+            .with_entities(*serializer.entities).filter(self._model_.id.in_(ids[:limit]))}
+        # Articles deleted since they were found are left out
+        return ([serializer.from_row(rows[id]) for id in ids[:limit] if id in rows], 
+            len(ids) > limit)
+
+    def _generate_variants(self, image_filename):
+        if image_filename and blob_store.content_addressed:
+            variants = (db.session.query(Article.image_variants)
+                .filter(Article.image_filename == image_filename, Article.image_variants.isnot(None))
+                .limit(1).scalar())
+            if variants:
+                # Another article has the same image, whose variants are there
+                self._record_variants(image_filename, variants.split(','))
+                return None
+        return image_pipeline.submit(self.asset_container_name, image_filename, 
+            self._record_variants)
+
+    def unused_blobs(self, images):
+        """The blobs of the given (image_filename, image_variants) of 
+        articles being deleted, that are no longer used. With content 
+        addressed blobs, that's those no other article has a reference to, 
+        which are released in the current transaction."""
+        images = dict((filename, variants) for filename, variants in images if filename)
+        if blob_store.content_addressed:
+            unreferenced = BlobRef.release(self.asset_container_name, list(images))
+            images = {filename: variants for filename, variants in images.items() 
+                if BlobRef.digest_of(filename) in unreferenced}
+        return [blob_filename for filename, variants in images.items() 
+            for blob_filename in Article.image_blob_filenames(filename, variants)]
+
+    def _reserve(self, images):
+        """Names the given image files (see `BlobStore.name`), returns their
+        (file, blob_filename). Content addressed ones are referenced (and 
+        committed) before they're uploaded, since uploads of blobs that are
+        already there are skipped: were the reference only taken with the
+        article, the blob could meanwhile be deleted along with the last 
+        article using it. `_discard_uploads` releases them."""
+        named = [blob_store.name(image) for image in images]
+        if named and blob_store.content_addressed:
+            BlobRef.acquire(self.asset_container_name, [filename for _, filename in named])
+            db.session.commit()
+        return named
+
+    def _discard_uploads(self, filenames):
+        """Deletes blobs uploaded for articles that were not created. Content
+        addressed ones may be used by other articles, their references (see
+        `_reserve`) are released and only unreferenced ones deleted."""
+        if blob_store.content_addressed:
+            unreferenced = BlobRef.release(self.asset_container_name, filenames)
+            blob_deletion_queue.enqueue(self.asset_container_name, 
+                [filename for filename in filenames if BlobRef.digest_of(filename) in unreferenced])
+            db.session.commit()
+            blob_deletion_queue.notify()
+        else:
+            blob_store.delete_many(self.asset_container_name, filenames)
+
+    def _record_variants(self, image_filename, variants):
+        """Called by the image pipeline once the variants are uploaded."""
+        ids = [id for (id,) in db.session.query(Article.id).filter_by(image_filename=image_filename)]
+        if not self._model_.set_image_variants(image_filename, variants):
+            # The article was deleted while its variants were generated
+            blob_deletion_queue.enqueue(self.asset_container_name, 
+                Article.image_blob_filenames(image_filename, ','.join(variants))[1:])
+            db.session.commit()
+            blob_deletion_queue.notify()
+        self.invalidate(*ids)
+
+    def _before_insert(self, chunk, errors):
+        """Uploads the images (under `image`, see `_reserve`) and long contents
+        of the chunk concurrently, rows whose image failed to upload are not 
+        inserted."""
+        chunk = [(index, dict(self._model_.writable(row), image=row.get('image')))
+            for index, row in chunk]
+        rows, images, uploads, contents = dict(chunk), [], [], []
+        for index, row in chunk:
+            image = row.pop('image')
+            row['image_filename'] = None
+            if image is None:
+                continue
+            if not hasattr(image, 'stream'):
+                uploads.append((index, None))
+                continue
+            images.append((index, image))
+        named = self._reserve([image for _, image in images])
+        with ThreadPoolExecutor(max_workers=self.bulk_upload_concurrency) as executor:
+            for index, row in chunk:
+                if content_store.offloads(row.get('content')):
+                    contents.append((index, executor.submit(content_store.store, row['content'])))
+            for (index, _), (image, filename) in zip(images, named):
+                rows[index]['image_filename'] = filename
+                uploads.append((index, executor.submit(blob_store.upload, file=image, 
+                    container_name=self.asset_container_name, blob_filename=filename)))
+
+        failed = set()
+        for index, future in uploads:
+            try:
+                if future is None:
+                    raise ValueError('Missing image file')
+                future.result()
+            except Exception as e:
+                errors.append(dict(index=index, error=str(e)))
+                failed.add(index)
+        for index, future in contents:
+            try:
+                rows[index]['content_blob'] = future.result()
+            except Exception as e:
+                if index not in failed:
+                    errors.append(dict(index=index, error=str(e)))
+                    failed.add(index)
+        self._after_failed_insert([rows[index] for index in failed])
+        return [(index, row) for index, row in chunk if index not in failed]
+
+    def _after_failed_insert(self, rows):
+        filenames = [row['image_filename'] for row in rows if row.get('image_filename')]
+        if filenames:
+            # Rolling back the blobs we just uploaded
+            self._discard_uploads(filenames)
+        content_blobs = [row['content_blob'] for row in rows if row.get('content_blob')]
+        if content_blobs:
+            blob_store.delete_many(content_store.container_name, content_blobs)
+
+    @property
+    def _bulk_return_defaults(self):
+        # Indexing needs the ids
+        return search_index.indexes_terms
+
+    def _after_insert(self, rows):
+        # Their images were referenced by `_reserve`
+        if search_index.indexes_terms and rows:
+            search_index.add([(row['id'], row.get('title'), row.get('content')) for row in rows])
+        db.session.commit()
+        for row in rows:
+            self._generate_variants(row.get('image_filename'))
 
     def delete(self, id):
-        article = super().delete(id)
-        blob_store.delete(blob_filename=article.image_filename,
-            container_name=self.asset_container_name)
-        
+        article = self._model_.delete(id, commit=False)
+        blob_deletion_queue.enqueue(self.asset_container_name, 
+            self.unused_blobs([(article.image_filename, article.image_variants)])
+            + ([article.content_blob] if article.content_blob else []))
+        db.session.commit()
+        self.invalidate(id)
+        blob_deletion_queue.notify()
+        return article
+
+
+class BlobDeletionQueue:
+    """Deletes blobs in the background, so requests only wait on the 
+    database. Services `enqueue` blobs in the same transaction as the rows 
+    referencing them, a worker thread then drains the `BlobDeletion` outbox
+    in batches, split into batch requests sent in parallel, retrying 
+    failed deletes on the next poll.
+
+    The worker starts with the process's first request, so it never runs in
+    a preloading server's master process (see server.py).
+
+    Note: with multiple processes, the same blob may be deleted more than 
+    once, which is harmless.
+    """
+    def init_app(self, app):
+        self.app = app
+        self.batch_size = app.config['BLOB_DELETE_BATCH_SIZE']
+        self.max_attempts = app.config['BLOB_DELETE_MAX_ATTEMPTS']
+        self.poll_interval = app.config['BLOB_DELETE_POLL_INTERVAL']
+        self.concurrency = app.config['BLOB_DELETE_CONCURRENCY']
+        self._wakeup = threading.Event()
+        if app.config['BLOB_DELETE_WORKER']:
+            app.before_first_request(lambda: threading.Thread(target=self._run, 
+                name='blob-deletions', daemon=True).start())
+
+    def enqueue(self, container_name, blob_filenames):
+        """Adds the blobs to the current transaction (with a single 
+        executemany), the caller commits."""
+        if blob_filenames:
+            db.session.bulk_insert_mappings(BlobDeletion, [dict(container_name=container_name,
+                blob_filename=blob_filename) for blob_filename in blob_filenames])
+
+    def notify(self):
+        """Wakes up the worker, rather than waiting for the next poll."""
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            with self.app.app_context():
+                try:
+                    # Keep going while there are full batches
+                    while self.drain() >= self.batch_size:
+                        pass
+                except Exception:
+                    log.exception('Failed to drain blob deletions')
+                finally:
+                    db.session.remove()
+
+    def drain(self):
+        """Deletes the next batch of pending blobs, returns the number of 
+        blobs deleted."""
+        deletions = (db.session.query(BlobDeletion.id, BlobDeletion.container_name, 
+                BlobDeletion.blob_filename, BlobDeletion.attempts)
+            .filter(BlobDeletion.attempts < self.max_attempts)
+            .order_by(BlobDeletion.id)
+            .limit(self.batch_size).all())
+        chunks = defaultdict(list)
+        for deletion in deletions:
+            chunks[deletion.container_name].append(deletion)
+        # Content addressed blobs may be in use again since they were queued
+        kept = []
+        if blob_store.content_addressed:
+            for container_name, pending in list(chunks.items()):
+                referenced = BlobRef.referenced(container_name, 
+                    {BlobRef.digest_of(d.blob_filename) for d in pending})
+                kept.extend(d.id for d in pending if BlobRef.digest_of(d.blob_filename) in referenced)
+                chunks[container_name] = [d for d in pending 
+                    if BlobRef.digest_of(d.blob_filename) not in referenced]
+        chunks = [(container_name, pending[i:i + BlobStore.MAX_BATCH_SIZE])
+            for container_name, pending in chunks.items()
+            for i in range(0, len(pending), BlobStore.MAX_BATCH_SIZE)]
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = executor.map(lambda chunk: self._delete_chunk(*chunk), chunks)
+            done, failed = kept, []
+            for (container_name, pending), failed_filenames in zip(chunks, results):
+                for deletion in pending:
+                    if deletion.blob_filename not in failed_filenames:
+                        done.append(deletion.id)
+                        continue
+                    failed.append(deletion.id)
+                    if deletion.attempts + 1 >= self.max_attempts:
+                        log.error(f'Giving up deleting blob {deletion.blob_filename} from {container_name}')
+
+        if done:
+            (BlobDeletion.query.filter(BlobDeletion.id.in_(done))
+                .delete(synchronize_session=False))
+        if failed:
+            (BlobDeletion.query.filter(BlobDeletion.id.in_(failed))
+                .update(dict(attempts=BlobDeletion.attempts + 1), synchronize_session=False))
+        db.session.commit()
+        return len(done)
+
+    def _delete_chunk(self, container_name, pending):
+        """Returns the filenames of the chunk that could not be deleted."""
+        blob_filenames = [d.blob_filename for d in pending]
+        try:
+            return blob_store.delete_many(container_name, blob_filenames)
+        except Exception:
+            log.exception(f'Failed to delete blobs from {container_name}')
+            return set(blob_filenames)
+
+
+class JobRunner:
+    """Runs slow work (e.g, deleting a user with lots of articles) on
+    background threads, so requests can return 202 right away. Each job's 
+    status is kept in the `Job` table, so any process can report it.
+
+    Note: jobs running in a process that dies are left as running.
+    """
+    def init_app(self, app):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'],
+            thread_name_prefix='jobs')
+
+    def submit(self, name, function, *args):
+        """Runs function(*args) in the background, returns its `Job`."""
+        job = Job.create(id=str(uuid.uuid4()), name=name)
+        self.executor.submit(self._run, job.id, function, args)
+        return job
+
+    def _run(self, id, function, args):
+        with self.app.app_context():
+            try:
+                self._set_status(id, 'running')
+                function(*args)
+                self._set_status(id, 'done')
+            except Exception as e:
+                log.exception(f'Job {id} failed')
+                db.session.rollback()
+                self._set_status(id, 'failed', error=str(e))
+            finally:
+                db.session.remove()
+
+    def _set_status(self, id, status, error=None):
+        Job.query.filter_by(id=id).update(dict(status=status, error=error, 
+            updated_at=datetime.utcnow()), synchronize_session=False)
+        db.session.commit()
+
+    def get(self, id):
+        return Job.get(id)
+
 
+cache = Cache()
+registry.gauge('cache_lookups', 'Service cache lookups, by result').set_function(
+    lambda: [(dict(result=k), v) for k, v in cache.stats().items() if k in ('hits', 'misses')])
+registry.gauge('cache_evictions', 'Entries evicted from the service cache').set_function(
+    lambda: cache.stats()['evictions'])
+blob_deletion_queue = BlobDeletionQueue()
+job_runner = JobRunner()
 article_service = ArticleService()
 user_service = UserService()
 
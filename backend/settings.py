@@ -1,5 +1,6 @@
 import os
 import logging
+import tempfile
 
 
 def _getbool_from_str(s):
@@ -33,15 +34,172 @@ class Config:
     BLOB_STORE_URI = os.environ.get('BLOB_STORE_URI')
     BLOB_STORE_CREDENTIAL = os.environ.get('BLOB_STORE_CREDENTIAL')
     BLOB_STORE_CONTAINERS = [CONTAINER_ARTICLE_ASSETS]
-
+    # When to check the containers exist (creating missing ones): in the 
+    # background (once per process), at startup (blocking), or off when 
+    # provisioned beforehand with `manage.py provision`
+    BLOB_STORE_VERIFY_CONTAINERS = os.environ.get('BLOB_STORE_VERIFY_CONTAINERS', 'background')
+    # Uploads larger than a block are staged in parallel blocks, at most 
+    # BLOB_UPLOAD_MAX_CONCURRENCY per upload and BLOB_UPLOAD_POOL_SIZE in total
+    BLOB_UPLOAD_BLOCK_SIZE = int(os.environ.get('BLOB_UPLOAD_BLOCK_SIZE', 4 * 1024 * 1024))
+    BLOB_UPLOAD_MAX_CONCURRENCY = int(os.environ.get('BLOB_UPLOAD_MAX_CONCURRENCY', 4))
+    BLOB_UPLOAD_POOL_SIZE = int(os.environ.get('BLOB_UPLOAD_POOL_SIZE', 16))
+    # Name blobs after their content, so the same image uploaded again is 
+    # stored (and sent to Azure) once, see datastores.BlobStore
+    BLOB_CONTENT_ADDRESSED = _getbool_from_str(os.environ.get('BLOB_CONTENT_ADDRESSED', 'false'))
+    # Seconds that direct upload URLs (POST /api/articles/uploads) are valid
+    BLOB_UPLOAD_SAS_TTL = int(os.environ.get('BLOB_UPLOAD_SAS_TTL', 900))
+    # Number of article images uploaded concurrently by batch requests
+    BULK_UPLOAD_CONCURRENCY = int(os.environ.get('BULK_UPLOAD_CONCURRENCY', 8))
+    # Blobs of deleted rows are removed by a background worker, see 
+    # services.BlobDeletionQueue
+    BLOB_DELETE_WORKER = _getbool_from_str(os.environ.get('BLOB_DELETE_WORKER', 'true'))
+    BLOB_DELETE_BATCH_SIZE = int(os.environ.get('BLOB_DELETE_BATCH_SIZE', 1024))
+    # Batch delete requests (of up to 256 blobs) sent in parallel
+    BLOB_DELETE_CONCURRENCY = int(os.environ.get('BLOB_DELETE_CONCURRENCY', 4))
+    BLOB_DELETE_MAX_ATTEMPTS = int(os.environ.get('BLOB_DELETE_MAX_ATTEMPTS', 5))
+    BLOB_DELETE_POLL_INTERVAL = int(os.environ.get('BLOB_DELETE_POLL_INTERVAL', 30))
+
+    # Local disk cache of the blobs served by GET /api/articles/<id>/image,
+    # see blob_cache.BlobCache. Blobs never change, so clients may keep them
+    BLOB_CACHE_DIR = os.environ.get('BLOB_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'blob-cache'))
+    BLOB_CACHE_MAX_BYTES = int(os.environ.get('BLOB_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+    BLOB_CACHE_MAX_AGE = int(os.environ.get('BLOB_CACHE_MAX_AGE', 86400))
+
+    # Thumbnails and compressed variants of article images, generated in the 
+    # background (see images.ImagePipeline), needs Pillow
+    IMAGE_PIPELINE = _getbool_from_str(os.environ.get('IMAGE_PIPELINE', 'true'))
+    IMAGE_VARIANT_SIZES = [int(size) for size in 
+        os.environ.get('IMAGE_VARIANT_SIZES', '160,640').split(',')]
+    IMAGE_VARIANT_FORMATS = os.environ.get('IMAGE_VARIANT_FORMATS', 'webp,avif').split(',')
+    IMAGE_VARIANT_QUALITY = int(os.environ.get('IMAGE_VARIANT_QUALITY', 80))
+    IMAGE_PROCESS_WORKERS = int(os.environ.get('IMAGE_PROCESS_WORKERS', 2))
+
+    # Threads running background jobs (e.g, DELETE /api/users/<id>?async=1)
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+
+    # Production server, see server.py and `manage.py serve`. Workers 
+    # default to 2 per CPU plus one
+    SERVER_BIND = os.environ.get('SERVER_BIND', '0.0.0.0:8000')
+    SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', 0))
+    SERVER_THREADS = int(os.environ.get('SERVER_THREADS', 4))
+    # Workers are replaced after this many requests (give or take the 
+    # jitter, so they don't all restart at once), 0 to never replace them
+    SERVER_MAX_REQUESTS = int(os.environ.get('SERVER_MAX_REQUESTS', 10000))
+    SERVER_MAX_REQUESTS_JITTER = int(os.environ.get('SERVER_MAX_REQUESTS_JITTER', 1000))
+    SERVER_TIMEOUT = int(os.environ.get('SERVER_TIMEOUT', 60))
+    SERVER_GRACEFUL_TIMEOUT = int(os.environ.get('SERVER_GRACEFUL_TIMEOUT', 30))
+    SERVER_KEEPALIVE = int(os.environ.get('SERVER_KEEPALIVE', 5))
+
+    # Optional SQLAlchemy URI that replaces the SQL Server one built from 
+    # the DB_* settings below (e.g, sqlite:// for benchmarks)
+    DB_URI = os.environ.get('DB_URI', '')
     DB_DRIVER = '{ODBC Driver 17 for SQL Server}'
     DB_SERVER_PORT = 1433
     DB_DATABASE = os.environ.get('DB_DATABASE')
     DB_USERNAME = os.environ.get('DB_USERNAME')
     DB_PASSWORD = os.environ.get('DB_PASSWORD')
     DB_SERVER_HOST = os.environ.get('DB_SERVER_HOST')
+    # Read replicas, e.g Azure SQL geo-replicas, or the primary's host to 
+    # read from its readable secondary. Connected to with the DB_* settings
+    # above and ApplicationIntent=ReadOnly, or given as SQLAlchemy URIs
+    DB_REPLICA_HOSTS = [host for host in os.environ.get('DB_REPLICA_HOSTS', '').split(',') if host]
+    DB_REPLICA_URIS = [uri for uri in os.environ.get('DB_REPLICA_URIS', '').split(',') if uri]
+    # Seconds between health checks of the replicas, and that reads stay on
+    # the primary after a write, see datastores.ReplicaRouter
+    DB_REPLICA_CHECK_INTERVAL = int(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 10))
+    DB_REPLICA_STICKY_SECONDS = int(os.environ.get('DB_REPLICA_STICKY_SECONDS', 5))
     
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Connection pool per process (see datastores.Database), recycle 
+    # connections before Azure SQL drops them for being idle (30 mins)
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+    DB_POOL_MAX_OVERFLOW = int(os.environ.get('DB_POOL_MAX_OVERFLOW', 10))
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 10))
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1500))
+    DB_POOL_PRE_PING = _getbool_from_str(os.environ.get('DB_POOL_PRE_PING', 'true'))
+    # ODBC driver manager pooling, off since SQLAlchemy already pools
+    DB_ODBC_POOLING = _getbool_from_str(os.environ.get('DB_ODBC_POOLING', 'false'))
+    # Lets pyodbc send executemany parameters in one round trip
+    DB_FAST_EXECUTEMANY = _getbool_from_str(os.environ.get('DB_FAST_EXECUTEMANY', 'true'))
+    # Rows per INSERT/commit for batch requests (e.g, /api/users:batch)
+    BULK_CREATE_CHUNK_SIZE = int(os.environ.get('BULK_CREATE_CHUNK_SIZE', 1000))
+
+    # Read through cache for services.Service, one of: memory, redis, none
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+    CACHE_TTL = int(os.environ.get('CACHE_TTL', 30))
+    CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 1024))
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+
+    # Admission control of API routes by endpoint class (read, write, list,
+    # upload, export), see limits.Limiter. Rate limits per client are given as 
+    # class:tokens per second:burst (e.g, upload:1:10,list:5:20), none by default
+    RATE_LIMITS = {name: (float(rate), int(burst)) for name, rate, burst in 
+        (limit.split(':') for limit in os.environ.get('RATE_LIMITS', '').split(',') if limit)}
+    # Either memory (per process) or redis (shared, needs the redis package)
+    RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+    RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL', CACHE_REDIS_URL)
+    RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 10000))
+    # Clients sending one of RATE_LIMIT_API_KEYS (comma separated) in this 
+    # header are limited by key, others by address
+    RATE_LIMIT_KEY_HEADER = os.environ.get('RATE_LIMIT_KEY_HEADER', 'X-API-Key')
+    RATE_LIMIT_API_KEYS = frozenset(key for key in 
+        os.environ.get('RATE_LIMIT_API_KEYS', '').split(',') if key)
+    RATE_LIMIT_TRUST_PROXY = _getbool_from_str(os.environ.get('RATE_LIMIT_TRUST_PROXY', 'false'))
+    # Requests in flight per process, as class:limit. Past the limit requests
+    # wait up to CONCURRENCY_QUEUE_TIMEOUT seconds, then get a 503
+    CONCURRENCY_LIMITS = {name: int(limit) for name, limit in 
+        (limit.split(':') for limit in os.environ.get('CONCURRENCY_LIMITS', 'list:8,upload:8,export:2').split(',') if limit)}
+    CONCURRENCY_QUEUE_TIMEOUT = float(os.environ.get('CONCURRENCY_QUEUE_TIMEOUT', 0.5))
+    CONCURRENCY_RETRY_AFTER = int(os.environ.get('CONCURRENCY_RETRY_AFTER', 1))
+
+    # Encode JSON responses with orjson, when it's installed
+    JSON_FAST_ENCODER = _getbool_from_str(os.environ.get('JSON_FAST_ENCODER', 'true'))
+    # Lists with at least this many items are encoded as they're sent
+    JSON_STREAM_MIN_ITEMS = int(os.environ.get('JSON_STREAM_MIN_ITEMS', 1000))
+
+    # Negotiated br/zstd (when brotli/zstandard are installed) or gzip 
+    # compression of responses, see compression.Compression
+    COMPRESSION = _getbool_from_str(os.environ.get('COMPRESSION', 'true'))
+    COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+    COMPRESSION_MIMETYPES = os.environ.get('COMPRESSION_MIMETYPES', 
+        'application/json,application/x-ndjson,text/csv,text/plain').split(',')
+    COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+    COMPRESSION_BROTLI_LEVEL = int(os.environ.get('COMPRESSION_BROTLI_LEVEL', 4))
+    COMPRESSION_ZSTD_LEVEL = int(os.environ.get('COMPRESSION_ZSTD_LEVEL', 3))
+
+    # Per request latency and SQL metrics (see /metrics), and profiles of a 
+    # sample of requests kept when slower than PROFILE_THRESHOLD_MS
+    INSTRUMENTATION = _getbool_from_str(os.environ.get('INSTRUMENTATION', 'false'))
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    PROFILE_THRESHOLD_MS = int(os.environ.get('PROFILE_THRESHOLD_MS', 500))
+    PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+    # Either cprofile or pyinstrument (which has to be installed)
+    PROFILER = os.environ.get('PROFILER', 'cprofile')
+
+    # Backend of /api/articles/search, fulltext (SQL Server full-text index),
+    # terms (inverted index in article_terms) or auto, fulltext on SQL Server
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'auto')
+    # Words of a search past this many are ignored
+    SEARCH_MAX_TERMS = int(os.environ.get('SEARCH_MAX_TERMS', 8))
+
+    # Paging of list endpoints (e.g, /api/articles?limit=&after=)
+    API_PAGE_LIMIT = int(os.environ.get('API_PAGE_LIMIT', 50))
+    API_PAGE_LIMIT_MAX = int(os.environ.get('API_PAGE_LIMIT_MAX', 500))
+    # Number of rows fetched per round trip when streaming list endpoints
+    DB_STREAM_BATCH_SIZE = int(os.environ.get('DB_STREAM_BATCH_SIZE', 500))
+    # Article contents longer than this many characters are stored compressed
+    # in blob storage rather than inline (SQL Server keeps nvarchar values
+    # past 4000 characters off row anyway), 0 keeps them all inline
+    ARTICLE_CONTENT_OFFLOAD_LENGTH = int(os.environ.get('ARTICLE_CONTENT_OFFLOAD_LENGTH', 4000))
+    # Either zstd (needs the zstandard package), gzip or auto, zstd if installed
+    ARTICLE_CONTENT_CODEC = os.environ.get('ARTICLE_CONTENT_CODEC', 'auto')
+
+    # Rows per batch of exports (/api/export/<table>), each batch is fetched
+    # and encoded at once, and is a row group of Parquet exports
+    EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 10000))
+    # Incremental exports leave out rows added in the last seconds, which 
+    # should be longer than any transaction adding rows takes to commit
+    EXPORT_WATERMARK_LAG = int(os.environ.get('EXPORT_WATERMARK_LAG', 60))
 
     # Moved to app.py/create_config_only_app, when DB_* properties are 
     # being overwritten by local file, this breaks
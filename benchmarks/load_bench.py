@@ -0,0 +1,250 @@
+"""Load test of every API route, against an app backed by SQLite (or the
+database in DB_URI, e.g a local SQL Server container) and an in process
+fake blob store. Reports req/s, latency percentiles and peak RSS as JSON.
+
+    python -m benchmarks.load_bench --output results.json
+    python -m benchmarks.load_bench --baseline results.json  # fails on regressions
+"""
+import argparse
+import http.client
+import io
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from werkzeug.serving import make_server
+from tests.backend.helpers import FakeBlobStore
+
+
+class LatentBlobStore(FakeBlobStore):
+    """Fake blob store that takes `latency` seconds per call, like a remote one would."""
+    def __init__(self, latency):
+        super().__init__()
+        self.latency = latency
+        self._lock = threading.Lock()
+
+    def upload(self, *args, **kwargs):
+        time.sleep(self.latency)
+        with self._lock:
+            return super().upload(*args, **kwargs)
+
+    def delete_many(self, *args, **kwargs):
+        time.sleep(self.latency)
+        with self._lock:
+            return super().delete_many(*args, **kwargs)
+
+
+def multipart(fields, files):
+    """Encodes a multipart/form-data body, returns (body, content type)."""
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in fields.items():
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data) in files.items():
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n'.encode())
+        body.write(data + b'\r\n')
+    body.write(f'--{boundary}--\r\n'.encode())
+    return body.getvalue(), f'multipart/form-data; boundary={boundary}'
+
+
+def scenarios(args, user_ids, article_ids):
+    """Each scenario is (name, function of the request number returning
+    (method, path, body, headers)). New articles go to the first user, 
+    other users are updated, then deleted from the last one, so requests 
+    never touch a deleted row."""
+    image = os.urandom(args.image_kb * 1024)
+    users, articles = reversed(user_ids[1:]), iter(article_ids)
+    user_id = user_ids[0]
+
+    def create_article(i):
+        body, content_type = multipart(dict(user_id=user_id, title=f'Bench {i}', content='Lorem ipsum'),
+            dict(image=('image.png', image)))
+        return ('POST', '/api/articles', body, {'Content-Type': content_type})
+
+    def json_request(method, path, value):
+        return (method, path, json.dumps(value).encode(), {'Content-Type': 'application/json'})
+
+    return [
+        ('list_articles', lambda i: ('GET', '/api/articles', None, {})),
+        ('page_articles', lambda i: ('GET', '/api/articles?limit=50', None, {})),
+        ('stream_articles', lambda i: ('GET', '/api/articles?stream=1', None, {})),
+        ('create_article', create_article),
+        ('create_articles_batch', lambda i: json_request('POST', '/api/articles:batch',
+            [dict(user_id=user_id, title=f'Batch {i}.{n}') for n in range(args.batch_size)])),
+        ('delete_article', lambda i: ('DELETE', f'/api/articles/{next(articles)}', None, {})),
+        ('list_users', lambda i: ('GET', '/api/users', None, {})),
+        ('create_user', lambda i: json_request('POST', '/api/users',
+            dict(name=f'Bench {i}', email=f'{uuid.uuid4().hex}@acme.org'))),
+        ('create_users_batch', lambda i: json_request('POST', '/api/users:batch',
+            [dict(name=f'Batch {i}.{n}', email=f'{uuid.uuid4().hex}@acme.org') for n in range(args.batch_size)])),
+        ('update_user', lambda i: json_request('PUT', f'/api/users/{user_ids[1 + i % (len(user_ids) - 1)]}',
+            dict(name=f'Updated {i}'))),
+        ('delete_user', lambda i: ('DELETE', f'/api/users/{next(users)}', None, {})),
+    ]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def run_scenario(port, request_for, requests, concurrency):
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker():
+        nonlocal errors
+        while True:
+            with lock:
+                i = next(counter, None)
+                if i is None:
+                    return
+                method, path, body, headers = request_for(i)
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            start = time.perf_counter()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+                failed = resp.status >= 400
+            except (OSError, http.client.HTTPException):
+                failed = True
+            finally:
+                conn.close()
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                errors += failed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(worker)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    ms = lambda s: round(s * 1000, 2) if s is not None else None
+    return dict(requests=requests, errors=errors, req_per_sec=round(requests / elapsed, 1),
+        p50_ms=ms(percentile(latencies, 50)), p95_ms=ms(percentile(latencies, 95)),
+        p99_ms=ms(percentile(latencies, 99)),
+        # Peak of the whole process so far, which includes the app
+        peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1))
+
+
+def seed(app, users, articles):
+    from backend.datastores import db
+    from backend.models import Article, User
+    with app.app_context():
+        db.create_all()
+        db.session.bulk_insert_mappings(User, [dict(name=f'User {i}', email=f'user{i}@acme.org')
+            for i in range(users)])
+        user_ids = [id for (id,) in db.session.query(User.id).order_by(User.id)]
+        db.session.bulk_insert_mappings(Article, [dict(title=f'Article {i}', content='Lorem ipsum ' * 50,
+            user_id=user_ids[i % users], image_filename=f'{i}.png') for i in range(articles)])
+        db.session.commit()
+        article_ids = [id for (id,) in db.session.query(Article.id).order_by(Article.id.desc())]
+    return user_ids, article_ids
+
+
+def compare(results, baseline, tolerance):
+    """Returns the regressions of results against a baseline report."""
+    regressions = []
+    for name, result in results['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if not base:
+            continue
+        if result['req_per_sec'] < base['req_per_sec'] * (1 - tolerance):
+            regressions.append(f"{name}: {result['req_per_sec']} req/s, was {base['req_per_sec']}")
+        if base['p95_ms'] and result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {result['p95_ms']}ms, was {base['p95_ms']}ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--articles', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=100, help='rows per batch request')
+    parser.add_argument('--image-kb', type=int, default=256)
+    parser.add_argument('--blob-latency-ms', type=float, default=20)
+    parser.add_argument('--only', nargs='*', help='scenarios to run, defaults to all')
+    parser.add_argument('--output', help='file to write the JSON report to')
+    parser.add_argument('--baseline', help='report to compare with, exits 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+    blob_store = LatentBlobStore(args.blob_latency_ms / 1000)
+    with mock.patch('backend.datastores.blob_store', blob_store), \
+            mock.patch('backend.services.blob_store', blob_store), \
+            mock.patch('backend.images.blob_store', blob_store), \
+            mock.patch('backend.blob_cache.blob_store', blob_store), \
+            mock.patch('backend.contents.blob_store', blob_store):
+        from backend import images
+        from backend.app import create_app
+        app = create_app()
+        app.debug = False
+        # Uploaded images are random bytes, there's nothing to render
+        images.image_pipeline.enabled = False
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        # Unless DB_URI says otherwise, use a throwaway SQLite database
+        if not app.config['DB_URI']:
+            app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_file}'
+        user_ids, article_ids = seed(app, args.users, args.articles)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            results = {}
+            for name, request_for in scenarios(args, user_ids, article_ids):
+                if args.only and name not in args.only:
+                    continue
+                # Deletes can only run as many times as there are rows
+                requests = args.requests
+                if name == 'delete_user':
+                    requests = min(requests, len(user_ids) - 1)
+                if name == 'delete_article':
+                    requests = min(requests, len(article_ids))
+                results[name] = run_scenario(server.port, request_for, requests, args.concurrency)
+                print(f'{name}: {results[name]}', file=sys.stderr)
+        finally:
+            server.shutdown()
+            os.unlink(db_file)
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    report = dict(commit=commit, db=app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0],
+        config=vars(args), scenarios=results)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'Regression, {regression}', file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
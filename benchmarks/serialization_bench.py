@@ -0,0 +1,56 @@
+"""Compares serializing the articles list the old way (models, `as_dict`
+and `jsonify`) with rows and `serializers.encoder`.
+
+    python -m benchmarks.serialization_bench [rows]
+"""
+import json
+import sys
+import time
+
+from datetime import datetime
+from flask import jsonify
+from backend import datastores, serializers
+from backend.app import create_config_only_app
+from backend.models import Article, User
+from backend.services import article_service
+
+
+def timed(f, repeat=5):
+    """Best of `repeat` runs, in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, body
+
+
+def main(rows=20000):
+    app = create_config_only_app()
+    app.debug = False
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    datastores.db.init_app(app)
+    serializers.encoder.init_app(app)
+
+    with app.test_request_context():
+        datastores.db.create_all()
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        datastores.db.session.bulk_insert_mappings(Article, [dict(title=f'Article {i}',
+            content='Lorem ipsum ' * 20, user_id=user.id, image_filename=f'{i}.png',
+            created_at=datetime.utcnow()) for i in range(rows)])
+        datastores.db.session.commit()
+
+        baseline, expected = timed(
+            lambda: jsonify([a.as_dict() for a in Article.query.all()]).get_data())
+        fast, actual = timed(
+            lambda: serializers.encoder.response(article_service.all_dicts()).get_data())
+        assert actual == expected, 'Output differs from jsonify'
+
+    print(json.dumps(dict(rows=rows, orjson=serializers.encoder.enabled,
+        baseline_rows_per_sec=round(rows / baseline), fast_rows_per_sec=round(rows / fast),
+        speedup=round(baseline / fast, 2)), indent=2))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
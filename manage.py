@@ -2,11 +2,18 @@
 python manage.py db init (run once to initialize alembic work directory)
 python manage.py db migrate
 python manage.py db upgrade
+python manage.py provision (creates the blob containers)
+python manage.py serve (production server, see backend/server.py)
+python manage.py reindex (rebuilds the article search index, SQL Server's only needs it after upgrading)
+python manage.py offload-content (moves long article contents to blob storage, after upgrading)
+python manage.py export articles -f parquet -o articles.parquet [--since <watermark>]
 """
-from flask_script import Manager
+import sys
+
+from flask_script import Command, Manager, Option
 from flask_migrate import Migrate, MigrateCommand, migrate
 # Note models needs to be import so migration can detect tables defs
-from backend import app, services, models
+from backend import app, datastores, services, models
 
 
 app = app.create_config_only_app()
@@ -17,5 +24,93 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+class Provision(Command):
+    """Creates any missing blob containers, so app processes can skip
+    checking them (BLOB_STORE_VERIFY_CONTAINERS=off)."""
+    def run(self):
+        app.config['BLOB_STORE_VERIFY_CONTAINERS'] = 'off'
+        datastores.blob_store.init_app(app)
+        datastores.blob_store.init_containers()
+
+
+class Serve(Command):
+    """Runs the app with the production server, see backend/server.py."""
+    option_list = (
+        Option('-b', '--bind', help='address to listen on, e.g 0.0.0.0:8000'),
+        Option('-w', '--workers', type=int, help='defaults to 2 per CPU plus one'),
+        Option('-t', '--threads', type=int, help='threads per worker'))
+
+    def run(self, bind, workers, threads):
+        from backend.app import create_app
+        from backend.server import serve
+        serve(create_app(), bind=bind, workers=workers, threads=threads)
+
+
+class Reindex(Command):
+    """Indexes all articles for search anew, see backend/search.py."""
+    def run(self):
+        from backend.contents import content_store
+        from backend.search import search_index
+        # Offloaded contents are read from blob storage
+        datastores.blob_store.init_app(app)
+        content_store.init_app(app)
+        search_index.init_app(app)
+        with app.app_context():
+            print(f'Indexed {search_index.rebuild()} articles')
+
+
+class OffloadContent(Command):
+    """Moves the contents of existing articles longer than
+    ARTICLE_CONTENT_OFFLOAD_LENGTH to blob storage, in batches, see
+    backend/contents.py. It can be stopped and run again."""
+    option_list = (
+        Option('-b', '--batch-size', type=int, default=100, help='articles per commit'),)
+
+    def run(self, batch_size):
+        from backend.contents import content_store
+        datastores.blob_store.init_app(app)
+        content_store.init_app(app)
+        with app.app_context():
+            print(f'Moved the contents of {content_store.offload_existing(batch_size)} articles')
+
+
+class Export(Command):
+    """Exports a table (users or articles) as NDJSON, CSV or Parquet, only
+    the rows added since the given watermark of a previous export, which
+    is printed to stderr once done. See backend/export.py."""
+    option_list = (
+        Option('table', help='users or articles'),
+        Option('-f', '--format', default='ndjson', help='ndjson, csv or parquet'),
+        Option('-o', '--output', help='file to write to, defaults to stdout'),
+        Option('-s', '--since', help='watermark of a previous export'))
+
+    def run(self, table, format, output, since):
+        from backend.contents import content_store
+        from backend.export import exporter
+        from backend.serializers import encoder
+        # Offloaded contents are read from blob storage
+        datastores.blob_store.init_app(app)
+        content_store.init_app(app)
+        exporter.init_app(app)
+        encoder.init_app(app)
+        with app.app_context():
+            watermark, chunks = exporter.export(table, format, since)
+            out = open(output, 'wb') if output else sys.stdout.buffer
+            try:
+                for chunk in chunks:
+                    out.write(chunk)
+            finally:
+                if output:
+                    out.close()
+        print(f'Watermark: {watermark}', file=sys.stderr)
+
+
+manager.add_command('provision', Provision())
+manager.add_command('serve', Serve())
+manager.add_command('reindex', Reindex())
+manager.add_command('offload-content', OffloadContent())
+manager.add_command('export', Export())
+
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
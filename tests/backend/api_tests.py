@@ -0,0 +1,422 @@
+import io
+import json
+import time
+import unittest
+
+from datetime import datetime, timedelta
+from unittest import mock
+from backend.datastores import db
+from backend import services
+from backend.models import User, Article, BlobDeletion, BlobRef, UploadClaim
+from backend.services import article_service, blob_deletion_queue
+from tests.backend.helpers import AppTestCase
+
+
+class ApiTestCase(AppTestCase):
+    def seed_articles(self, n):
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        now = datetime(2020, 12, 11)
+        # Every other pair shares a created_at, to exercise the id tie breaker
+        for i in range(n):
+            db.session.add(Article(title=f'title {i}', user_id=user.id,
+                created_at=now + timedelta(seconds=i // 2)))
+        db.session.commit()
+        return user
+
+
+class ListArticlesTests(ApiTestCase):
+    def test_list_all(self):
+        self.seed_articles(3)
+        resp = self.client.get('/api/articles')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.get_json()), 3)
+
+    def test_paginate(self):
+        self.seed_articles(7)
+        titles, after = [], ''
+        while True:
+            resp = self.client.get(f'/api/articles?limit=3&after={after}')
+            self.assertEqual(resp.status_code, 200)
+            page = resp.get_json()
+            self.assertLessEqual(len(page['items']), 3)
+            titles += [a['title'] for a in page['items']]
+            if page['next'] is None:
+                break
+            after = page['next']
+        self.assertEqual(titles, [f'title {i}' for i in range(7)])
+
+    def test_paginate_invalid_cursor(self):
+        resp = self.client.get('/api/articles?after=garbage')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_stream(self):
+        self.seed_articles(5)
+        resp = self.client.get('/api/articles?stream=1')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([a['title'] for a in resp.get_json()],
+            [f'title {i}' for i in range(5)])
+
+    def test_filter_sort_and_fields(self):
+        user = self.seed_articles(6)
+        other = User.create(name='Daryl One', email='one@acme.org')
+        Article.create(title='other', user_id=other.id, created_at=datetime(2020, 12, 11))
+        resp = self.client.get(f'/api/articles?user_id={user.id}&sort=-created_at'
+            '&created_after=2020-12-11T00:00:01&fields=title,image_variants')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json(), [dict(title=f'title {i}', image_variants=None) 
+            for i in (5, 4, 3, 2)])
+
+    def test_paginate_sorted_descending(self):
+        self.seed_articles(7)
+        titles, after = [], ''
+        while after is not None:
+            page = self.client.get(f'/api/articles?limit=2&sort=-created_at&fields=title'
+                f'&after={after}').get_json()
+            self.assertEqual([list(a) for a in page['items']], [['title']] * len(page['items']))
+            titles += [a['title'] for a in page['items']]
+            after = page['next']
+        self.assertEqual(titles, [f'title {i}' for i in reversed(range(7))])
+
+    def test_invalid_list_options(self):
+        for query in ('sort=title', 'fields=id,nope', 'user_id=one', 'created_before=today'):
+            self.assertEqual(self.client.get(f'/api/articles?{query}').status_code, 400, query)
+
+    def test_users_by_email_prefix(self):
+        User.create(name='a', email='a_1@acme.org')
+        User.create(name='b', email='ab@acme.org')
+        resp = self.client.get('/api/users?email_prefix=a_&fields=email')
+        self.assertEqual(resp.get_json(), [dict(email='a_1@acme.org')])
+
+
+class ConditionalRequestTests(ApiTestCase):
+    def test_not_modified_until_changed(self):
+        self.seed_articles(2)
+        resp = self.client.get('/api/articles')
+        etag = resp.headers['ETag']
+        self.assertIsNotNone(resp.headers.get('Last-Modified'))
+
+        with mock.patch('backend.services.ArticleService.all', side_effect=AssertionError):
+            resp = self.client.get('/api/articles', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        # Other representations of the collection have their own ETag
+        resp = self.client.get('/api/articles?limit=1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+
+        article = Article.query.first()
+        self.client.delete(f'/api/articles/{article.id}')
+        resp = self.client.get('/api/articles', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_bulk_changes_bump_version(self):
+        resp = self.client.get('/api/users')
+        etag = resp.headers['ETag']
+        self.client.post('/api/users:batch', json=[dict(name='a', email='a@acme.org')])
+        resp = self.client.get('/api/users', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.get_json()), 1)
+
+
+    def test_changes_made_by_other_processes_are_listed(self):
+        self.client.get('/api/users')
+        resp = self.client.get('/api/users')
+        etag = resp.headers['ETag']
+        # Straight to the database, so this process's cache isn't invalidated
+        User.create(name='a', email='a@acme.org')
+        resp = self.client.get('/api/users', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        self.assertEqual(len(resp.get_json()), 1)
+
+
+class DirectUploadTests(ApiTestCase):
+    def test_create_article_from_direct_upload(self):
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        upload = self.client.post('/api/articles/uploads', json=dict(filename='a.png')).get_json()
+        self.assertIn('?', upload['upload_url'])
+
+        article = dict(user_id=user.id, title='a', upload_token=upload['upload_token'])
+        resp = self.client.post('/api/articles', json=article)
+        self.assertEqual(resp.get_json(), dict(error='Image was not uploaded'))
+
+        # The client uploads to upload_url, straight to blob storage
+        blob_filename = upload['upload_url'].split('/')[-1].split('?')[0]
+        self.blob_store.blobs[('articleassets', blob_filename)] = b'png'
+        resp = self.client.post('/api/articles', json=article)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['image_filename'], blob_filename)
+
+        resp = self.client.post('/api/articles', json=article)
+        self.assertEqual(resp.get_json(), dict(error='upload_token was already used'))
+
+    def test_concurrent_uses_of_a_token_create_one_article(self):
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        upload = self.client.post('/api/articles/uploads', json=dict(filename='a.png')).get_json()
+        blob_filename = upload['upload_url'].split('/')[-1].split('?')[0]
+        self.blob_store.blobs[('articleassets', blob_filename)] = b'png'
+        article = dict(user_id=user.id, title='a', upload_token=upload['upload_token'])
+        # Both requests got past the fast check before either committed
+        with mock.patch.object(UploadClaim, 'query') as query:
+            query.get.return_value = None
+            statuses = [self.client.post('/api/articles', json=article).status_code for _ in range(2)]
+        self.assertEqual(statuses, [200, 400])
+        self.assertEqual(Article.query.filter_by(image_filename=blob_filename).count(), 1)
+
+    def test_invalid_upload_token(self):
+        resp = self.client.post('/api/articles', json=dict(user_id=1, title='a', upload_token='x'))
+        self.assertEqual(resp.status_code, 400)
+
+
+class CreateTests(ApiTestCase):
+    def upload_later(self, events, error=None):
+        """Patches uploads to finish when they're waited on, recording it
+        in events, failing with error if given."""
+        upload_async = self.blob_store.upload_async
+        def upload_later(container_name, file, blob_filename=None):
+            filename, future = upload_async(container_name, file, blob_filename)
+            result = future.result
+            def wait(*args):
+                events.append('wait')
+                if error:
+                    raise error
+                return result(*args)
+            future.result = wait
+            future.exception = lambda *args: error
+            return (filename, future)
+        return mock.patch.object(self.blob_store, 'upload_async', side_effect=upload_later)
+
+    def test_article_is_committed_while_the_image_uploads(self):
+        user_id = User.create(name='Daryl Zero', email='daryl@acme.org').id
+        events = []
+        commit = db.session.commit
+        def record_commit():
+            events.append('commit')
+            commit()
+        with self.upload_later(events), \
+                mock.patch.object(db.session, 'commit', side_effect=record_commit):
+            resp = self.client.post('/api/articles', data=dict(user_id=user_id, title='title',
+                image=(io.BytesIO(b'png'), 'a.png')))
+        self.assertEqual(resp.status_code, 200)
+        # In one short transaction, done by the time the upload is waited on
+        self.assertEqual(events, ['commit', 'wait'])
+
+    def test_article_is_deleted_when_its_upload_fails(self):
+        user_id = User.create(name='Daryl Zero', email='daryl@acme.org').id
+        with self.upload_later([], error=IOError('unreachable')):
+            with self.assertRaises(IOError):
+                self.client.post('/api/articles', data=dict(user_id=user_id, title='title',
+                    image=(io.BytesIO(b'png'), 'a.png')))
+        self.assertEqual(Article.query.count(), 0)
+        self.assertEqual(BlobDeletion.query.count(), 1)
+
+    def test_internal_columns_cannot_be_set_by_clients(self):
+        user_id = User.create(name='Daryl Zero', email='daryl@acme.org').id
+        victim = self.client.post('/api/articles', data=dict(user_id=user_id, title='victim',
+            image=(io.BytesIO(b'png'), 'a.png'))).get_json()
+        internal = dict(id=99, content_blob=victim['image_filename'], content_words='x',
+            image_filename=victim['image_filename'], image_variants='160.webp')
+        resp = self.client.post('/api/articles', json=dict(user_id=user_id, title='a', **internal))
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.post('/api/articles:batch', json=[dict(user_id=user_id, title='b', **internal)])
+        self.assertEqual(resp.get_json(), dict(created=1, errors=[]))
+        for title in ('a', 'b'):
+            article = Article.query.filter_by(title=title).one()
+            self.assertNotEqual(article.id, 99)
+            self.assertEqual((article.content_blob, article.content_words, article.image_filename,
+                article.image_variants), (None, None, None, None))
+            self.client.delete(f'/api/articles/{article.id}')
+        # So deleting them never deletes another article's blobs
+        self.assertEqual(BlobDeletion.query.count(), 0)
+        self.assertEqual(len(self.blob_store.blobs), 1)
+
+
+class DeleteTests(ApiTestCase):
+    def create_article(self, user):
+        resp = self.client.post('/api/articles', content_type='multipart/form-data',
+            data=dict(user_id=user.id, title='title', image=(io.BytesIO(b'png'), 'a.png')))
+        self.assertEqual(resp.status_code, 200)
+        return resp.get_json()
+
+    def test_delete_article_defers_blob_deletion(self):
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        article = self.create_article(user)
+        self.assertEqual(self.client.delete(f'/api/articles/{article["id"]}').status_code, 204)
+        self.assertIsNone(Article.get(article['id']))
+        self.assertEqual(len(self.blob_store.blobs), 1)
+        self.assertEqual(BlobDeletion.query.count(), 1)
+
+        self.assertEqual(blob_deletion_queue.drain(), 1)
+        self.assertEqual(self.blob_store.blobs, {})
+        self.assertEqual(BlobDeletion.query.count(), 0)
+
+    def test_delete_user_queues_article_blobs(self):
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        for _ in range(3):
+            self.create_article(user)
+        self.assertEqual(self.client.delete(f'/api/users/{user.id}').status_code, 204)
+        self.assertEqual(Article.query.count(), 0)
+        self.assertEqual(BlobDeletion.query.count(), 3)
+
+        self.assertEqual(blob_deletion_queue.drain(), 3)
+        self.assertEqual(self.blob_store.blobs, {})
+
+    def test_delete_user_async(self):
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        for _ in range(3):
+            self.create_article(user)
+        user_id = user.id
+        resp = self.client.delete(f'/api/users/{user_id}?async=1')
+        self.assertEqual(resp.status_code, 202)
+        status_url = resp.headers['Location']
+        self.assertEqual(resp.get_json()['status_url'], status_url)
+
+        for _ in range(100):
+            job = self.client.get(status_url).get_json()
+            if job['status'] in ('done', 'failed'):
+                break
+            time.sleep(0.01)
+        self.assertEqual(job['status'], 'done')
+        self.assertIsNone(User.query.get(user_id))
+        self.assertEqual(Article.query.count(), 0)
+        self.assertEqual(BlobDeletion.query.count(), 3)
+        self.assertEqual(self.client.get('/api/jobs/nope').status_code, 404)
+
+    def test_drain_sends_parallel_batches(self):
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        Article.bulk_create([dict(user_id=user.id, title=str(i), image_filename=f'{i}.png')
+            for i in range(300)])
+        self.client.delete(f'/api/users/{user.id}')
+        with mock.patch.object(self.blob_store, 'delete_many', 
+                wraps=self.blob_store.delete_many) as delete_many:
+            self.assertEqual(blob_deletion_queue.drain(), 300)
+        self.assertEqual(sorted(len(c.args[1]) for c in delete_many.call_args_list), [44, 256])
+
+    def test_failed_blob_deletion_is_retried(self):
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        article = self.create_article(user)
+        self.client.delete(f'/api/articles/{article["id"]}')
+        with mock.patch.object(self.blob_store, 'delete_many', side_effect=IOError):
+            self.assertEqual(blob_deletion_queue.drain(), 0)
+        self.assertEqual(BlobDeletion.query.one().attempts, 1)
+        self.assertEqual(blob_deletion_queue.drain(), 1)
+
+
+class ContentAddressedTests(ApiTestCase):
+    create_article = DeleteTests.create_article
+
+    def setUp(self):
+        super().setUp()
+        self.blob_store.content_addressed = True
+
+    def test_same_image_is_stored_once(self):
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        first, second = self.create_article(user), self.create_article(user)
+        self.assertEqual(first['image_filename'], second['image_filename'])
+        self.assertEqual(len(first['image_filename']), len('0' * 32 + '.png'))
+        self.assertEqual(self.blob_store.uploads, 1)
+        self.assertEqual(BlobRef.query.one().refs, 2)
+
+    def test_reference_is_committed_before_the_upload_is_skipped(self):
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        self.create_article(user)
+        refs = []
+        def exists(container_name, blob_filename):
+            # Or the blob could be deleted along with the first article
+            refs.append(db.session.query(BlobRef.refs).scalar())
+            return True
+        with mock.patch.object(self.blob_store, 'exists', side_effect=exists):
+            self.create_article(user)
+        self.assertEqual(refs, [2])
+
+    def test_reference_is_released_when_the_article_is_not_created(self):
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        self.create_article(user)
+        with mock.patch('backend.services.search_index.add', side_effect=ValueError('Nope')):
+            # A server error, not the client's
+            with self.assertRaises(ValueError):
+                self.client.post('/api/articles', content_type='multipart/form-data',
+                    data=dict(user_id=user.id, title='title', image=(io.BytesIO(b'png'), 'a.png')))
+        self.assertEqual(BlobRef.query.one().refs, 1)
+        self.assertEqual(BlobDeletion.query.count(), 0)
+
+    def test_concurrent_first_references_are_counted(self):
+        BlobRef.acquire('assets', ['a.png'])
+        execute = db.session.execute
+        def racing_execute(statement, *args, **kwargs):
+            if racing_execute.update:
+                # The update ran before the other acquire inserted the row
+                racing_execute.update = False
+                return mock.Mock(rowcount=0)
+            return execute(statement, *args, **kwargs)
+        racing_execute.update = True
+        with mock.patch.object(db.session, 'execute', side_effect=racing_execute):
+            BlobRef.acquire('assets', ['a.png'])
+        db.session.commit()
+        self.assertEqual(BlobRef.query.one().refs, 2)
+
+    def test_blob_is_deleted_with_its_last_article(self):
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        first, second = self.create_article(user), self.create_article(user)
+        self.client.delete(f'/api/articles/{first["id"]}')
+        self.assertEqual(BlobDeletion.query.count(), 0)
+        self.client.delete(f'/api/articles/{second["id"]}')
+        self.assertEqual(BlobRef.query.count(), 0)
+        self.assertEqual(blob_deletion_queue.drain(), 1)
+        self.assertEqual(self.blob_store.blobs, {})
+
+    def test_blob_used_again_is_not_deleted(self):
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        article = self.create_article(user)
+        self.client.delete(f'/api/articles/{article["id"]}')
+        # Reposted before the queue got to it
+        self.create_article(user)
+        self.assertEqual(blob_deletion_queue.drain(), 1)
+        self.assertEqual(len(self.blob_store.blobs), 1)
+        self.assertEqual(BlobDeletion.query.count(), 0)
+
+    def test_variants_are_shared(self):
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        first = self.create_article(user)
+        article_service._record_variants(first['image_filename'], ['160.webp'])
+        with mock.patch.object(services.image_pipeline, 'submit') as submit:
+            second = self.create_article(user)
+        submit.assert_not_called()
+        self.assertEqual(Article.get(second['id']).image_variants, '160.webp')
+
+
+class BatchTests(ApiTestCase):
+    def test_create_users_batch(self):
+        users = [dict(name=f'user {i}', email=f'{i}@acme.org') for i in range(5)]
+        users[2] = dict(name='no email')
+        users[3]['email'] = users[0]['email']
+        with mock.patch.dict(self.app.config, BULK_CREATE_CHUNK_SIZE=2):
+            resp = self.client.post('/api/users:batch', json=users)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['created'], 3)
+        self.assertEqual([e['index'] for e in resp.get_json()['errors']], [2, 3])
+        self.assertEqual(User.query.count(), 3)
+
+    def test_create_users_batch_ndjson(self):
+        lines = '{"name": "a", "email": "a@acme.org"}\nnot json\n{"name": "b", "email": "b@acme.org"}\n'
+        resp = self.client.post('/api/users:batch', data=lines, 
+            content_type='application/x-ndjson')
+        self.assertEqual(resp.get_json(), dict(created=2, 
+            errors=[dict(index=1, error='Invalid row')]))
+
+    def test_create_articles_batch_with_images(self):
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        articles = [dict(user_id=user.id, title='a', image='f0'), 
+            dict(user_id=user.id, title='b'),
+            dict(user_id=user.id, title='c', image='missing')]
+        resp = self.client.post('/api/articles:batch', content_type='multipart/form-data',
+            data=dict(articles=json.dumps(articles), f0=(io.BytesIO(b'png'), 'a.png')))
+        self.assertEqual(resp.get_json(), dict(created=2, 
+            errors=[dict(index=2, error='Missing image file')]))
+        self.assertEqual(len(self.blob_store.blobs), 1)
+        self.assertIsNotNone(Article.query.filter_by(title='a').one().image_filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
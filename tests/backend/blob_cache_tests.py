@@ -0,0 +1,93 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from backend.blob_cache import blob_cache
+from tests.backend.helpers import AppTestCase
+
+
+class BlobCacheTests(AppTestCase):
+    config = dict(BLOB_CACHE_DIR=tempfile.mkdtemp(), BLOB_CACHE_MAX_BYTES=25)
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(shutil.rmtree, self.app.config['BLOB_CACHE_DIR'], ignore_errors=True)
+        user = self.client.post('/api/users', json=dict(name='Jane', email='jane@acme.org')).get_json()
+        self.article = self.client.post('/api/articles', data=dict(user_id=user['id'], title='Hello',
+            image=(io.BytesIO(b'0123456789'), 'image.png'))).get_json()
+        self.url = f"/api/articles/{self.article['id']}/image"
+
+    def test_image_is_fetched_once_then_served_from_disk(self):
+        with mock.patch.object(self.blob_store, 'download_to', wraps=self.blob_store.download_to) as download:
+            for _ in range(2):
+                resp = self.client.get(self.url)
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.get_data(), b'0123456789')
+                resp.close()
+        self.assertEqual(download.call_count, 1)
+        self.assertEqual(resp.mimetype, 'image/png')
+        self.assertEqual(resp.headers['ETag'], f'"{self.article["image_filename"]}"')
+        self.assertIn('max-age=86400', resp.headers['Cache-Control'])
+
+    def test_range_and_conditional_requests(self):
+        resp = self.client.get(self.url, headers={'Range': 'bytes=2-4'})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.get_data(), b'234')
+        self.assertEqual(resp.headers['Content-Range'], 'bytes 2-4/10')
+        resp.close()
+        resp = self.client.get(self.url, headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.get_data(), b'')
+
+    def test_missing_images_and_variants(self):
+        self.assertEqual(self.client.get(f'{self.url}?variant=160.webp').status_code, 404)
+        self.assertEqual(self.client.get('/api/articles/999/image').status_code, 404)
+        self.blob_store.blobs.clear()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_blob_evicted_before_it_is_opened_is_fetched_again(self):
+        get = blob_cache.get
+        def evicted_get(container_name, blob_filename):
+            path = get(container_name, blob_filename)
+            # Only the first lookup races with an eviction
+            if lookup.call_count == 1:
+                os.remove(path)
+            return path
+        with mock.patch.object(blob_cache, 'get', side_effect=evicted_get) as lookup:
+            resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_data(), b'0123456789')
+        resp.close()
+
+    def test_concurrent_misses_fetch_once(self):
+        started = threading.Event()
+        def download_to(container_name, blob_filename, file):
+            started.set()
+            time.sleep(0.05)
+            file.write(b'data')
+        self.blob_store.download_to = mock.Mock(side_effect=download_to)
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            paths = set(executor.map(lambda _: blob_cache.get('assets', 'cold.png'), range(100)))
+        self.assertEqual(len(paths), 1)
+        self.assertEqual(self.blob_store.download_to.call_count, 1)
+
+    def test_least_recently_used_blobs_are_evicted(self):
+        self.blob_store.download_to = lambda container_name, blob_filename, file: file.write(b'x' * 10)
+        first = blob_cache.get('assets', 'first')
+        second = blob_cache.get('assets', 'second')
+        os.utime(first, (0, 0))
+        os.utime(second, (1, 1))
+        blob_cache.get('assets', 'second')
+        blob_cache.get('assets', 'third')
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+
+
+if __name__ == '__main__':
+    unittest.main()
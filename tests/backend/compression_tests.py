@@ -0,0 +1,46 @@
+import gzip
+import unittest
+
+from unittest import mock
+from backend.models import User
+from tests.backend.helpers import AppTestCase
+
+
+class CompressionTests(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(50):
+            User.create(name=f'user {i}', email=f'{i}@acme.org')
+
+    def test_gzip_when_accepted(self):
+        plain = self.client.get('/api/users')
+        resp = self.client.get('/api/users', headers={'Accept-Encoding': 'br;q=0, gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(gzip.decompress(resp.get_data()), plain.get_data())
+        self.assertLess(int(resp.headers['Content-Length']), len(plain.get_data()))
+
+    def test_not_compressed_when_refused_or_small(self):
+        resp = self.client.get('/api/users', headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        resp = self.client.get('/api/users?fields=id&limit=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_streamed_list_is_compressed_incrementally(self):
+        plain = self.client.get('/api/users?stream=1').get_data()
+        with mock.patch.dict(self.app.config, DB_STREAM_BATCH_SIZE=10):
+            resp = self.client.get('/api/users?stream=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', resp.headers)
+        self.assertEqual(gzip.decompress(resp.get_data()), plain)
+
+    def test_compressed_etag_is_weak_and_revalidates(self):
+        resp = self.client.get('/api/users', headers={'Accept-Encoding': 'gzip'})
+        self.assertTrue(resp.headers['ETag'].startswith('W/'))
+        resp = self.client.get('/api/users', headers={'Accept-Encoding': 'gzip',
+            'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status_code, 304)
+
+
+if __name__ == '__main__':
+    unittest.main()
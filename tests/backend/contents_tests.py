@@ -0,0 +1,104 @@
+import gzip
+import unittest
+
+from unittest import mock
+from backend.contents import content_store
+from backend.models import Article, User
+from backend.search import search_index
+from backend.services import blob_deletion_queue
+from tests.backend.helpers import AppTestCase
+
+
+class ContentTests(AppTestCase):
+    config = dict(ARTICLE_CONTENT_OFFLOAD_LENGTH=20, ARTICLE_CONTENT_CODEC='gzip')
+    long_content = 'Deploying Flask to Azure, ' * 4
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.create(name='Jane', email='jane@acme.org')
+
+    def create(self, content):
+        resp = self.client.post('/api/articles', json=dict(user_id=self.user.id,
+            title='Hello', content=content))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['content'], content)
+        return resp.get_json()['id']
+
+    def test_long_contents_are_stored_compressed_in_blobs(self):
+        id = self.create(self.long_content)
+        article = Article.get(id)
+        self.assertIsNone(article.content)
+        self.assertTrue(article.content_blob.endswith('.gz'))
+        data = self.blob_store.download(content_store.container_name, article.content_blob)
+        self.assertEqual(gzip.decompress(data).decode(), self.long_content)
+
+        resp = self.client.get(f'/api/articles/{id}').get_json()
+        self.assertEqual(resp['content'], self.long_content)
+        self.assertNotIn('content_blob', resp)
+        self.assertEqual(self.client.get('/api/articles/999').status_code, 404)
+
+    def test_offloaded_contents_keep_their_words_for_full_text_search(self):
+        id = self.create(self.long_content)
+        self.assertEqual(Article.get(id).content_words, 'deploying flask to azure')
+        self.assertNotIn('content_words', self.client.get(f'/api/articles/{id}').get_json())
+        # Those offloaded before are filled in by a rebuild
+        Article.query.update(dict(content_words=None))
+        with mock.patch.object(search_index, '_backend', 'fulltext'):
+            self.assertEqual(search_index.rebuild(), 1)
+        self.assertEqual(Article.get(id).content_words, 'deploying flask to azure')
+
+    def test_contents_are_not_stored_for_articles_that_cannot_be_created(self):
+        resp = self.client.post('/api/articles', json=dict(user_id=self.user.id,
+            title='Hello', content=self.long_content, upload_token='x'))
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(self.blob_store.blobs, {})
+
+    def test_short_contents_stay_inline(self):
+        id = self.create('Short')
+        self.assertEqual(Article.get(id).content, 'Short')
+        self.assertIsNone(Article.get(id).content_blob)
+        self.assertEqual(self.blob_store.blobs, {})
+
+    def test_lists_are_metadata_only(self):
+        self.create(self.long_content)
+        self.create('Short')
+        for query in ['', '?limit=10', '?stream=1']:
+            resp = self.client.get(f'/api/articles{query}').get_json()
+            items = resp['items'] if isinstance(resp, dict) else resp
+            self.assertEqual(len(items), 2)
+            self.assertTrue(all('content' not in item and 'title' in item for item in items))
+        self.assertEqual(self.client.get('/api/articles?fields=id,content').status_code, 400)
+        self.assertNotIn('content', self.client.get('/api/articles/search?q=hello').get_json()['items'][0])
+
+    def test_batches_offload_and_index_contents(self):
+        resp = self.client.post('/api/articles:batch', json=[
+            dict(user_id=self.user.id, title='Batch', content=self.long_content),
+            dict(user_id=self.user.id, title='Batch', content='Short')])
+        self.assertEqual(resp.get_json()['created'], 2)
+        self.assertEqual(Article.query.filter(Article.content_blob.isnot(None)).count(), 1)
+        self.assertEqual(len(self.client.get('/api/articles/search?q=azure').get_json()['items']), 1)
+
+    def test_blobs_are_deleted_with_their_articles(self):
+        id = self.create(self.long_content)
+        self.create(self.long_content)
+        self.client.delete(f'/api/articles/{id}')
+        self.assertEqual(blob_deletion_queue.drain(), 1)
+        self.client.delete(f'/api/users/{self.user.id}')
+        self.assertEqual(blob_deletion_queue.drain(), 1)
+        self.assertEqual(self.blob_store.blobs, {})
+
+    def test_existing_contents_are_moved_in_batches(self):
+        content_store.offload_length = 0
+        ids = [self.create(self.long_content) for _ in range(3)] + [self.create('Short')]
+        content_store.offload_length = 20
+        self.assertEqual(content_store.offload_existing(batch_size=2), 3)
+        self.assertEqual(content_store.offload_existing(batch_size=2), 0)
+        self.assertEqual([Article.get(id).content for id in ids], [None, None, None, 'Short'])
+        self.assertEqual(Article.get(ids[0]).content_words, 'deploying flask to azure')
+        self.assertEqual(self.client.get(f'/api/articles/{ids[0]}').get_json()['content'], self.long_content)
+        self.assertEqual(search_index.rebuild(), 4)
+        self.assertEqual(len(self.client.get('/api/articles/search?q=azure').get_json()['items']), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+import base64
+import io
+import unittest
+
+from types import SimpleNamespace
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+from azure.storage.blob import BlobServiceClient
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+from werkzeug.datastructures import FileStorage
+from backend.datastores import BlobStore, ReplicaRouter, db
+from backend.models import User
+from backend.services import user_service
+from backend.settings import DevelopmentConfig
+from tests.backend.helpers import AppTestCase
+
+
+class FakeBlobClient:
+    def __init__(self):
+        self.staged = {}
+        self.data = None
+
+    def upload_blob(self, data):
+        self.data = data
+
+    def stage_block(self, block_id, data):
+        self.staged[block_id] = data
+
+    def commit_block_list(self, block_list):
+        self.data = b''.join(self.staged[b.id] for b in block_list)
+
+
+class FakeBlobServiceClient:
+    def __init__(self):
+        self.blobs = {}
+
+    def get_blob_client(self, container, blob):
+        return self.blobs.setdefault((container, blob), FakeBlobClient())
+
+
+def create_blob_store(block_size=4, max_concurrency=2):
+    blob_store = BlobStore()
+    blob_store.client = FakeBlobServiceClient()
+    blob_store._init_uploads(SimpleNamespace(config={
+        'BLOB_UPLOAD_BLOCK_SIZE': block_size,
+        'BLOB_UPLOAD_MAX_CONCURRENCY': max_concurrency,
+        'BLOB_UPLOAD_POOL_SIZE': 4}))
+    return blob_store
+
+
+class BlobStoreUploadTests(unittest.TestCase):
+    def upload(self, blob_store, content):
+        filename = blob_store.upload('assets', FileStorage(
+            stream=io.BytesIO(content), filename='image.png'))
+        self.assertTrue(filename.endswith('.png'))
+        return blob_store.client.blobs[('assets', filename)]
+
+    def test_upload_single_block(self):
+        blob_client = self.upload(create_blob_store(), b'abcd')
+        self.assertEqual(blob_client.data, b'abcd')
+        self.assertEqual(blob_client.staged, {})
+
+    def test_upload_blocks(self):
+        content = bytes(range(50))
+        blob_client = self.upload(create_blob_store(), content)
+        self.assertEqual(blob_client.data, content)
+        self.assertEqual(len(blob_client.staged), 13)
+        # Block ids must all be the same length
+        self.assertEqual(len({len(base64.b64decode(i)) for i in blob_client.staged}), 1)
+
+    def test_upload_failed_block_is_not_committed(self):
+        blob_store = create_blob_store()
+        blob_client = FakeBlobClient()
+        blob_client.stage_block = lambda block_id, data: 1/0
+        blob_store.client.get_blob_client = lambda container, blob: blob_client
+        with self.assertRaises(ZeroDivisionError):
+            blob_store.upload('assets', FileStorage(
+                stream=io.BytesIO(bytes(20)), filename='image.png'))
+        self.assertIsNone(blob_client.data)
+
+
+class BlobStoreUploadUrlTests(unittest.TestCase):
+    def test_generate_upload_url(self):
+        blob_store = BlobStore()
+        blob_store.credential = DevelopmentConfig.BLOB_STORE_CREDENTIAL
+        blob_store.client = BlobServiceClient(account_url=DevelopmentConfig.BLOB_STORE_URI,
+            credential=blob_store.credential)
+        url = urlparse(blob_store.generate_upload_url('assets', 'a.png', 60))
+        self.assertTrue(url.path.endswith('/assets/a.png'))
+        # Write only, scoped to the blob
+        self.assertEqual(parse_qs(url.query)['sp'], ['cw'])
+        self.assertEqual(parse_qs(url.query)['sr'], ['b'])
+
+
+
+class ForkedPoolTests(unittest.TestCase):
+    def test_connections_of_parent_process_are_replaced(self):
+        engine = create_engine('sqlite://', poolclass=QueuePool)
+        with engine.connect() as conn:
+            parent_connection = conn.connection.connection
+        with mock.patch('os.getpid', return_value=-1):
+            with engine.connect() as conn:
+                self.assertIsNot(conn.connection.connection, parent_connection)
+                self.assertEqual(conn.execute('SELECT 1').scalar(), 1)
+
+
+class BlobStoreContainersTests(unittest.TestCase):
+    def init_app(self, verify):
+        blob_store = BlobStore()
+        blob_store.init_app(SimpleNamespace(before_first_request=lambda f: f(), config={
+            'BLOB_STORE_URI': DevelopmentConfig.BLOB_STORE_URI,
+            'BLOB_STORE_CREDENTIAL': DevelopmentConfig.BLOB_STORE_CREDENTIAL,
+            'BLOB_STORE_CONTAINERS': ['assets'],
+            'BLOB_STORE_VERIFY_CONTAINERS': verify,
+            'BLOB_UPLOAD_BLOCK_SIZE': 4,
+            'BLOB_UPLOAD_MAX_CONCURRENCY': 2,
+            'BLOB_UPLOAD_POOL_SIZE': 4,
+            'BLOB_CONTENT_ADDRESSED': False}))
+        return blob_store
+
+    def test_client_is_built_on_first_use(self):
+        blob_store = self.init_app('off')
+        self.assertIsNone(blob_store._client)
+        self.assertIs(blob_store.client, blob_store.client)
+        self.assertTrue(blob_store.ready())
+
+    def test_containers_are_verified_in_the_background(self):
+        client = mock.Mock()
+        client.list_containers.side_effect = [IOError('unreachable'), [dict(name='other')]]
+        with mock.patch('azure.storage.blob.BlobServiceClient', return_value=client), \
+                mock.patch.object(BlobStore, 'VERIFY_RETRY_INTERVAL', 0):
+            with mock.patch('threading.Thread') as thread:
+                blob_store = self.init_app('background')
+            self.assertFalse(blob_store.ready())
+            # Run what the thread would have
+            thread.call_args.kwargs['target']()
+        self.assertTrue(blob_store.ready())
+        self.assertEqual(client.list_containers.call_count, 2)
+        self.assertEqual(client.create_container.call_args.args, ('assets',))
+
+
+class ReplicaRoutingTests(AppTestCase):
+    config = dict(SQLALCHEMY_BINDS={'replica_0': 'sqlite://'}, CACHE_BACKEND='none')
+
+    def setUp(self):
+        super().setUp()
+        # Tell the replica apart from the primary by its rows
+        self.replica = db.get_engine(self.app, bind='replica_0')
+        db.Model.metadata.create_all(self.replica)
+        self.replica.execute(User.__table__.insert(), name='Replica', email='replica@acme.org')
+        self.addCleanup(db.Model.metadata.drop_all, self.replica)
+
+    def names(self, resp):
+        return [user['name'] for user in resp.get_json()]
+
+    def test_reads_go_to_the_replica(self):
+        self.assertEqual(self.names(self.client.get('/api/users')), ['Replica'])
+        self.assertEqual(user_service.get(1).name, 'Replica')
+
+    def test_writes_are_read_from_the_primary(self):
+        with self.app.test_request_context():
+            user_service.create(name='Primary', email='primary@acme.org')
+            self.assertEqual([u['name'] for u in user_service.all_dicts()], ['Primary'])
+
+    def test_client_that_wrote_reads_from_the_primary(self):
+        self.client.post('/api/users', json=dict(name='Primary', email='primary@acme.org'))
+        # Other clients still read from the replica (in a new session, 
+        # as the test's app context outlives requests)
+        db.session.remove()
+        db.router._primary_until = 0
+        self.assertEqual(self.names(self.app.test_client().get('/api/users')), ['Replica'])
+        self.assertEqual(self.names(self.client.get('/api/users')), ['Primary'])
+
+    def test_failed_replica_falls_back_to_the_primary(self):
+        self.replica.execute('DROP TABLE articles')
+        self.replica.execute('DROP TABLE users')
+        self.assertEqual(self.names(self.client.get('/api/users')), [])
+        self.assertEqual(db.router.unhealthy, {'replica_0'})
+        # Until it passes a health check
+        db.router.check()
+        self.assertEqual(db.router.unhealthy, set())
+
+
+class ReplicaPerRequestTests(AppTestCase):
+    config = dict(SQLALCHEMY_BINDS={'replica_0': 'sqlite://', 'replica_1': 'sqlite://'}, 
+        CACHE_BACKEND='none')
+
+    def setUp(self):
+        super().setUp()
+        for key in db.router.bind_keys:
+            engine = db.get_engine(self.app, bind=key)
+            db.Model.metadata.create_all(engine)
+            self.addCleanup(db.Model.metadata.drop_all, engine)
+
+    def test_reads_of_a_request_go_to_the_same_replica(self):
+        pick = db.router.pick
+        for _ in range(2):
+            db.session.remove()
+            binds = []
+            def picked(*args):
+                key, engine = pick(*args)
+                binds.append(key)
+                return (key, engine)
+            with mock.patch.object(db.router, 'pick', side_effect=picked):
+                # Reads the version, then the rows
+                self.assertEqual(self.client.get('/api/users').status_code, 200)
+            self.assertEqual(len(binds), 2)
+            self.assertEqual(len(set(binds)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
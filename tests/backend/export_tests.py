@@ -0,0 +1,99 @@
+import csv
+import io
+import json
+import unittest
+
+from datetime import datetime
+from unittest import mock
+from backend import export
+from backend.contents import content_store
+from backend.models import Article, User
+from backend.services import article_service
+from tests.backend.helpers import AppTestCase
+
+
+class ExportTests(AppTestCase):
+    config = dict(EXPORT_BATCH_SIZE=2)
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.create(name='Jane', email='jane@acme.org', created_at=datetime(2020, 12, 11))
+        self.articles = [Article.create(user_id=self.user.id, title=f'Article {i}',
+            created_at=datetime(2020, 12, 11, 12, i)) for i in range(5)]
+
+    def get_export(self, table, **args):
+        resp = self.client.get(f'/api/export/{table}', query_string=args)
+        self.assertEqual(resp.status_code, 200)
+        return resp
+
+    def test_ndjson(self):
+        resp = self.get_export('articles')
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertEqual(resp.headers['X-Export-Watermark'], '2020-12-11T12:04:00')
+        rows = [json.loads(line) for line in resp.get_data().splitlines()]
+        self.assertEqual([row['title'] for row in rows], [f'Article {i}' for i in range(5)])
+        self.assertEqual(rows[0]['created_at'], '2020-12-11T12:00:00')
+        self.assertIsNone(rows[0]['content'])
+
+    def test_csv(self):
+        resp = self.get_export('users', format='csv')
+        self.assertEqual(resp.mimetype, 'text/csv')
+        self.assertEqual(list(csv.reader(io.StringIO(resp.get_data(as_text=True)))),
+            [['id', 'name', 'email', 'created_at'], 
+             [str(self.user.id), 'Jane', 'jane@acme.org', '2020-12-11T00:00:00']])
+        self.assertEqual(resp.headers['X-Export-Watermark'], str(self.user.id))
+
+    def test_incremental(self):
+        watermark = self.get_export('articles', format='csv').headers['X-Export-Watermark']
+        resp = self.get_export('articles', format='csv', since=watermark)
+        self.assertEqual(resp.get_data(as_text=True).splitlines()[1:], [])
+        self.assertEqual(resp.headers['X-Export-Watermark'], watermark)
+        Article.create(user_id=self.user.id, title='New', created_at=datetime(2020, 12, 12))
+        resp = self.get_export('articles', since=watermark)
+        self.assertEqual([json.loads(line)['title'] for line in resp.get_data().splitlines()], ['New'])
+        self.assertEqual(resp.headers['X-Export-Watermark'], '2020-12-12T00:00:00')
+
+    def test_recent_rows_are_left_for_the_next_export(self):
+        # Those may commit after rows with a later watermark
+        Article.create(user_id=self.user.id, title='Recent', created_at=datetime.utcnow())
+        User.create(name='Recent', email='recent@acme.org')
+        resp = self.get_export('articles')
+        self.assertEqual(resp.headers['X-Export-Watermark'], '2020-12-11T12:04:00')
+        self.assertEqual(len(resp.get_data().splitlines()), 5)
+        self.assertEqual(self.get_export('users').headers['X-Export-Watermark'], str(self.user.id))
+        with mock.patch.object(export.exporter, 'watermark_lag', 0):
+            resp = self.get_export('articles', since='2020-12-11T12:04:00')
+        self.assertEqual([json.loads(line)['title'] for line in resp.get_data().splitlines()], ['Recent'])
+
+    def test_offloaded_contents_are_exported(self):
+        content_store.offload_length = 10
+        article_service.create(user_id=self.user.id, title='Long', content='Flask on Azure')
+        with mock.patch.object(export.exporter, 'watermark_lag', 0):
+            resp = self.get_export('articles', since='2020-12-11T12:04:00')
+        (row,) = [json.loads(line) for line in resp.get_data().splitlines()]
+        self.assertEqual(row['content'], 'Flask on Azure')
+        self.assertNotIn('content_blob', row)
+        self.assertNotIn('content_words', row)
+
+    def test_rows_are_read_a_batch_at_a_time(self):
+        with mock.patch.object(export.NdjsonFormat, 'batch', autospec=True,
+                side_effect=lambda self, columns: b'') as batch:
+            self.get_export('articles').get_data()
+        self.assertEqual([len(call.args[1][0]) for call in batch.call_args_list], [2, 2, 1])
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.client.get('/api/export/jobs').status_code, 404)
+        self.assertEqual(self.client.get('/api/export/users?format=xml').status_code, 400)
+        self.assertEqual(self.client.get('/api/export/articles?since=yesterday').status_code, 400)
+
+    @unittest.skipUnless(export.pyarrow, 'requires pyarrow')
+    def test_parquet(self):
+        import pyarrow.parquet
+        resp = self.get_export('articles', format='parquet')
+        table = pyarrow.parquet.read_table(io.BytesIO(resp.get_data()))
+        self.assertEqual(table.column('title').to_pylist(), [f'Article {i}' for i in range(5)])
+        self.assertEqual(table.column('created_at').to_pylist()[0], datetime(2020, 12, 11, 12, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
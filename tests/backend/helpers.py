@@ -0,0 +1,127 @@
+import os
+import unittest
+import uuid
+
+from concurrent.futures import Future
+from unittest import mock
+from backend import api, blob_cache, compression, contents, datastores, export, images, limits, search, serializers, services
+from backend.app import create_config_only_app
+from backend.datastores import db
+
+
+class FakeBlobStore:
+    """In memory stand-in for `datastores.BlobStore`."""
+    def __init__(self, content_addressed=False):
+        self.blobs = {}
+        self.content_addressed = content_addressed
+        self.uploads = 0
+
+    def init_app(self, app):
+        pass
+
+    def name(self, file):
+        if self.content_addressed:
+            return datastores.content_address(file, 1024)
+        return (file, self.new_blob_filename(file.filename))
+
+    def upload_async(self, container_name, file, blob_filename=None):
+        if blob_filename is None:
+            file, blob_filename = self.name(file)
+        future = Future()
+        try:
+            future.set_result(self.upload(container_name, file, blob_filename=blob_filename))
+        except Exception as e:
+            future.set_exception(e)
+        return (blob_filename, future)
+
+    def upload(self, container_name, file, existing_blob=None, blob_filename=None):
+        if self.content_addressed:
+            if blob_filename is None:
+                file, blob_filename = datastores.content_address(file, 1024)
+            if self.exists(container_name, blob_filename):
+                file.close()
+                return blob_filename
+        blob_filename = blob_filename or self.new_blob_filename(file.filename)
+        self.uploads += 1
+        with file.stream as data:
+            self.blobs[(container_name, blob_filename)] = data.read()
+        return blob_filename
+
+    def new_blob_filename(self, filename):
+        return f'blob-{uuid.uuid4()}{os.path.splitext(filename)[1]}'
+
+    def generate_upload_url(self, container_name, blob_filename, expires_in):
+        return f'http://blobs/{container_name}/{blob_filename}?sas'
+
+    def ready(self):
+        return True
+
+    def download(self, container_name, blob_filename):
+        return self.blobs[(container_name, blob_filename)]
+
+    def download_to(self, container_name, blob_filename, file):
+        if not self.exists(container_name, blob_filename):
+            raise FileNotFoundError(blob_filename)
+        file.write(self.download(container_name, blob_filename))
+
+    def exists(self, container_name, blob_filename):
+        return (container_name, blob_filename) in self.blobs
+
+    def delete(self, container_name, blob_filename):
+        self.blobs.pop((container_name, blob_filename), None)
+
+    def delete_many(self, container_name, blob_filenames):
+        for blob_filename in blob_filenames:
+            self.delete(container_name, blob_filename)
+        return set()
+
+
+def create_test_app(**config):
+    """Produces an app backed by an in memory SQLite database, note the 
+    blob store is left to the caller to replace (see `FakeBlobStore`). 
+    Any config given overrides the defaults."""
+    app = create_config_only_app()
+    app.config['TESTING'] = True
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['BLOB_DELETE_WORKER'] = False
+    app.config['IMAGE_PIPELINE'] = False
+    app.config.update(config)
+    datastores.db.init_app(app)
+    services.blob_deletion_queue.init_app(app)
+    services.job_runner.init_app(app)
+    images.image_pipeline.init_app(app)
+    search.search_index.init_app(app)
+    export.exporter.init_app(app)
+    serializers.encoder.init_app(app)
+    compression.compression.init_app(app)
+    limits.limiter.init_app(app)
+    blob_cache.blob_cache.init_app(app)
+    contents.content_store.init_app(app)
+    services.cache.init_app(app)
+    services.article_service.init_app(app)
+    services.user_service.init_app(app)
+    app.register_blueprint(api.bp)
+    with app.app_context():
+        datastores.db.create_all()
+    return app
+
+
+class AppTestCase(unittest.TestCase):
+    """Runs each test against a fresh `create_test_app` (with `config`) and
+    `FakeBlobStore`."""
+    config = {}
+
+    def setUp(self):
+        self.blob_store = FakeBlobStore()
+        for target in ('backend.services.blob_store', 'backend.images.blob_store',
+                'backend.blob_cache.blob_store', 'backend.contents.blob_store'):
+            patcher = mock.patch(target, new=self.blob_store)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.app = create_test_app(**self.config)
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.addCleanup(self.ctx.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
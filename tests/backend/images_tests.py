@@ -0,0 +1,67 @@
+import io
+import unittest
+
+from werkzeug.datastructures import FileStorage
+from backend.images import Image, image_pipeline, render_variants
+from backend.models import Article, BlobDeletion, User
+from backend.services import article_service
+from tests.backend.helpers import AppTestCase
+
+
+def png(width, height):
+    output = io.BytesIO()
+    Image.new('RGB', (width, height), 'teal').save(output, format='PNG')
+    return output.getvalue()
+
+
+@unittest.skipIf(Image is None, 'Pillow is not installed')
+class RenderVariantsTests(unittest.TestCase):
+    def test_resizes_without_upscaling(self):
+        variants = render_variants(png(800, 400), sizes=[160, 1600], formats=['webp'], quality=80)
+        self.assertEqual(sorted(variants), ['160.webp', '1600.webp'])
+        self.assertEqual(Image.open(io.BytesIO(variants['160.webp'])).size, (160, 80))
+        self.assertEqual(Image.open(io.BytesIO(variants['1600.webp'])).size, (800, 400))
+
+
+@unittest.skipIf(Image is None, 'Pillow is not installed')
+class ImagePipelineTests(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config.update(IMAGE_PIPELINE=True, IMAGE_VARIANT_SIZES=[160], 
+            IMAGE_VARIANT_FORMATS=['webp'], IMAGE_PROCESS_WORKERS=1)
+        image_pipeline.init_app(self.app)
+        self.addCleanup(image_pipeline.init_app, self.app)
+        self.addCleanup(self.app.config.update, IMAGE_PIPELINE=False)
+
+    def wait_for_pipeline(self):
+        # A single worker runs images in order, so this waits for the others
+        image_pipeline.executor.submit(lambda: None).result()
+
+    def test_variants_are_uploaded_and_exposed(self):
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        article = article_service.create(user_id=user.id, title='a',
+            image=FileStorage(stream=io.BytesIO(png(800, 400)), filename='a.png'))
+        self.wait_for_pipeline()
+
+        variant_filename = Article.variant_filename(article.image_filename, '160.webp')
+        self.assertIn(('articleassets', variant_filename), self.blob_store.blobs)
+        variants = article_service.get(article.id).as_dict()['image_variants']
+        self.assertEqual(variants, {'160.webp': 
+            f"{self.app.config['BLOB_STORE_URI']}/articleassets/{variant_filename}"})
+        self.assertEqual(article_service.all_dicts()[0]['image_variants'], variants)
+
+        article_service.delete(article.id)
+        self.assertEqual(sorted(d.blob_filename for d in BlobDeletion.query),
+            sorted([article.image_filename, variant_filename]))
+
+    def test_invalid_image_is_left_without_variants(self):
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        article = article_service.create(user_id=user.id, title='a',
+            image=FileStorage(stream=io.BytesIO(b'png'), filename='a.png'))
+        self.wait_for_pipeline()
+        self.assertIsNone(article_service.get(article.id).as_dict()['image_variants'])
+        self.assertEqual(len(self.blob_store.blobs), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+
+from unittest import mock
+from backend.limits import MemoryBuckets, limiter, rejected_requests
+from tests.backend.helpers import AppTestCase
+
+
+class MemoryBucketsTests(unittest.TestCase):
+    def test_tokens_refill_over_time(self):
+        buckets = MemoryBuckets(max_keys=10)
+        with mock.patch('time.monotonic', return_value=100):
+            self.assertEqual([buckets.take('a', 2, 2) for _ in range(3)], [0, 0, 0.5])
+            # Other keys have their own bucket
+            self.assertEqual(buckets.take('b', 2, 2), 0)
+        with mock.patch('time.monotonic', return_value=100.5):
+            self.assertEqual(buckets.take('a', 2, 2), 0)
+
+    def test_least_recently_used_keys_are_dropped(self):
+        buckets = MemoryBuckets(max_keys=2)
+        for key in 'abc':
+            buckets.take(key, 1, 1)
+        self.assertEqual(list(buckets._buckets), ['b', 'c'])
+
+
+class LimiterTests(AppTestCase):
+    config = dict(RATE_LIMITS={'list': (0.01, 2)}, CONCURRENCY_LIMITS={'upload': 1},
+        CONCURRENCY_QUEUE_TIMEOUT=0, RATE_LIMIT_API_KEYS={'other'})
+
+    def test_rate_limited_clients_get_429(self):
+        rejected = rejected_requests.value(reason='rate_limit', endpoint_class='list')
+        self.assertEqual([self.client.get('/api/users').status_code for _ in range(3)], [200, 200, 429])
+        resp = self.client.get('/api/users')
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], '100')
+        # Other endpoint classes, and clients, have their own tokens
+        self.assertEqual(self.client.get('/api/jobs/unknown').status_code, 404)
+        self.assertEqual(self.client.get('/api/users', headers={'X-API-Key': 'other'}).status_code, 200)
+        self.assertEqual(rejected_requests.value(reason='rate_limit', endpoint_class='list'), rejected + 2)
+
+    def test_clients_cannot_pick_their_own_bucket(self):
+        for _ in range(2):
+            self.client.get('/api/users')
+        # Neither with a made up key, nor a spoofed forwarded address
+        self.assertEqual(self.client.get('/api/users', headers={'X-API-Key': 'made-up'}).status_code, 429)
+        self.app.config['RATE_LIMIT_TRUST_PROXY'] = True
+        limiter.init_app(self.app)
+        self.assertEqual([self.client.get('/api/users', 
+            headers={'X-Forwarded-For': f'10.0.0.{i}, 1.2.3.4'}).status_code for i in range(3)], [200, 200, 429])
+
+    def test_requests_over_the_concurrency_limit_get_503(self):
+        user = self.client.post('/api/users', json=dict(name='Jane', email='jane@acme.org')).get_json()
+        rows = [dict(user_id=user['id'], title='Hello')]
+        self.assertEqual(self.client.post('/api/articles:batch', json=rows).status_code, 200)
+        # Another request is in flight
+        limiter._slots['upload'].acquire()
+        resp = self.client.post('/api/articles:batch', json=rows)
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+        limiter._slots['upload'].release()
+        self.assertEqual(self.client.post('/api/articles:batch', json=rows).status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+
+from unittest import mock
+from backend.datastores import db
+from backend.models import ArticleTerm, User
+from backend.search import search_index, tokenize
+from tests.backend.helpers import AppTestCase
+
+
+class SearchTests(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.create(name='Jane', email='jane@acme.org')
+
+    def create(self, title, content=None):
+        return self.client.post('/api/articles', json=dict(user_id=self.user.id,
+            title=title, content=content)).get_json()['id']
+
+    def search(self, q, **args):
+        resp = self.client.get('/api/articles/search', query_string=dict(q=q, **args))
+        self.assertEqual(resp.status_code, 200)
+        return resp.get_json()
+
+    def ids(self, q, **args):
+        return [article['id'] for article in self.search(q, **args)['items']]
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize("Azure's Flask, 2020!"), ['azure', 's', 'flask', '2020'])
+        self.assertEqual(tokenize(None), [])
+
+    def test_matches_all_words_ranked_best_first(self):
+        in_content = self.create('Getting started', 'Deploying Flask to Azure')
+        in_title = self.create('Flask on Azure', 'Deploying it')
+        self.create('Flask only', 'Nothing else')
+        self.assertEqual(self.ids('azure FLASK'), [in_title, in_content])
+        self.assertEqual(self.ids('azure django'), [])
+        self.assertEqual(self.search('flask')['items'][0]['title'], 'Flask on Azure')
+
+    def test_paginated(self):
+        ids = [self.create(f'Article {i}', 'flask ' * (5 - i)) for i in range(5)]
+        first = self.search('flask', limit=2)
+        self.assertEqual([a['id'] for a in first['items']], ids[:2])
+        second = self.search('flask', limit=2, after=first['next'])
+        self.assertEqual([a['id'] for a in second['items']], ids[2:4])
+        last = self.search('flask', limit=2, after=second['next'])
+        self.assertEqual([a['id'] for a in last['items']], ids[4:])
+        self.assertIsNone(last['next'])
+
+    def test_index_follows_creates_and_deletes(self):
+        id = self.create('Hello Azure')
+        resp = self.client.post('/api/articles:batch', json=[
+            dict(user_id=self.user.id, title='Azure batch', content='more azure')])
+        self.assertEqual(resp.get_json()['created'], 1)
+        self.assertEqual(len(self.ids('azure')), 2)
+        self.client.delete(f'/api/articles/{id}')
+        self.assertEqual(len(self.ids('azure')), 1)
+        # Along with their user
+        self.client.delete(f'/api/users/{self.user.id}')
+        self.assertEqual(self.ids('azure'), [])
+        self.assertEqual(ArticleTerm.query.count(), 0)
+
+    def test_rebuild(self):
+        id = self.create('Hello Azure')
+        ArticleTerm.query.delete()
+        self.assertEqual(self.ids('azure'), [])
+        self.assertEqual(search_index.rebuild(batch_size=1), 1)
+        self.assertEqual(self.ids('azure'), [id])
+
+    def test_full_text_search_covers_offloaded_contents(self):
+        with mock.patch.object(search_index, '_backend', 'fulltext'), \
+                mock.patch.object(db.session, 'execute', return_value=[(1,)]) as execute:
+            self.assertEqual(search_index.search('azure flask', 10), [1])
+        statement, params = execute.call_args.args
+        self.assertIn('CONTAINSTABLE(articles, (title, content, content_words)', str(statement))
+        self.assertEqual(params['condition'], '"azure" AND "flask"')
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.client.get('/api/articles/search').status_code, 400)
+        self.assertEqual(self.client.get('/api/articles/search?q=a&after=nope').status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+from datetime import datetime
+from unittest import mock
+from flask import jsonify
+from backend.datastores import db
+from backend.models import User, Article
+from backend.serializers import encoder, orjson
+from backend.services import article_service
+from tests.backend.helpers import AppTestCase
+
+
+class EncoderTests(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.debug = False
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        for title in ['plain', 'café  ', 'ctrl \x00\x7f "quoted" </script>']:
+            db.session.add(Article(title=title, user_id=user.id, content=None,
+                created_at=datetime(2020, 12, 11, 12, 3, 25, 123)))
+        db.session.commit()
+
+    def list_dicts(self):
+        """Dicts of the articles as listed, lists are metadata only."""
+        return [{name: value for name, value in a.as_dict().items() if name in Article.__list_fields__}
+            for a in Article.query.all()]
+
+    def assertSameAsJsonify(self, value, expected):
+        with self.app.test_request_context():
+            self.assertEqual(encoder.response(value).get_data(), jsonify(expected).get_data())
+
+    @unittest.skipIf(orjson is None, 'orjson is not installed')
+    def test_fast_path_is_enabled(self):
+        self.assertTrue(encoder.enabled)
+
+    def test_rows_match_jsonify_of_models(self):
+        models = self.list_dicts()
+        self.assertSameAsJsonify(article_service.all_dicts(), models)
+        self.assertSameAsJsonify(dict(items=models[:1]), dict(items=models[:1]))
+
+    def test_non_ascii_output_matches_jsonify(self):
+        models = self.list_dicts()
+        with mock.patch.object(encoder, 'ascii', False), \
+                mock.patch.dict(self.app.config, JSON_AS_ASCII=False):
+            self.assertSameAsJsonify(article_service.all_dicts(), models)
+
+    def test_streamed_list_matches_jsonify(self):
+        models = self.list_dicts()
+        with mock.patch.multiple(encoder, stream_min_items=2, stream_batch_size=2):
+            with self.app.test_request_context():
+                self.assertTrue(encoder.response(models).is_streamed)
+            self.assertSameAsJsonify(article_service.all_dicts(), models)
+
+    def test_pretty_output_matches_jsonify(self):
+        self.app.debug = True
+        models = self.list_dicts()
+        self.assertSameAsJsonify(article_service.all_dicts(), models)
+
+
+if __name__ == '__main__':
+    unittest.main()
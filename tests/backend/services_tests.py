@@ -0,0 +1,87 @@
+import io
+import unittest
+
+from unittest import mock
+from werkzeug.datastructures import FileStorage
+from backend.datastores import db
+from backend.models import Article, User
+from backend.services import LRUCache, article_service, cache, user_service
+from tests.backend.helpers import AppTestCase
+
+
+class LRUCacheTests(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        lru = LRUCache(max_entries=2, ttl=60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        lru.set('c', 3)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.stats(), dict(hits=2, misses=1, evictions=1, entries=2))
+
+    def test_expires_entries(self):
+        lru = LRUCache(max_entries=2, ttl=60)
+        with mock.patch('time.monotonic', return_value=0):
+            lru.set('a', 1)
+        with mock.patch('time.monotonic', return_value=61):
+            self.assertIsNone(lru.get('a'))
+
+
+class ServiceCacheTests(AppTestCase):
+    def test_get_is_cached_until_updated(self):
+        user = user_service.create(name='Daryl Zero', email='daryl@acme.org')
+        user_service.get(user.id)
+        with mock.patch.object(db.session, 'execute', side_effect=AssertionError):
+            self.assertEqual(user_service.get(user.id).name, 'Daryl Zero')
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        user_service.update(id=user.id, name='Daryl One')
+        db.session.remove()
+        self.assertEqual(user_service.get(user.id).name, 'Daryl One')
+
+    def test_all_is_invalidated_by_mutators(self):
+        user = user_service.create(name='Daryl Zero', email='daryl@acme.org')
+        self.assertEqual(len(user_service.all()), 1)
+        self.assertEqual(len(user_service.all()), 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+        user_service.create(name='Daryl One', email='one@acme.org')
+        self.assertEqual(len(user_service.all()), 2)
+        user_service.delete(user.id)
+        self.assertEqual([u.name for u in user_service.all()], ['Daryl One'])
+
+
+    def test_all_dicts_are_cached_once_whatever_the_version(self):
+        for i in range(5):
+            # Straight to the database, as other processes would
+            User.create(name=f'User {i}', email=f'{i}@acme.org')
+            self.assertEqual(len(user_service.all_dicts()), i + 1)
+            self.assertEqual(len(user_service.all_dicts()), i + 1)
+        self.assertEqual(cache.stats()['entries'], 1)
+
+
+class ArticleServiceCreateTests(AppTestCase):
+    def image(self):
+        return FileStorage(stream=io.BytesIO(b'png'), filename='a.png')
+
+    def test_create_with_image(self):
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        article = article_service.create(image=self.image(), user_id=user.id, title='a')
+        self.assertIn(('articleassets', article.image_filename), self.blob_store.blobs)
+        self.assertEqual(Article.query.count(), 1)
+
+    def test_failed_upload_rolls_back_article(self):
+        user = User.create(name='Daryl Zero', email='daryl@acme.org')
+        with mock.patch.object(self.blob_store, 'upload', side_effect=IOError):
+            with self.assertRaises(IOError):
+                article_service.create(image=self.image(), user_id=user.id, title='a')
+        self.assertEqual(Article.query.count(), 0)
+
+    def test_failed_insert_rolls_back_upload(self):
+        with self.assertRaises(Exception):
+            article_service.create(image=self.image(), user_id=1, title=None)
+        self.assertEqual(self.blob_store.blobs, {})
+
+
+if __name__ == '__main__':
+    unittest.main()